@@ -0,0 +1,224 @@
+"""
+准入控制和过载保护
+一轮对话以及其中的ASR、LLM、TTS各阶段各有一个限流器：同时处理的请求数有上限，超出的请求在有界队列中排队，
+队列已满或排到截止时间仍未轮到时立即以BusyError拒绝，新请求不会排在几分钟的积压之后
+
+- 限额格式：同时处理数:排队上限[:最长排队秒数]，例如 8:16:5；排队上限为0时满员立即拒绝
+- 一轮对话收到时用deadline_scope确定排队截止时间，随任务上下文传给其中每个阶段，
+  各阶段的排队时间都不超过它，有空闲名额时不受截止时间限制；
+  voice_server把它作为整个请求的时限，各阶段用time_left得到剩余的时间
+- 名额按先来先到直接交给排队中的下一个请求，被取消或超时的请求让出位置
+- 占用和排队情况见get_stats，以及 /metrics 的huohuo_admission_*指标
+"""
+
+import asyncio
+import contextvars
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+from metrics import ADMISSION_IN_FLIGHT, ADMISSION_WAITING, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+DEFAULT_MAX_WAIT = 10.0  # 限额中没有指定时的最长排队秒数
+
+# 当前请求的排队截止时间（time.monotonic()），由deadline_scope设置，新建的任务会继承
+request_deadline = contextvars.ContextVar('request_deadline', default=None)
+
+
+class BusyReason:
+    QUEUE_FULL = 'queue_full'  # 排队人数已达上限
+    TIMEOUT = 'timeout'  # 到截止时间仍未轮到
+    RATE_LIMIT = 'rate_limit'  # 截止时间前等不到上游配额，见rate_limit.py
+
+
+class BusyError(Exception):
+    """某个阶段满载，请求被拒绝"""
+
+    def __init__(self, stage: str, reason: str, waited: float = 0.0):
+        super().__init__(f"{stage}繁忙（{reason}）")
+        self.stage = stage
+        self.reason = reason
+        self.waited = waited
+
+    def to_dict(self) -> dict:
+        return {
+            'stage': self.stage,
+            'reason': self.reason,
+            'waited_ms': round(self.waited * 1000, 1)
+        }
+
+
+class _Expired(Exception):
+    """排队超时，由acquire转换为BusyError"""
+
+
+@contextmanager
+def deadline_scope(seconds: float):
+    """with块内（包括其中新建的任务）的排队截止时间为seconds秒之后"""
+    token = request_deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+def time_left() -> Optional[float]:
+    """距当前请求截止时间的秒数，没有截止时间时为None"""
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class StageLimiter:
+    """
+    一个阶段的并发上限和有界等待队列，用法: async with limiter: ...
+
+    Args:
+        stage (str): 阶段名称，用于统计和BusyError
+        max_concurrency (int): 同时处理的请求数上限
+        max_queue (int): 排队请求数上限
+        max_wait (float): 最长排队秒数
+    """
+
+    def __init__(self, stage: str, max_concurrency: int, max_queue: int, max_wait: float = DEFAULT_MAX_WAIT):
+        if max_concurrency < 1:
+            raise ValueError(f"{stage}的并发上限至少为1: {max_concurrency}")
+        if max_queue < 0 or max_wait < 0:
+            raise ValueError(f"{stage}的排队上限和排队时间不能为负数")
+        self.stage = stage
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.waiters = deque()
+
+        # 统计信息
+        self.admitted = 0
+        self.queued = 0  # 经过排队才轮到的请求数
+        self.rejected = {BusyReason.QUEUE_FULL: 0, BusyReason.TIMEOUT: 0}
+        self.total_wait = 0.0
+        self.max_seen_wait = 0.0
+        self.in_flight_gauge = ADMISSION_IN_FLIGHT.labels(stage)
+        self.waiting_gauge = ADMISSION_WAITING.labels(stage)
+        self.wait_histogram = ADMISSION_WAIT_SECONDS.labels(stage)
+        self.rejected_counters = {reason: ADMISSION_REJECTED.labels(stage, reason) for reason in self.rejected}
+
+    @classmethod
+    def parse(cls, stage: str, spec: str) -> 'StageLimiter':
+        """
+        按配置字符串创建限流器
+
+        Args:
+            spec (str): 同时处理数:排队上限[:最长排队秒数]，例如 8:16 或 8:16:5
+        """
+        parts = spec.strip().split(':')
+        if len(parts) not in (2, 3):
+            raise ValueError(f"{stage}的限额格式应为 同时处理数:排队上限[:最长排队秒数]: {spec}")
+        max_wait = float(parts[2]) if len(parts) == 3 else DEFAULT_MAX_WAIT
+        return cls(stage, int(parts[0]), int(parts[1]), max_wait)
+
+    @property
+    def waiting(self) -> int:
+        return len(self.waiters)
+
+    async def acquire(self) -> float:
+        """
+        取得一个名额，返回排队的秒数
+
+        Raises:
+            BusyError: 队列已满，或到截止时间仍未轮到
+        """
+        if self.in_flight < self.max_concurrency and not self.waiters:
+            self.in_flight += 1
+            self._admit(0.0, queued=False)
+            return 0.0
+        if len(self.waiters) >= self.max_queue:
+            self._reject(BusyReason.QUEUE_FULL, 0.0)
+
+        timeout = self.max_wait
+        deadline = request_deadline.get()
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            self._reject(BusyReason.TIMEOUT, 0.0)
+
+        loop = asyncio.get_event_loop()
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        self.waiting_gauge.set(len(self.waiters))
+        start = time.monotonic()
+        timer = loop.call_later(timeout, self._expire, waiter)
+        try:
+            await waiter
+        except _Expired:
+            self._remove(waiter)
+            self._reject(BusyReason.TIMEOUT, time.monotonic() - start)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                # 名额已经交过来，但请求在轮到的同时被取消，转给下一个
+                self.release()
+            self._remove(waiter)
+            raise
+        finally:
+            timer.cancel()
+        waited = time.monotonic() - start
+        self._admit(waited, queued=True)
+        return waited
+
+    def release(self) -> None:
+        """归还名额，有人排队时直接交给最早的一个"""
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.waiting_gauge.set(len(self.waiters))
+                return
+        self.in_flight -= 1
+        self.in_flight_gauge.set(self.in_flight)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+        return False
+
+    def _expire(self, waiter: asyncio.Future) -> None:
+        if not waiter.done():
+            waiter.set_exception(_Expired())
+
+    def _remove(self, waiter: asyncio.Future) -> None:
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+        self.waiting_gauge.set(len(self.waiters))
+
+    def _admit(self, waited: float, queued: bool) -> None:
+        self.admitted += 1
+        self.queued += queued
+        self.total_wait += waited
+        self.max_seen_wait = max(self.max_seen_wait, waited)
+        self.wait_histogram.observe(waited)
+        self.in_flight_gauge.set(self.in_flight)
+
+    def _reject(self, reason: str, waited: float) -> None:
+        self.rejected[reason] += 1
+        self.rejected_counters[reason].inc()
+        raise BusyError(self.stage, reason, waited)
+
+    def get_stats(self) -> dict:
+        """返回限额、当前占用和排队情况"""
+        return {
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'max_wait_s': self.max_wait,
+            'in_flight': self.in_flight,
+            'waiting': len(self.waiters),
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': dict(self.rejected),
+            'avg_wait_ms': round(self.total_wait * 1000 / self.admitted, 1) if self.admitted else 0.0,
+            'max_wait_ms': round(self.max_seen_wait * 1000, 1)
+        }
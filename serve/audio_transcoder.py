@@ -0,0 +1,273 @@
+"""
+非阻塞音频转码服务
+把各种格式的录音统一转换为ASR需要的16kHz 16bit单声道WAV
+
+- 非WAV输入通过asyncio子进程调用ffmpeg，音频经stdin管道传入，不落盘
+- 同时运行的ffmpeg进程数有上限，超出的请求排队等待
+- 只需重采样/混音的WAV输入在进程内用NumPy向量化处理（需要安装numpy），降采样前先低通滤波，
+  避免高于目标奈奎斯特频率的成分混叠进语音频段
+- 所有阻塞操作都不在事件循环上执行
+"""
+
+import asyncio
+import logging
+import struct
+import time
+import weakref
+from typing import Optional, Tuple
+
+from metrics import STAGE_SECONDS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_RATE = 16000
+MAX_CONCURRENT_CONVERSIONS = 2  # 同时运行的ffmpeg进程数
+CONVERSION_TIMEOUT = 30  # 单次转码超时（秒）
+ANTI_ALIAS_TAPS_PER_RATIO = 32  # 降采样低通滤波器的阶数为降采样倍数的该倍数
+ANTI_ALIAS_CUTOFF = 0.9  # 低通截止频率占目标奈奎斯特频率的比例，留出过渡带
+
+WAV_FORMAT_PCM = 1
+WAV_FORMAT_FLOAT = 3
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+
+CHUNK_HEADER = struct.Struct('<4sI')
+FMT_CHUNK = struct.Struct('<HHIIHH')
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+
+def parse_wav(data: bytes) -> Optional[Tuple[int, int, int, int, memoryview]]:
+    """
+    解析WAV文件头
+
+    Returns:
+        (audio_format, channels, sample_rate, bits_per_sample, 音频数据)，不是WAV时返回None
+    """
+    if len(data) < 44 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+
+    view = memoryview(data)
+    fmt = None
+    pos = 12
+    while pos + CHUNK_HEADER.size <= len(data):
+        chunk_id, chunk_size = CHUNK_HEADER.unpack_from(data, pos)
+        body = pos + CHUNK_HEADER.size
+        if chunk_id == b'fmt ' and chunk_size >= FMT_CHUNK.size:
+            fmt = list(FMT_CHUNK.unpack_from(data, body))
+            if fmt[0] == WAV_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                # 扩展格式的子格式GUID前两个字节即实际的编码格式
+                fmt[0] = struct.unpack_from('<H', data, body + 24)[0]
+        elif chunk_id == b'data' and fmt is not None:
+            audio_format, channels, sample_rate, _, _, bits = fmt
+            return audio_format, channels, sample_rate, bits, view[body:body + chunk_size]
+        pos = body + chunk_size + (chunk_size & 1)
+    return None
+
+
+def build_wav(pcm: bytes, sample_rate: int = DEFAULT_SAMPLE_RATE, channels: int = 1) -> bytes:
+    """为16bit PCM数据加上WAV文件头"""
+    header = WAV_HEADER.pack(
+        b'RIFF', 36 + len(pcm), b'WAVE',
+        b'fmt ', 16, WAV_FORMAT_PCM, channels, sample_rate,
+        sample_rate * channels * 2, channels * 2, 16,
+        b'data', len(pcm)
+    )
+    return header + bytes(pcm)
+
+
+def lowpass_kernel(cutoff: float, taps: int):
+    """
+    Hamming窗的sinc低通FIR滤波器
+
+    Args:
+        cutoff (float): 截止频率与原采样率之比（0~0.5）
+        taps (int): 阶数（奇数）
+    """
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def resample_wav(data: bytes, sample_rate: int = DEFAULT_SAMPLE_RATE) -> Optional[bytes]:
+    """
+    用NumPy把WAV转换为目标采样率的16bit单声道WAV
+
+    Returns:
+        bytes: 转换后的WAV，格式不支持或未安装numpy时返回None
+    """
+    info = parse_wav(data)
+    if info is None or np is None:
+        return None
+
+    audio_format, channels, rate, bits, pcm = info
+    if audio_format == WAV_FORMAT_PCM and bits == 16:
+        samples = np.frombuffer(pcm[:len(pcm) // 2 * 2], dtype='<i2').astype(np.float32)
+    elif audio_format == WAV_FORMAT_PCM and bits == 32:
+        samples = np.frombuffer(pcm[:len(pcm) // 4 * 4], dtype='<i4').astype(np.float32) / 65536.0
+    elif audio_format == WAV_FORMAT_PCM and bits == 8:
+        samples = (np.frombuffer(pcm, dtype=np.uint8).astype(np.float32) - 128.0) * 256.0
+    elif audio_format == WAV_FORMAT_FLOAT and bits == 32:
+        samples = np.frombuffer(pcm[:len(pcm) // 4 * 4], dtype='<f4') * 32767.0
+    else:
+        return None
+
+    if channels < 1 or rate <= 0:
+        return None
+
+    # 混音为单声道
+    if channels > 1:
+        samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+
+    # 降采样时先低通滤波，再线性插值重采样
+    if rate > sample_rate:
+        ratio = rate / sample_rate
+        taps = int(ANTI_ALIAS_TAPS_PER_RATIO * ratio) | 1
+        kernel = lowpass_kernel(ANTI_ALIAS_CUTOFF * 0.5 / ratio, taps)
+        samples = np.convolve(samples, kernel, mode='same')
+    if rate != sample_rate and len(samples) > 1:
+        target_len = int(len(samples) * sample_rate / rate)
+        positions = np.arange(target_len, dtype=np.float64) * (rate / sample_rate)
+        samples = np.interp(positions, np.arange(len(samples)), samples)
+
+    out = np.clip(samples, -32768, 32767).astype('<i2')
+    return build_wav(out.tobytes(), sample_rate)
+
+
+def is_target_wav(data: bytes, sample_rate: int = DEFAULT_SAMPLE_RATE) -> bool:
+    """是否已经是16bit单声道目标采样率的PCM WAV"""
+    info = parse_wav(data)
+    if info is None:
+        return False
+    audio_format, channels, rate, bits, _ = info
+    return audio_format == WAV_FORMAT_PCM and channels == 1 and rate == sample_rate and bits == 16
+
+
+class AudioTranscoder:
+    """
+    音频转码服务
+
+    Args:
+        max_workers (int): 同时运行的ffmpeg进程数
+        sample_rate (int): 输出采样率
+        timeout (float): 单次转码超时（秒）
+    """
+
+    def __init__(self, max_workers: int = MAX_CONCURRENT_CONVERSIONS,
+                 sample_rate: int = DEFAULT_SAMPLE_RATE, timeout: float = CONVERSION_TIMEOUT):
+        self.max_workers = max_workers
+        self.sample_rate = sample_rate
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_workers)
+
+        # 统计信息
+        self.waiting = 0
+        self.running = 0
+        self.conversions = 0
+        self.fast_path_conversions = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+
+    async def to_wav(self, data: bytes) -> bytes:
+        """
+        把任意格式的音频转换为目标格式的WAV
+
+        Args:
+            data (bytes): 原始音频数据
+
+        Returns:
+            bytes: 16bit单声道WAV数据
+        """
+        if is_target_wav(data, self.sample_rate):
+            return data
+
+        start = time.perf_counter()
+        loop = asyncio.get_event_loop()
+
+        if parse_wav(data) is not None and np is not None:
+            result = await loop.run_in_executor(None, resample_wav, data, self.sample_rate)
+            if result is not None:
+                self.fast_path_conversions += 1
+                self._record(start, 'numpy')
+                return result
+
+        result = await self._run_ffmpeg(data)
+        self._record(start, 'ffmpeg')
+        return result
+
+    async def _run_ffmpeg(self, data: bytes) -> bytes:
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "ffmpeg", "-v", "quiet", "-y", "-i", "pipe:0",
+                "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(self.sample_rate),
+                "-f", "wav", "pipe:1",
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(data), self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                process.kill()
+                await process.wait()
+                raise
+
+            if process.returncode != 0 or not stdout:
+                self.failures += 1
+                message = stderr.decode(errors='ignore')
+                logger.error(f"FFmpeg conversion failed: {message}")
+                raise RuntimeError(f"Audio conversion failed: {message}")
+
+            return stdout
+        except (asyncio.TimeoutError, OSError) as e:
+            self.failures += 1
+            logger.error(f"FFmpeg conversion failed: {e}")
+            raise RuntimeError(f"Audio conversion failed: {e}")
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+
+    def _record(self, start: float, method: str) -> None:
+        self.last_time = time.perf_counter() - start
+        self.total_time += self.last_time
+        self.conversions += 1
+        STAGE_SECONDS.labels('transcode').observe(self.last_time)
+        logger.info(f"音频转码完成({method}): {self.last_time * 1000:.1f}ms, 排队: {self.waiting}, 运行中: {self.running}")
+
+    def get_stats(self) -> dict:
+        """返回转码服务的统计信息"""
+        return {
+            'queue_depth': self.waiting,
+            'running': self.running,
+            'max_workers': self.max_workers,
+            'conversions': self.conversions,
+            'fast_path_conversions': self.fast_path_conversions,
+            'failures': self.failures,
+            'last_ms': round(self.last_time * 1000, 1),
+            'avg_ms': round(self.total_time * 1000 / self.conversions, 1) if self.conversions else 0.0
+        }
+
+
+# 每个事件循环一个转码服务（asyncio同步原语不能跨事件循环使用）
+_transcoders = weakref.WeakKeyDictionary()
+
+
+def get_transcoder() -> AudioTranscoder:
+    """获取当前事件循环的转码服务"""
+    loop = asyncio.get_event_loop()
+    transcoder = _transcoders.get(loop)
+    if transcoder is None:
+        transcoder = AudioTranscoder()
+        _transcoders[loop] = transcoder
+    return transcoder
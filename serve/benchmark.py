@@ -0,0 +1,438 @@
+"""
+离线压测
+启动本地模拟的ASR/TTS/LLM上游服务（fake_upstreams.py），在子进程中启动websocket_server.py并指向这些服务，
+然后用N个并发客户端发送文字和语音消息，统计每轮对话从发送到收到完整回复的时间。
+
+报告内容:
+- 回复时间的p50/p95/p99、吞吐量、失败数（其中因服务器满载被拒绝的busy数）
+- 服务器进程的CPU占用和内存（安装了psutil时使用psutil，否则读取/proc）
+- 服务器/metrics中各处理阶段的平均耗时，发往上游的payload压缩节省的字节数和耗费的CPU时间，
+  以及VAD丢弃的静音时长
+
+用法:
+    python benchmark.py --clients 20 --turns 10 --mode mixed --llm-latency 0.8 --tts-error-rate 0.02
+    python benchmark.py --mode audio --asr-compression none   # 对比不同压缩策略的CPU和流量
+    python benchmark.py --clients 50 --admission llm=4:8:2     # 观察过载时的拒绝和排队
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import sys
+import tempfile
+import time
+import uuid
+from typing import List, Optional
+
+import aiohttp
+import websockets
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from audio_transcoder import build_wav
+from fake_upstreams import start_fake_upstreams, upstream_env, add_profile_arguments, profiles_from_args
+from ws_protocol import build_frame, FrameKind, AudioCodec
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'websocket_server.py')
+SERVER_START_TIMEOUT = 30
+SAMPLE_INTERVAL = 0.5  # 服务器资源占用的采样间隔（秒）
+BENCHMARK_TEXTS = ['你好藿藿', '今天过得怎么样', '给我讲个笑话吧', '你喜欢什么', '晚安']
+
+STAGE_SUM_PATTERN = re.compile(r'^huohuo_stage_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+PAYLOAD_BYTES_PATTERN = re.compile(
+    r'^huohuo_upstream_payload_bytes_total\{upstream="([^"]+)",payload="([^"]+)",stage="([^"]+)"\} (\S+)$')
+VAD_SECONDS_PATTERN = re.compile(r'^huohuo_vad_audio_seconds_total\{stage="([^"]+)"\} (\S+)$')
+COMPRESSION_SECONDS_PATTERN = re.compile(
+    r'^huohuo_upstream_compression_seconds_total\{upstream="([^"]+)",payload="([^"]+)"\} (\S+)$')
+QUOTA_WAIT_PATTERN = re.compile(r'^huohuo_upstream_wait_seconds_(sum|count)\{upstream="([^"]+)"\} (\S+)$')
+QUOTA_EVENT_PATTERN = re.compile(r'^huohuo_upstream_(throttled|rate_limited)_total\{upstream="([^"]+)"\} (\S+)$')
+
+
+def percentile(values: List[float], p: float) -> float:
+    """最近秩法百分位数"""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def make_test_audio(seconds: float, silence: float = 0.0, sample_rate: int = 16000) -> bytes:
+    """生成一段16kHz 16bit单声道的正弦波WAV，不需要转码即可送入ASR；silence为前后各附加的静音秒数"""
+    samples = bytearray()
+    for i in range(int(seconds * sample_rate)):
+        value = int(8000 * math.sin(2 * math.pi * 220 * i / sample_rate))
+        samples += value.to_bytes(2, 'little', signed=True)
+    padding = bytes(int(silence * sample_rate) * 2)
+    return build_wav(padding + bytes(samples) + padding, sample_rate)
+
+
+class ProcessSampler:
+    """定期采样进程的CPU时间和常驻内存"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.clock_ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+        self.page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self.process = psutil.Process(pid) if psutil is not None else None
+        self.samples = []  # (时间, CPU秒数, 常驻内存字节数)
+
+    def read(self):
+        if self.process is not None:
+            cpu = self.process.cpu_times()
+            return cpu.user + cpu.system, self.process.memory_info().rss
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{self.pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        # utime、stime分别是第14、15个字段（去掉pid和进程名后的第12、13个）
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks, rss_pages * self.page_size
+
+    def sample(self) -> None:
+        try:
+            cpu, rss = self.read()
+        except (OSError, ValueError, IndexError):
+            return
+        self.samples.append((time.perf_counter(), cpu, rss))
+
+    async def run(self) -> None:
+        while True:
+            self.sample()
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+    def report(self) -> dict:
+        if len(self.samples) < 2:
+            return {}
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        peak_cpu = 0.0
+        for (ta, ca, _), (tb, cb, _) in zip(self.samples, self.samples[1:]):
+            if tb > ta:
+                peak_cpu = max(peak_cpu, (cb - ca) / (tb - ta))
+        rss = [sample[2] for sample in self.samples]
+        return {
+            'cpu_seconds': round(cpu1 - cpu0, 2),
+            'cpu_avg_percent': round((cpu1 - cpu0) / (t1 - t0) * 100, 1) if t1 > t0 else 0.0,
+            'cpu_peak_percent': round(peak_cpu * 100, 1),
+            'rss_start_mb': round(rss[0] / 1048576, 1),
+            'rss_peak_mb': round(max(rss) / 1048576, 1),
+            'rss_end_mb': round(rss[-1] / 1048576, 1),
+        }
+
+
+class TurnResult:
+    __slots__ = ('kind', 'ok', 'elapsed', 'first_reply', 'error', 'has_audio')
+
+    def __init__(self, kind: str, ok: bool, elapsed: float, first_reply: Optional[float], error: str = '',
+                 has_audio: bool = False):
+        self.kind = kind
+        self.ok = ok
+        self.elapsed = elapsed
+        self.first_reply = first_reply
+        self.error = error
+        self.has_audio = has_audio
+
+
+async def run_turn(websocket, kind: str, audio: bytes, timeout: float) -> TurnResult:
+    """发送一条消息并等待完整回复"""
+    request_id = uuid.uuid4().hex[:12]
+    start = time.perf_counter()
+    if kind == 'audio':
+        await websocket.send(build_frame(FrameKind.AUDIO, audio, request_id, AudioCodec.WAV))
+    else:
+        await websocket.send(json.dumps({
+            'type': 'text',
+            'message': BENCHMARK_TEXTS[hash(request_id) % len(BENCHMARK_TEXTS)],
+            'request_id': request_id
+        }))
+
+    first_reply = None
+    deadline = start + timeout
+    while True:
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            return TurnResult(kind, False, time.perf_counter() - start, first_reply, 'timeout')
+        try:
+            message = await asyncio.wait_for(websocket.recv(), remaining)
+        except asyncio.TimeoutError:
+            continue
+        if isinstance(message, bytes):
+            # 流式下发的回复语音
+            if first_reply is None:
+                first_reply = time.perf_counter() - start
+            continue
+        data = json.loads(message)
+        message_type = data.get('type')
+        if message_type == 'assistant_reply_chunk' and first_reply is None:
+            first_reply = time.perf_counter() - start
+        elif message_type in ('assistant_reply', 'error', 'busy') and data.get('request_id') == request_id:
+            elapsed = time.perf_counter() - start
+            if first_reply is None:
+                first_reply = elapsed
+            if message_type == 'error':
+                return TurnResult(kind, False, elapsed, first_reply, data.get('message', ''))
+            if message_type == 'busy':
+                return TurnResult(kind, False, elapsed, first_reply, f"busy: {data.get('stage')} {data.get('reason')}")
+            # 语音合成失败时回复仍然成功，只是没有语音
+            has_audio = bool(data.get('audio_url') or data.get('streamed'))
+            return TurnResult(kind, True, elapsed, first_reply, has_audio=has_audio)
+
+
+async def run_client(url: str, index: int, args: argparse.Namespace, audio: bytes, results: list) -> None:
+    """一个模拟客户端依次进行多轮对话"""
+    try:
+        async with websockets.connect(url, max_size=16 * 1024 * 1024) as websocket:
+            await websocket.recv()  # 欢迎消息
+            await websocket.send(json.dumps({
+                'type': 'config',
+                'stream_reply': args.stream_reply,
+                'stream_audio': args.stream_audio
+            }))
+            await websocket.recv()
+            for turn in range(args.turns):
+                if args.mode == 'mixed':
+                    kind = 'audio' if (index + turn) % 2 else 'text'
+                else:
+                    kind = args.mode
+                results.append(await run_turn(websocket, kind, audio, args.timeout))
+                if args.think_time:
+                    await asyncio.sleep(args.think_time)
+    except (OSError, websockets.exceptions.WebSocketException) as e:
+        results.append(TurnResult('connect', False, 0.0, None, str(e)))
+
+
+async def wait_for_server(url: str, process: asyncio.subprocess.Process) -> None:
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.returncode is not None:
+            raise RuntimeError(f"服务器进程已退出: {process.returncode}")
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("等待服务器启动超时")
+
+
+async def fetch_server_metrics(http_url: str) -> tuple:
+    """
+    从服务器的/metrics读取指标
+
+    Returns:
+        tuple: (各阶段的平均耗时（毫秒）, 各类上游payload的压缩统计, VAD处理和丢弃的录音秒数,
+                各上游的配额排队时间和限流次数)
+    """
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{http_url}/metrics") as response:
+                text = await response.text()
+    except aiohttp.ClientError:
+        return {}, {}, {}, {}
+    sums, counts = {}, {}
+    vad = {}
+    payload_bytes, cpu_seconds = {}, {}
+    quota_sums, quota_counts, quota_events = {}, {}, {}
+    for line in text.splitlines():
+        match = STAGE_SUM_PATTERN.match(line)
+        if match:
+            target = sums if match.group(1) == 'sum' else counts
+            target[match.group(2)] = float(match.group(3))
+            continue
+        match = PAYLOAD_BYTES_PATTERN.match(line)
+        if match:
+            payload_bytes.setdefault(f"{match.group(1)}_{match.group(2)}", {})[match.group(3)] = float(match.group(4))
+            continue
+        match = COMPRESSION_SECONDS_PATTERN.match(line)
+        if match:
+            cpu_seconds[f"{match.group(1)}_{match.group(2)}"] = float(match.group(3))
+            continue
+        match = VAD_SECONDS_PATTERN.match(line)
+        if match:
+            vad[f"{match.group(1)}_s"] = round(float(match.group(2)), 2)
+            continue
+        match = QUOTA_WAIT_PATTERN.match(line)
+        if match:
+            target = quota_sums if match.group(1) == 'sum' else quota_counts
+            target[match.group(2)] = float(match.group(3))
+            continue
+        match = QUOTA_EVENT_PATTERN.match(line)
+        if match:
+            quota_events.setdefault(match.group(2), {})[match.group(1)] = int(float(match.group(3)))
+    stages = {stage: {'count': int(counts[stage]), 'avg_ms': round(sums[stage] * 1000 / counts[stage], 1)}
+              for stage in sums if counts.get(stage)}
+    compression = {}
+    for name, sizes in payload_bytes.items():
+        raw, sent = sizes.get('raw', 0), sizes.get('sent', 0)
+        compression[name] = {
+            'raw_kb': round(raw / 1024, 1),
+            'saved_kb': round((raw - sent) / 1024, 1),
+            'cpu_ms': round(cpu_seconds.get(name, 0) * 1000, 1),
+        }
+    quota = {upstream: {'count': int(quota_counts[upstream]),
+                        'avg_wait_ms': round(quota_sums[upstream] * 1000 / quota_counts[upstream], 1),
+                        'throttled': quota_events.get(upstream, {}).get('throttled', 0),
+                        'rate_limited': quota_events.get(upstream, {}).get('rate_limited', 0)}
+             for upstream in quota_sums if quota_counts.get(upstream)}
+    return stages, compression, vad, quota
+
+
+def summarize(results: List[TurnResult], duration: float) -> dict:
+    ok = [r for r in results if r.ok]
+    report = {
+        'turns': len(results),
+        'ok': len(ok),
+        'failed': len(results) - len(ok),
+        'busy': sum(1 for r in results if r.error.startswith('busy')),
+        'without_audio': sum(1 for r in ok if not r.has_audio),
+        'duration_s': round(duration, 2),
+        'throughput_per_s': round(len(ok) / duration, 2) if duration > 0 else 0.0,
+    }
+    for kind in sorted({r.kind for r in ok}):
+        elapsed = [r.elapsed for r in ok if r.kind == kind]
+        first = [r.first_reply for r in ok if r.kind == kind and r.first_reply is not None]
+        report[f'{kind}_reply_ms'] = {
+            'p50': round(percentile(elapsed, 50) * 1000, 1),
+            'p95': round(percentile(elapsed, 95) * 1000, 1),
+            'p99': round(percentile(elapsed, 99) * 1000, 1),
+            'max': round(max(elapsed) * 1000, 1),
+        }
+        report[f'{kind}_first_reply_ms'] = {
+            'p50': round(percentile(first, 50) * 1000, 1),
+            'p95': round(percentile(first, 95) * 1000, 1),
+            'p99': round(percentile(first, 99) * 1000, 1),
+        }
+    errors = {}
+    for r in results:
+        if not r.ok:
+            errors[r.error[:80]] = errors.get(r.error[:80], 0) + 1
+    if errors:
+        report['errors'] = errors
+    return report
+
+
+def print_report(report: dict) -> None:
+    print("\n===== 压测结果 =====")
+    print(f"对话轮数: {report['turns']}  成功: {report['ok']}  失败: {report['failed']}"
+          f"（busy: {report['busy']}）  没有语音: {report['without_audio']}")
+    print(f"耗时: {report['duration_s']}s  吞吐量: {report['throughput_per_s']} 轮/秒")
+    for key, value in report.items():
+        if key.endswith('_ms') and isinstance(value, dict):
+            print(f"{key:>24}: " + '  '.join(f"{name}={ms}" for name, ms in value.items()))
+    if report.get('server'):
+        server = report['server']
+        print(f"服务器CPU: 平均 {server['cpu_avg_percent']}%  峰值 {server['cpu_peak_percent']}%  "
+              f"共 {server['cpu_seconds']}s")
+        print(f"服务器内存: 开始 {server['rss_start_mb']}MB  峰值 {server['rss_peak_mb']}MB  "
+              f"结束 {server['rss_end_mb']}MB")
+    if report.get('stages'):
+        print("各阶段平均耗时: " + '  '.join(f"{stage}={info['avg_ms']}ms(x{info['count']})"
+                                       for stage, info in report['stages'].items()))
+    if report.get('compression'):
+        print("上游payload压缩: " + '  '.join(
+            f"{name}: 原始{info['raw_kb']}KB 节省{info['saved_kb']}KB CPU{info['cpu_ms']}ms"
+            for name, info in report['compression'].items()))
+    if report.get('quota'):
+        print("上游配额: " + '  '.join(
+            f"{name}: 平均排队{info['avg_wait_ms']}ms(x{info['count']}) 限流{info['throttled']} 拒绝{info['rate_limited']}"
+            for name, info in report['quota'].items()))
+    if report.get('vad'):
+        print(f"VAD: 录音 {report['vad'].get('input_s', 0)}s  丢弃静音 {report['vad'].get('dropped_s', 0)}s")
+    if report.get('errors'):
+        print("失败原因:")
+        for error, count in report['errors'].items():
+            print(f"  {count:>5}  {error}")
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    fake_runner = await start_fake_upstreams(args.fake_host, args.fake_port, **profiles_from_args(args))
+    workdir = tempfile.mkdtemp(prefix='huohuo_bench_')
+    env = dict(os.environ)
+    env.update(upstream_env(args.fake_host, args.fake_port))
+    env.update({'HUOHUO_WS_PORT': str(args.ws_port), 'HUOHUO_HTTP_PORT': str(args.http_port)})
+    # 上传录音和TTS缓存默认放在项目目录下，压测时改到临时目录
+    env.update({'HUOHUO_UPLOAD_DIR': os.path.join(workdir, 'uploads', 'audio'),
+                'HUOHUO_REPLY_AUDIO_DIR': os.path.join(workdir, 'reply_video')})
+    if args.asr_compression:
+        env['HUOHUO_ASR_AUDIO_COMPRESSION'] = args.asr_compression
+    if args.tts_compression:
+        env['HUOHUO_TTS_COMPRESSION'] = args.tts_compression
+    for admission in args.admission:
+        stage, _, spec = admission.partition('=')
+        env[f'HUOHUO_ADMISSION_{stage.upper()}'] = spec
+    for quota in args.quota:
+        upstream, _, spec = quota.partition('=')
+        env[f'HUOHUO_{upstream.upper()}_QUOTA'] = spec
+    url = f"ws://localhost:{args.ws_port}"
+
+    # 服务器在临时目录中运行，上传录音、TTS缓存和日志都不会写入项目目录
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, SERVER_SCRIPT, cwd=workdir, env=env,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    sampler_task = None
+    try:
+        await wait_for_server(url, process)
+        sampler = ProcessSampler(process.pid)
+        sampler_task = asyncio.ensure_future(sampler.run())
+
+        audio = make_test_audio(args.audio_seconds, args.silence)
+        results = []
+        start = time.perf_counter()
+        await asyncio.gather(*(run_client(url, i, args, audio, results) for i in range(args.clients)))
+        duration = time.perf_counter() - start
+        sampler.sample()
+
+        report = summarize(results, duration)
+        report['server'] = sampler.report()
+        report['stages'], report['compression'], report['vad'], report['quota'] = await fetch_server_metrics(
+            f"http://localhost:{args.http_port}")
+        report['workdir'] = workdir
+        return report
+    finally:
+        if sampler_task is not None:
+            sampler_task.cancel()
+        if process.returncode is None:
+            process.terminate()
+            await process.wait()
+        await fake_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线压测websocket_server.py')
+    parser.add_argument('--clients', type=int, default=10, help='并发客户端数')
+    parser.add_argument('--turns', type=int, default=5, help='每个客户端的对话轮数')
+    parser.add_argument('--mode', choices=['text', 'audio', 'mixed'], default='mixed')
+    parser.add_argument('--stream-reply', action='store_true', help='逐句生成并合成回复')
+    parser.add_argument('--stream-audio', action='store_true', help='回复语音以二进制帧下发')
+    parser.add_argument('--audio-seconds', type=float, default=2.0, help='每条语音消息的时长')
+    parser.add_argument('--silence', type=float, default=0.0, help='每条语音消息前后各附加的静音秒数')
+    parser.add_argument('--think-time', type=float, default=0.0, help='每轮对话之间的间隔（秒）')
+    parser.add_argument('--timeout', type=float, default=60.0, help='单轮对话超时（秒）')
+    parser.add_argument('--ws-port', type=int, default=18765)
+    parser.add_argument('--http-port', type=int, default=15000)
+    parser.add_argument('--fake-host', default='127.0.0.1')
+    parser.add_argument('--fake-port', type=int, default=19100)
+    parser.add_argument('--asr-compression', help='ASR音频包的压缩策略: none, gzip[:级别], adaptive[:节省比例]')
+    parser.add_argument('--tts-compression', help='TTS请求的压缩策略')
+    parser.add_argument('--admission', action='append', default=[], metavar='STAGE=SPEC',
+                        help='服务器各阶段的准入限额，例如 llm=4:8:2（阶段: turn/asr/llm/tts），可重复')
+    parser.add_argument('--quota', action='append', default=[], metavar='UPSTREAM=SPEC',
+                        help='上游凭证的出站配额，例如 tts=5:5:4（上游: asr/tts/llm），可重复')
+    parser.add_argument('--json', action='store_true', help='以JSON输出报告')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,116 @@
 import os
+import re
+import time
+import asyncio
 import logging
-from volcenginesdkarkruntime import Ark
+import weakref
+from typing import AsyncIterator, List, Optional, Tuple
+from volcenginesdkarkruntime import Ark, AsyncArk
+from metrics import record_upstream_error
+from admission import BusyError
+from rate_limit import get_outbound_limiter
 from character_config import get_system_prompt, CHARACTER_INFO, SCENARIO_RESPONSES, parse_emotion_from_reply
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 可通过环境变量指向其他兼容的服务（例如压测用的本地模拟服务）
+ARK_BASE_URL = os.environ.get("HUOHUO_ARK_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
+ARK_API_KEY = os.environ.get("HUOHUO_ARK_API_KEY", "your_api")
+
 # 初始化Ark客户端
 client = Ark(
-    base_url="https://ark.cn-beijing.volces.com/api/v3",
-    api_key="your_api",
+    base_url=ARK_BASE_URL,
+    api_key=ARK_API_KEY,
+)
+
+MODEL_NAME = "doubao-1-5-pro-32k-250115"
+LLM_MAX_CONCURRENCY = 16  # 同时进行的异步AI请求数上限，超出的请求排队等待
+LLM_TIMEOUT = 60  # 单次请求超时（秒）
+# 该API Key的配额：每秒请求数:突发数:并发数[:最长排队秒数]，见rate_limit.py
+LLM_QUOTA = os.environ.get("HUOHUO_LLM_QUOTA", "20:20:32")
+
+# 流式回复切句配置
+SENTENCE_ENDINGS = '。！？!?；;～~…\n'
+MIN_SENTENCE_LENGTH = 6  # 过短的句子与下一句合并，减少TTS请求次数
+EMOTION_TAG_PATTERN = re.compile(r'\[情绪:\d\]')
+EMOTION_TAG_PREFIX_PATTERN = re.compile(r'\[(情(绪(:\d?)?)?)?$')  # 尚未输出完整的情绪标记
+
+# 多轮对话摘要
+SUMMARY_PROMPT = (
+    "请把下面的对话压缩成一段简短的摘要，保留用户提到的重要信息、偏好和尚未结束的话题，"
+    "不超过200字，只输出摘要内容。"
 )
 
+def build_messages(user_message: str, system_prompt: str = None, history: list = None) -> list:
+    """构建发送给模型的消息列表：系统提示词、历史消息、本轮用户消息"""
+    # 使用角色配置文件中的系统提示词
+    if system_prompt is None:
+        system_prompt = get_system_prompt()
+    return [
+        {"role": "system", "content": system_prompt},
+        *(history or []),
+        {"role": "user", "content": user_message}
+    ]
+
+def usage_to_dict(usage) -> dict:
+    """把上游返回的token用量转换为字典"""
+    if usage is None:
+        return {}
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'total_tokens': usage.total_tokens,
+        'cached_tokens': getattr(details, 'cached_tokens', 0) or 0
+    }
+
+def build_reply_result(ai_reply: str) -> dict:
+    """解析模型的原始回复，返回get_ai_response格式的结果"""
+    logger.info(f"AI原始回复: {ai_reply}")
+    
+    # 解析情绪值
+    clean_reply, emotion_value = parse_emotion_from_reply(ai_reply)
+    logger.info(f"AI清理后回复: {clean_reply}")
+    logger.info(f"情绪值: {emotion_value}")
+    
+    return {
+        'success': True,
+        'ai_reply': clean_reply,
+        'raw_reply': ai_reply,
+        'emotion_value': emotion_value,
+        'model': MODEL_NAME,
+        'character': CHARACTER_INFO['name']
+    }
+
+def throttle_retry_after(error: Exception) -> Optional[float]:
+    """
+    判断是否为上游限流错误（HTTP 429）
+    
+    Returns:
+        上游建议的等待秒数；限流但没有Retry-After时为0，不是限流错误时为None
+    """
+    if getattr(error, 'status_code', None) != 429:
+        return None
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after', 0)) if response is not None else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+def build_error_result(error: Exception) -> dict:
+    """调用失败时返回的结果"""
+    logger.error(f"调用AI模型失败: {str(error)}")
+    # 使用角色配置中的默认错误回复
+    default_error_reply = SCENARIO_RESPONSES.get('apology', ['抱歉，我现在有点忙，请稍后再试~'])[0]
+    return {
+        'success': False,
+        'error': str(error),
+        'ai_reply': default_error_reply,
+        'emotion_value': 2,  # 错误时设置为消极/担心情绪
+        'character': CHARACTER_INFO['name']
+    }
+
 def get_ai_response(user_message: str, system_prompt: str = None) -> dict:
     """
     调用豆包AI模型获取回复
@@ -24,50 +123,279 @@ def get_ai_response(user_message: str, system_prompt: str = None) -> dict:
         dict: 包含成功状态和AI回复的字典
     """
     try:
-        # 使用角色配置文件中的系统提示词
-        if system_prompt is None:
-            system_prompt = get_system_prompt()
-        
         logger.info(f"调用AI模型，用户消息: {user_message}")
         logger.info(f"使用角色: {CHARACTER_INFO['name']} ({CHARACTER_INFO['identity']})")
         
         # 调用豆包AI模型
         completion = client.chat.completions.create(
-            model="doubao-1-5-pro-32k-250115",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
+            model=MODEL_NAME,
+            messages=build_messages(user_message, system_prompt),
         )
         
-        ai_reply = completion.choices[0].message.content
-        logger.info(f"AI原始回复: {ai_reply}")
+        result = build_reply_result(completion.choices[0].message.content)
+        result['usage'] = usage_to_dict(completion.usage)
+        return result
         
-        # 解析情绪值
-        clean_reply, emotion_value = parse_emotion_from_reply(ai_reply)
-        logger.info(f"AI清理后回复: {clean_reply}")
-        logger.info(f"情绪值: {emotion_value}")
+    except Exception as e:
+        return build_error_result(e)
+
+class AsyncLlmClient:
+    """
+    异步AI对话客户端
+    
+    请求直接在事件循环中发出，复用AsyncArk内部的HTTP连接池，不占用线程。
+    同时进行的请求数由信号量限制，超出上限的请求排队等待；
+    同一API Key的请求还要经过进程内共享的出站限流器（rate_limit.py），按配额平滑发出。
+    
+    Args:
+        max_concurrency (int): 同时进行的请求数上限
+    """
+    
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.client = AsyncArk(base_url=ARK_BASE_URL, api_key=ARK_API_KEY, timeout=LLM_TIMEOUT)
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.limiter = get_outbound_limiter('llm', ARK_API_KEY, LLM_QUOTA)
         
-        return {
-            'success': True,
-            'ai_reply': clean_reply,
-            'emotion_value': emotion_value,
-            'model': 'doubao-1-5-pro-32k-250115',
-            'character': CHARACTER_INFO['name']
-        }
+        # 统计信息
+        self.in_flight = 0
+        self.queued = 0
+        self.requests = 0
+        self.failures = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+    
+    async def acquire(self) -> float:
+        """等待空闲的并发名额，返回开始时间"""
+        self.queued += 1
+        try:
+            await self.semaphore.acquire()
+            try:
+                await self.limiter.acquire()
+            except BaseException:
+                self.semaphore.release()
+                raise
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        return time.perf_counter()
+    
+    def release(self, start: float, failed: bool) -> None:
+        self.in_flight -= 1
+        self.limiter.release()
+        self.semaphore.release()
+        if not failed:
+            self.limiter.succeeded()
+        self.requests += 1
+        if failed:
+            self.failures += 1
+        self.last_time = time.perf_counter() - start
+        self.total_time += self.last_time
+    
+    async def complete(self, messages: list) -> Tuple[str, dict]:
+        """发送消息列表，返回(模型回复, token用量)"""
+        start = await self.acquire()
+        failed = False
+        try:
+            completion = await self.client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+            )
+            return completion.choices[0].message.content, usage_to_dict(completion.usage)
+        except Exception as e:
+            failed = True
+            record_upstream_error('llm', e)
+            self.note_throttle(e)
+            raise
+        finally:
+            self.release(start, failed)
+    
+    async def chat(self, user_message: str, system_prompt: str = None, history: list = None) -> dict:
+        """获取完整回复，返回值与get_ai_response相同"""
+        logger.info(f"调用AI模型，用户消息: {user_message}")
+        try:
+            ai_reply, usage = await self.complete(build_messages(user_message, system_prompt, history))
+        except BusyError:
+            raise
+        except Exception as e:
+            return build_error_result(e)
+        result = build_reply_result(ai_reply)
+        result['usage'] = usage
+        return result
+    
+    async def stream(self, user_message: str, system_prompt: str = None, history: list = None,
+                     usage: dict = None) -> AsyncIterator[str]:
+        """
+        流式获取回复，逐段产出回复文字（包含末尾的情绪标记）
         
-    except Exception as e:
-        logger.error(f"调用AI模型失败: {str(e)}")
-        # 使用角色配置中的默认错误回复
-        default_error_reply = SCENARIO_RESPONSES.get('apology', ['抱歉，我现在有点忙，请稍后再试~'])[0]
+        Args:
+            usage (dict): 传入时在输出结束后填入本次请求的token用量
+        
+        Yields:
+            str: 模型新生成的文字
+        """
+        logger.info(f"流式调用AI模型，用户消息: {user_message}")
+        start = await self.acquire()
+        failed = False
+        try:
+            stream = await self.client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=build_messages(user_message, system_prompt, history),
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.usage is not None and usage is not None:
+                        usage.update(usage_to_dict(chunk.usage))
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        yield delta
+            finally:
+                # 提前结束时关闭上游连接
+                await stream.close()
+        except Exception as e:
+            failed = True
+            record_upstream_error('llm', e)
+            self.note_throttle(e)
+            raise
+        finally:
+            self.release(start, failed)
+    
+    def note_throttle(self, error: Exception) -> None:
+        """上游返回限流错误时让限流器退避"""
+        retry_after = throttle_retry_after(error)
+        if retry_after is not None:
+            self.limiter.throttled(retry_after)
+    
+    async def close(self) -> None:
+        await self.client.close()
+    
+    def get_stats(self) -> dict:
+        """返回客户端的统计信息"""
         return {
-            'success': False,
-            'error': str(e),
-            'ai_reply': default_error_reply,
-            'emotion_value': 2,  # 错误时设置为消极/担心情绪
-            'character': CHARACTER_INFO['name']
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_concurrency': self.max_concurrency,
+            'requests': self.requests,
+            'failures': self.failures,
+            'last_ms': round(self.last_time * 1000, 1),
+            'avg_ms': round(self.total_time * 1000 / self.requests, 1) if self.requests else 0.0,
+            'quota': self.limiter.get_stats()
         }
 
+# 每个事件循环一个异步客户端（HTTP连接池和信号量不能跨事件循环使用）
+_llm_clients = weakref.WeakKeyDictionary()
+
+def get_llm_client(max_concurrency: int = None) -> AsyncLlmClient:
+    """获取当前事件循环的异步AI客户端，max_concurrency只在第一次创建时生效"""
+    loop = asyncio.get_event_loop()
+    llm_client = _llm_clients.get(loop)
+    if llm_client is None:
+        llm_client = AsyncLlmClient(max_concurrency or LLM_MAX_CONCURRENCY)
+        _llm_clients[loop] = llm_client
+    return llm_client
+
+async def close_llm_client() -> None:
+    """关闭当前事件循环的异步AI客户端"""
+    llm_client = _llm_clients.pop(asyncio.get_event_loop(), None)
+    if llm_client is not None:
+        await llm_client.close()
+
+async def get_ai_response_async(user_message: str, system_prompt: str = None, history: list = None) -> dict:
+    """get_ai_response的异步版本，history为之前的对话消息"""
+    return await get_llm_client().chat(user_message, system_prompt, history)
+
+async def summarize_conversation(summary: str, messages: list) -> str:
+    """
+    把之前的摘要和要移出上下文的对话压缩为新的摘要
+    
+    Args:
+        summary (str): 之前的摘要
+        messages (list): 要压缩的user/assistant消息
+    
+    Returns:
+        str: 新的摘要
+    """
+    lines = [f"之前的摘要：{summary}"] if summary else []
+    for message in messages:
+        speaker = '用户' if message['role'] == 'user' else CHARACTER_INFO['name']
+        lines.append(f"{speaker}：{EMOTION_TAG_PATTERN.sub('', message['content']).strip()}")
+    
+    new_summary, _ = await get_llm_client().complete([
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": '\n'.join(lines)}
+    ])
+    return new_summary.strip()
+
+def stream_ai_response(user_message: str, system_prompt: str = None, history: list = None,
+                       usage: dict = None) -> AsyncIterator[str]:
+    """
+    流式调用豆包AI模型，逐段产出回复文字（包含末尾的情绪标记）
+    
+    Args:
+        user_message (str): 用户消息内容
+        system_prompt (str): 系统提示词，如果不提供则使用藿藿的默认角色设定
+        history (list): 之前的对话消息
+        usage (dict): 传入时在输出结束后填入本次请求的token用量
+    
+    Returns:
+        异步迭代器，产出模型新生成的文字
+    """
+    return get_llm_client().stream(user_message, system_prompt, history, usage)
+
+class SentenceSplitter:
+    """
+    把流式输出的文字按中文标点切分为完整的句子，用于逐句合成语音
+    
+    情绪标记[情绪:N]不会出现在切出的句子中：完整的标记直接去掉，
+    尚未输出完整的标记前缀会暂时保留在缓冲区中。
+    """
+    
+    def __init__(self, min_length: int = MIN_SENTENCE_LENGTH):
+        self.min_length = min_length
+        self.buffer = ''
+    
+    def feed(self, delta: str) -> List[str]:
+        """加入新生成的文字，返回已经完整的句子"""
+        text = EMOTION_TAG_PATTERN.sub('', self.buffer + delta)
+        
+        held = ''
+        match = EMOTION_TAG_PREFIX_PATTERN.search(text)
+        if match:
+            held = text[match.start():]
+            text = text[:match.start()]
+        
+        sentences = []
+        start = 0
+        for i, char in enumerate(text):
+            if char not in SENTENCE_ENDINGS:
+                continue
+            # 连续的标点归入同一句
+            if i + 1 < len(text) and text[i + 1] in SENTENCE_ENDINGS:
+                continue
+            if len(text[start:i + 1].strip()) < self.min_length:
+                continue
+            sentences.append(text[start:i + 1].strip())
+            start = i + 1
+        
+        self.buffer = text[start:] + held
+        return [sentence for sentence in sentences if self.is_speakable(sentence)]
+    
+    def flush(self) -> List[str]:
+        """输出结束，返回缓冲区中剩余的文字"""
+        rest, _ = parse_emotion_from_reply(EMOTION_TAG_PATTERN.sub('', self.buffer))
+        rest = EMOTION_TAG_PREFIX_PATTERN.sub('', rest).strip()
+        self.buffer = ''
+        return [rest] if self.is_speakable(rest) else []
+    
+    @staticmethod
+    def is_speakable(text: str) -> bool:
+        """只有标点或空白的片段不需要合成语音"""
+        return any(char.isalnum() for char in text)
+
 def test_ai_chat():
     """测试AI对话功能"""
     print(f"----- {CHARACTER_INFO['name']}AI对话测试 -----")
@@ -0,0 +1,226 @@
+"""
+上游二进制协议编解码的微基准
+在同一进程内对比改造前的逐字节拼接实现（legacy_*）与upstream_protocol的每帧耗时：
+ASR音频包、ASR识别结果、TTS音频包、TTS请求、录音分段
+
+gzip和JSON的耗时远大于帧处理本身，带(raw)的项使用不压缩、不序列化的帧，只测帧的构建和解析。
+改造前后的gzip都是同一个级别9的deflate，压缩项的差异主要是测量噪声；
+为避免CPU频率漂移偏向某一方，改造前后交替测量，各取最快的一轮
+
+用法:
+    python codec_benchmark.py [--number 20000]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import struct
+import timeit
+
+from upstream_protocol import (
+    build_audio_request, build_full_request, parse_frame, split_segments, MessageType, SerializationType,
+    CompressionType
+)
+
+SEGMENT_BYTES = 6400  # 200ms的16kHz 16bit单声道PCM
+TTS_CHUNK_BYTES = 4800
+TTS_LARGE_CHUNK_BYTES = 64 * 1024
+AUDIO_SECONDS = 10
+TTS_REQUEST = {'app': {'appid': '0000000000', 'token': 'access_token', 'cluster': 'volcano_tts'},
+               'user': {'uid': 'huohuo_tts_user'},
+               'audio': {'voice_type': 'zh_female_wanwanxiaohe_moon_bigtts', 'encoding': 'mp3', 'speed_ratio': 1.0},
+               'request': {'reqid': '00000000-0000-0000-0000-000000000000', 'text': '你好呀，我是藿藿。',
+                           'text_type': 'plain', 'operation': 'submit'}}
+
+
+# ---------------------------------------------------------------------------
+# 改造前的实现，仅作对照
+
+def legacy_audio_request(seq: int, segment: bytes, is_last: bool = False, compress=gzip.compress) -> bytes:
+    flags = 0b0011 if is_last else 0b0001
+    if is_last:
+        seq = -seq
+    request = bytearray()
+    request.extend(bytes([0x11, (0b0010 << 4) | flags, 0x11]))
+    request.extend(bytes([0x00]))
+    request.extend(struct.pack('>i', seq))
+    compressed_segment = compress(segment)
+    request.extend(struct.pack('>I', len(compressed_segment)))
+    request.extend(compressed_segment)
+    return bytes(request)
+
+
+def legacy_parse_response(msg: bytes) -> dict:
+    response = {'code': 0, 'event': 0, 'is_last_package': False, 'payload_sequence': 0,
+                'payload_size': 0, 'payload_msg': None}
+    header_size = msg[0] & 0x0f
+    message_type = msg[1] >> 4
+    flags = msg[1] & 0x0f
+    serialization_method = msg[2] >> 4
+    message_compression = msg[2] & 0x0f
+    payload = msg[header_size * 4:]
+    if flags & 0x01:
+        response['payload_sequence'] = struct.unpack('>i', payload[:4])[0]
+        payload = payload[4:]
+    if flags & 0x02:
+        response['is_last_package'] = True
+    if flags & 0x04:
+        response['event'] = struct.unpack('>i', payload[:4])[0]
+        payload = payload[4:]
+    if message_type == 0b1001:
+        response['payload_size'] = struct.unpack('>I', payload[:4])[0]
+        payload = payload[4:]
+    elif message_type == 0b1111:
+        response['code'] = struct.unpack('>i', payload[:4])[0]
+        response['payload_size'] = struct.unpack('>I', payload[4:8])[0]
+        payload = payload[8:]
+    if message_compression == 1:
+        payload = gzip.decompress(payload)
+    if serialization_method == 1:
+        response['payload_msg'] = json.loads(payload.decode('utf-8'))
+    return response
+
+
+def legacy_tts_audio(res: bytes, file) -> bool:
+    header_size = res[0] & 0x0f
+    message_type = res[1] >> 4
+    flags = res[1] & 0x0f
+    payload = res[header_size * 4:]
+    if message_type == 0xb:
+        if flags == 0:
+            return False
+        sequence_number = int.from_bytes(payload[:4], "big", signed=True)
+        payload = payload[8:]
+        file.write(payload)
+        return sequence_number < 0
+    return True
+
+
+def legacy_full_request(request: dict) -> bytearray:
+    payload_bytes = gzip.compress(str.encode(json.dumps(request)))
+    full_client_request = bytearray(b'\x11\x10\x11\x00')
+    full_client_request.extend((len(payload_bytes)).to_bytes(4, 'big'))
+    full_client_request.extend(payload_bytes)
+    return full_client_request
+
+
+def legacy_split_audio(data: bytes, segment_size: int) -> list:
+    segments = []
+    for i in range(0, len(data), segment_size):
+        end = min(i + segment_size, len(data))
+        segments.append(data[i:end])
+    return segments
+
+
+# ---------------------------------------------------------------------------
+
+class NullSink:
+    def write(self, data) -> None:
+        pass
+
+
+def current_tts_audio(res: bytes, file) -> bool:
+    """与tts_service.parse_tts_response的音频分支相同"""
+    frame = parse_frame(res)
+    if frame.message_type == MessageType.SERVER_AUDIO_ONLY_RESPONSE:
+        if frame.flags == 0:
+            return False
+        file.write(frame.payload)
+        return frame.is_last
+    return True
+
+
+def current_parse_response(msg: bytes):
+    """与sauc_websocket_demo.ResponseParser相同的解析步骤"""
+    frame = parse_frame(msg)
+    payload = frame.decompressed()
+    if frame.serialization == SerializationType.JSON:
+        return frame, json.loads(str(payload, 'utf-8'))
+    return frame, None
+
+
+def identity(data):
+    return data
+
+
+def raw_encode(data):
+    return data, CompressionType.NO_COMPRESSION
+
+
+def asr_result_frame(raw: bool = False) -> bytes:
+    payload = json.dumps({
+        'audio_info': {'duration': 3200},
+        'result': {'text': '今天天气怎么样', 'utterances': [{'text': '今天天气怎么样', 'start_time': 0,
+                                                         'end_time': 3200, 'definite': True}]}
+    }).encode('utf-8')
+    if raw:
+        return bytes([0x11, 0x93, 0x00, 0x00]) + struct.pack('>iI', -5, len(payload)) + payload
+    payload = gzip.compress(payload)
+    return bytes([0x11, 0x93, 0x11, 0x00]) + struct.pack('>iI', -5, len(payload)) + payload
+
+
+def tts_audio_frame(size: int) -> bytes:
+    chunk = os.urandom(size)
+    return bytes([0x11, 0xb1, 0x00, 0x00]) + struct.pack('>iI', 3, len(chunk)) + chunk
+
+
+def measure(before, after, number: int, repeat: int = 7) -> tuple:
+    """改造前后交替测量repeat轮，各取最快的一轮，返回每次调用的微秒数"""
+    before_times, after_times = [], []
+    for _ in range(repeat):
+        before_times.append(timeit.timeit(before, number=number))
+        after_times.append(timeit.timeit(after, number=number))
+    return min(before_times) / number * 1e6, min(after_times) / number * 1e6
+
+
+def run(number: int) -> list:
+    """返回[(名称, 改造前us, 改造后us)]"""
+    segment = os.urandom(SEGMENT_BYTES)
+    asr_raw = asr_result_frame(raw=True)
+    asr_frame = asr_result_frame()
+    tts_small = tts_audio_frame(TTS_CHUNK_BYTES)
+    tts_large = tts_audio_frame(TTS_LARGE_CHUNK_BYTES)
+    audio = os.urandom(32000 * AUDIO_SECONDS)
+    segments = len(audio) // SEGMENT_BYTES
+    sink = NullSink()
+
+    rows = [
+        ('asr_audio_request(raw)',
+         lambda: legacy_audio_request(7, segment, compress=identity),
+         lambda: build_audio_request(7, segment, encode=raw_encode)),
+        ('asr_audio_request',
+         lambda: legacy_audio_request(7, segment), lambda: build_audio_request(7, segment)),
+        ('asr_response_parse(raw)',
+         lambda: legacy_parse_response(asr_raw), lambda: current_parse_response(asr_raw)),
+        ('asr_response_parse',
+         lambda: legacy_parse_response(asr_frame), lambda: current_parse_response(asr_frame)),
+        ('tts_audio_parse(4.8KB)',
+         lambda: legacy_tts_audio(tts_small, sink), lambda: current_tts_audio(tts_small, sink)),
+        ('tts_audio_parse(64KB)',
+         lambda: legacy_tts_audio(tts_large, sink), lambda: current_tts_audio(tts_large, sink)),
+        ('tts_full_request',
+         lambda: legacy_full_request(TTS_REQUEST), lambda: build_full_request(TTS_REQUEST)),
+    ]
+    results = []
+    for name, before, after in rows:
+        results.append((name, *measure(before, after, number)))
+
+    split_number = max(1, number // 50)
+    before, after = measure(lambda: legacy_split_audio(audio, SEGMENT_BYTES),
+                            lambda: split_segments(audio, SEGMENT_BYTES), split_number)
+    results.append(('split_audio_per_segment', before / segments, after / segments))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='上游二进制协议编解码微基准')
+    parser.add_argument('--number', type=int, default=20000, help='每项重复次数')
+    args = parser.parse_args()
+    print(f"{'us/frame':>26} {'before':>9} {'after':>9}")
+    for name, before, after in run(args.number):
+        print(f"{name:>26} {before:9.2f} {after:9.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+上游payload的压缩策略
+ASR的音频包、控制请求和TTS的控制请求各自使用一个策略，可以按客户端单独指定
+
+- none:              不压缩
+- gzip[:级别]        始终gzip压缩，级别0~9，默认9
+- adaptive[:节省比例] 以最快的级别1压缩并测量压缩率，近期平均节省的字节比例低于阈值（默认0.1）时停止压缩，
+                     之后每隔一定帧数再试压一帧，音频内容变化（如大段静音）时可以恢复压缩
+
+每个策略统计原始字节数、实际发送的字节数和压缩耗费的CPU时间，
+用于在负载高时权衡上游带宽和服务器CPU，见get_stats和 /metrics
+"""
+
+import threading
+import time
+import zlib
+from typing import Tuple
+
+from metrics import UPSTREAM_PAYLOAD_BYTES, COMPRESSION_SECONDS
+from upstream_protocol import BytesLike, CompressionType, GZIP_LEVEL, GZIP_WBITS
+
+
+class CompressionMode:
+    NONE = "none"
+    GZIP = "gzip"
+    ADAPTIVE = "adaptive"
+
+
+ADAPTIVE_MIN_SAVING = 0.1  # 平均节省比例低于该值时停止压缩
+ADAPTIVE_PROBE_INTERVAL = 50  # 停止压缩后每隔多少帧试压一次
+ADAPTIVE_LEVEL = 1  # 自适应模式追求低CPU，默认使用最快的压缩级别
+SAVING_SMOOTHING = 0.2  # 节省比例的指数平滑系数
+
+
+class CompressionPolicy:
+    """
+    payload压缩策略，encode可以直接作为upstream_protocol的编码函数
+
+    Args:
+        upstream (str): 上游名称，用于统计 (asr/tts)
+        payload (str): payload种类，用于统计 (audio/control)
+        mode (str): none / gzip / adaptive
+        level (int): gzip压缩级别
+        min_saving (float): 自适应模式下继续压缩所需的最低平均节省比例
+        probe_interval (int): 自适应模式下停止压缩后每隔多少帧试压一次
+    """
+
+    def __init__(self, upstream: str, payload: str, mode: str = CompressionMode.GZIP, level: int = GZIP_LEVEL,
+                 min_saving: float = ADAPTIVE_MIN_SAVING, probe_interval: int = ADAPTIVE_PROBE_INTERVAL):
+        if mode not in (CompressionMode.NONE, CompressionMode.GZIP, CompressionMode.ADAPTIVE):
+            raise ValueError(f"未知的压缩模式: {mode}")
+        if not 0 <= level <= 9:
+            raise ValueError(f"gzip压缩级别应为0~9: {level}")
+        self.upstream = upstream
+        self.payload = payload
+        self.mode = mode
+        self.level = level
+        self.min_saving = min_saving
+        self.probe_interval = probe_interval
+        self.lock = threading.Lock()
+
+        # 自适应状态
+        self.saving = None  # 近期平均节省比例
+        self.skip = 0  # 还要跳过压缩的帧数
+
+        # 统计信息
+        self.frames = 0
+        self.compressed_frames = 0
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.cpu_seconds = 0.0
+        self.raw_counter = UPSTREAM_PAYLOAD_BYTES.labels(upstream, payload, 'raw')
+        self.sent_counter = UPSTREAM_PAYLOAD_BYTES.labels(upstream, payload, 'sent')
+        self.seconds_counter = COMPRESSION_SECONDS.labels(upstream, payload)
+
+    @classmethod
+    def parse(cls, spec: str, upstream: str, payload: str) -> 'CompressionPolicy':
+        """
+        按配置字符串创建策略
+
+        Args:
+            spec (str): none / gzip / gzip:6 / adaptive / adaptive:0.2
+        """
+        mode, _, arg = spec.strip().lower().partition(':')
+        if mode == CompressionMode.GZIP and arg:
+            return cls(upstream, payload, mode, level=int(arg))
+        if mode == CompressionMode.ADAPTIVE:
+            return cls(upstream, payload, mode, level=ADAPTIVE_LEVEL,
+                       min_saving=float(arg) if arg else ADAPTIVE_MIN_SAVING)
+        return cls(upstream, payload, mode)
+
+    def encode(self, data: BytesLike) -> Tuple[BytesLike, int]:
+        """按策略压缩一帧payload，返回(写入帧的payload, 压缩方式)"""
+        if self.mode == CompressionMode.NONE or (self.mode == CompressionMode.ADAPTIVE and self.should_skip()):
+            self.record(len(data), len(data), 0.0, False)
+            return data, CompressionType.NO_COMPRESSION
+
+        start = time.thread_time()
+        body = zlib.compress(data, self.level, GZIP_WBITS)
+        elapsed = time.thread_time() - start
+
+        if self.mode == CompressionMode.ADAPTIVE:
+            self.update_saving(len(data), len(body))
+            if len(body) >= len(data):
+                # 已经付出了CPU，但压缩后没有变小，发送原始数据
+                self.record(len(data), len(data), elapsed, False)
+                return data, CompressionType.NO_COMPRESSION
+        self.record(len(data), len(body), elapsed, True)
+        return body, CompressionType.GZIP
+
+    def should_skip(self) -> bool:
+        with self.lock:
+            if self.skip > 0:
+                self.skip -= 1
+                return True
+            return False
+
+    def update_saving(self, raw: int, compressed: int) -> None:
+        if not raw:
+            return
+        saving = 1 - compressed / raw
+        with self.lock:
+            if self.saving is None:
+                self.saving = saving
+            else:
+                self.saving += (saving - self.saving) * SAVING_SMOOTHING
+            if self.saving < self.min_saving:
+                self.skip = self.probe_interval
+
+    def record(self, raw: int, sent: int, cpu_seconds: float, compressed: bool) -> None:
+        with self.lock:
+            self.frames += 1
+            self.compressed_frames += compressed
+            self.raw_bytes += raw
+            self.sent_bytes += sent
+            self.cpu_seconds += cpu_seconds
+        self.raw_counter.inc(raw)
+        self.sent_counter.inc(sent)
+        if cpu_seconds:
+            self.seconds_counter.inc(cpu_seconds)
+
+    def describe(self) -> str:
+        if self.mode == CompressionMode.GZIP:
+            return f"gzip:{self.level}"
+        if self.mode == CompressionMode.ADAPTIVE:
+            return f"adaptive:{self.min_saving}"
+        return self.mode
+
+    def get_stats(self) -> dict:
+        """返回压缩统计：节省的字节数和耗费的CPU时间"""
+        with self.lock:
+            saved = self.raw_bytes - self.sent_bytes
+            return {
+                'policy': self.describe(),
+                'frames': self.frames,
+                'compressed_frames': self.compressed_frames,
+                'raw_bytes': self.raw_bytes,
+                'sent_bytes': self.sent_bytes,
+                'saved_bytes': saved,
+                'cpu_ms': round(self.cpu_seconds * 1000, 3),
+                'saved_bytes_per_cpu_ms': round(saved / (self.cpu_seconds * 1000), 1) if self.cpu_seconds else None,
+                'recent_saving': round(self.saving, 3) if self.saving is not None else None,
+                'skipping': self.skip > 0
+            }
@@ -0,0 +1,161 @@
+"""
+多轮对话记忆
+每个WebSocket连接保存一份对话历史，按token预算维护发送给模型的上下文
+
+- 系统提示词和已有的历史消息在轮次之间逐字节保持不变，上游的前缀缓存可以命中
+- 上下文超出预算时，把最早的若干轮压缩为摘要（摘要失败时直接丢弃），
+  一次压缩到预算的一半，之后的多轮对话前缀都不再变化
+- 压缩在回复发送之后于后台进行，下一轮请求开始前等待其完成；
+  压缩任务不继承这一轮的排队截止时间（admission.request_deadline），较长的一轮之后摘要请求也不会被拒绝
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional
+
+from admission import request_deadline
+from character_config import get_system_prompt
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = 4000  # 上下文（含系统提示词）的token预算
+COMPACT_TARGET_RATIO = 0.5  # 压缩后上下文占预算的比例
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的格式开销
+SUMMARY_PREFIX = "以下是你和用户之前对话的摘要：\n"
+
+Summarizer = Callable[[str, List[dict]], Awaitable[str]]
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文字的token数：中文每字约1个token，其他字符约4个算1个token"""
+    wide = sum(1 for char in text if ord(char) > 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def estimate_messages_tokens(messages: List[dict]) -> int:
+    return sum(estimate_tokens(message['content']) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+class ConversationMemory:
+    """
+    一个连接的对话历史
+
+    Args:
+        token_budget (int): 上下文token预算
+        summarizer: 异步摘要函数 (之前的摘要, 要移出的消息) -> 新摘要，为None时直接丢弃旧消息
+        system_prompt (str): 系统提示词，默认使用藿藿的角色设定
+    """
+
+    def __init__(self, token_budget: int = CONTEXT_TOKEN_BUDGET, summarizer: Optional[Summarizer] = None,
+                 system_prompt: Optional[str] = None):
+        self.token_budget = token_budget
+        self.summarizer = summarizer
+        # 整个连接期间使用同一个字符串，保证请求前缀不变
+        self.system_prompt = system_prompt or get_system_prompt()
+        self.summary = ''
+        self.messages = []  # 按顺序保存的user/assistant消息，加入后不再修改
+        self.measured_tokens = None  # 上游返回的最近一次请求的总token数
+        self.compact_task = None
+
+        # 统计信息
+        self.turns = 0
+        self.compactions = 0
+        self.dropped_turns = 0
+        self.summary_failures = 0
+
+    async def get_history(self) -> List[dict]:
+        """返回本轮请求要带上的历史消息（不含系统提示词和本轮用户消息）"""
+        if self.compact_task is not None:
+            # 请求被取消时不能连带取消压缩任务
+            await asyncio.shield(self.compact_task)
+            self.compact_task = None
+
+        history = []
+        if self.summary:
+            history.append({'role': 'system', 'content': SUMMARY_PREFIX + self.summary})
+        history.extend(self.messages)
+        return history
+
+    def add_turn(self, user_message: str, assistant_reply: str, usage: Optional[dict] = None) -> None:
+        """
+        记录一轮对话，上下文超出预算时在后台开始压缩
+
+        Args:
+            user_message (str): 用户消息
+            assistant_reply (str): 模型的原始回复（保留情绪标记，让模型保持回复格式）
+            usage (dict): 上游返回的token用量
+        """
+        self.messages.append({'role': 'user', 'content': user_message})
+        self.messages.append({'role': 'assistant', 'content': assistant_reply})
+        self.turns += 1
+        self.measured_tokens = usage.get('total_tokens') if usage else None
+
+        if self.token_count() > self.token_budget and self.compact_task is None:
+            self.compact_task = asyncio.ensure_future(self.compact())
+
+    def token_count(self) -> int:
+        """当前上下文的token数，优先使用上游返回的真实值"""
+        if self.measured_tokens:
+            return self.measured_tokens
+        return self._estimate(self.messages)
+
+    def _estimate(self, messages: List[dict]) -> int:
+        prefix = [{'role': 'system', 'content': self.system_prompt}]
+        if self.summary:
+            prefix.append({'role': 'system', 'content': SUMMARY_PREFIX + self.summary})
+        return estimate_messages_tokens(prefix + messages)
+
+    async def compact(self) -> None:
+        """把最早的若干轮移出上下文，压缩为摘要"""
+        # 任务从add_turn继承了这一轮的上下文，摘要请求不受这一轮的排队截止时间限制
+        token = request_deadline.set(None)
+        try:
+            await self._compact()
+        finally:
+            request_deadline.reset(token)
+
+    async def _compact(self) -> None:
+        target = self.token_budget * COMPACT_TARGET_RATIO
+        # 用上游的真实token数校准估算值
+        estimated = self._estimate(self.messages)
+        scale = self.measured_tokens / estimated if self.measured_tokens and estimated else 1.0
+
+        count = 0
+        while len(self.messages) - count > 2 and self._estimate(self.messages[count:]) * scale > target:
+            count += 2
+        if not count:
+            return
+
+        removed = self.messages[:count]
+        summary = self.summary
+        if self.summarizer is not None:
+            try:
+                summary = await self.summarizer(self.summary, removed)
+            except Exception as e:
+                self.summary_failures += 1
+                logger.warning(f"对话摘要失败，直接丢弃最早的{count // 2}轮对话: {type(e).__name__}: {str(e)}")
+
+        self.summary = summary
+        del self.messages[:count]
+        self.measured_tokens = None
+        self.compactions += 1
+        self.dropped_turns += count // 2
+        logger.info(f"对话历史已压缩: 移出{count // 2}轮, 剩余{len(self.messages) // 2}轮, "
+                    f"估算token: {self.token_count()}")
+
+    def close(self) -> None:
+        if self.compact_task is not None and not self.compact_task.done():
+            self.compact_task.cancel()
+
+    def get_stats(self) -> dict:
+        """返回对话历史的统计信息"""
+        return {
+            'turns': self.turns,
+            'history_turns': len(self.messages) // 2,
+            'context_tokens': self.token_count(),
+            'token_budget': self.token_budget,
+            'summary_chars': len(self.summary),
+            'compactions': self.compactions,
+            'dropped_turns': self.dropped_turns,
+            'summary_failures': self.summary_failures
+        }
@@ -0,0 +1,183 @@
+"""
+情绪头像资源表
+六张情绪图片在启动时一次性读入内存，之后只读
+
+- 每个文件预先计算内容哈希，用作ETag和URL版本号（?v=哈希），客户端可以永久缓存
+- 安装了Pillow时额外生成WebP版本和缩略图，文件名为 N.webp / N_thumb.webp（不支持WebP时为 N_thumb.jpg）
+- describe()返回资源ID、哈希和各版本的URL，客户端已缓存同一哈希的图片时无需再请求
+"""
+
+import base64
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+EMOTION_IMG_FOLDER = 'emotion_img'
+EMOTION_VALUES = range(1, 7)
+DEFAULT_EMOTION_VALUE = 3
+EMOTION_URL_PREFIX = '/api/emotion/'
+
+THUMBNAIL_SIZE = 256  # 缩略图最长边像素
+WEBP_QUALITY = 80
+THUMBNAIL_QUALITY = 75
+
+
+class AssetFile(NamedTuple):
+    """内存中的一个图片文件"""
+    filename: str
+    content_type: str
+    data: bytes
+    digest: str  # 内容哈希（sha256前16位）
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.digest}"'
+
+    @property
+    def url(self) -> str:
+        return f"{EMOTION_URL_PREFIX}{self.filename}?v={self.digest}"
+
+
+class EmotionAsset(NamedTuple):
+    """一个情绪值对应的图片及其各版本"""
+    emotion_value: int
+    original: AssetFile
+    variants: Mapping[str, AssetFile]  # 'webp' / 'thumb'
+
+
+def make_asset_file(filename: str, data: bytes, content_type: Optional[str] = None) -> AssetFile:
+    content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return AssetFile(filename, content_type, data, hashlib.sha256(data).hexdigest()[:16])
+
+
+def encode_image(image, image_format: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def build_variants(emotion_value: int, data: bytes) -> dict:
+    """用Pillow生成WebP版本和缩略图，未安装Pillow或图片无法解码时返回空字典"""
+    if Image is None:
+        return {}
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+        try:
+            webp = encode_image(image, 'WEBP', WEBP_QUALITY)
+        except (KeyError, OSError):
+            # Pillow编译时没有WebP支持
+            webp = None
+
+        variants = {}
+        if webp is not None:
+            variants['webp'] = make_asset_file(f"{emotion_value}.webp", webp, 'image/webp')
+            variants['thumb'] = make_asset_file(f"{emotion_value}_thumb.webp",
+                                                encode_image(thumbnail, 'WEBP', THUMBNAIL_QUALITY), 'image/webp')
+        else:
+            variants['thumb'] = make_asset_file(f"{emotion_value}_thumb.jpg",
+                                                encode_image(thumbnail.convert('RGB'), 'JPEG', THUMBNAIL_QUALITY),
+                                                'image/jpeg')
+        return variants
+    except Exception as e:
+        logger.warning(f"生成情绪图片{emotion_value}的压缩版本失败: {str(e)}")
+        return {}
+
+
+class EmotionAssetTable:
+    """
+    只读的情绪图片资源表
+
+    Args:
+        folder (str): 情绪图片文件夹，图片文件名为 1.jpg ~ 6.jpg
+    """
+
+    def __init__(self, folder: str = EMOTION_IMG_FOLDER):
+        assets = {}
+        files = {}
+        for emotion_value in EMOTION_VALUES:
+            path = os.path.join(folder, f"{emotion_value}.jpg")
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError as e:
+                logger.warning(f"情绪图片加载失败: {path}, {str(e)}")
+                continue
+
+            original = make_asset_file(f"{emotion_value}.jpg", data, 'image/jpeg')
+            variants = build_variants(emotion_value, data)
+            assets[emotion_value] = EmotionAsset(emotion_value, original, MappingProxyType(variants))
+            for asset_file in (original, *variants.values()):
+                files[asset_file.filename] = asset_file
+
+        self.assets = MappingProxyType(assets)
+        self.files = MappingProxyType(files)
+        logger.info(f"情绪图片已加载: {len(assets)}张, 共{len(files)}个文件, "
+                    f"{sum(len(f.data) for f in files.values())} bytes")
+
+    def get_file(self, filename: str) -> Optional[AssetFile]:
+        return self.files.get(filename)
+
+    def describe(self, emotion_value: int, include_data: Optional[str] = None) -> Optional[dict]:
+        """
+        返回情绪图片的资源描述
+
+        Args:
+            emotion_value (int): 情绪值，超出范围时使用中性情绪
+            include_data (str): 要以base64内嵌数据的版本（'original'/'webp'/'thumb'）
+
+        Returns:
+            dict: {'id', 'hash', 'url', 'variants'}，图片未加载时返回None
+        """
+        asset = self.assets.get(emotion_value) or self.assets.get(DEFAULT_EMOTION_VALUE)
+        if asset is None:
+            return None
+
+        description = {
+            'id': f"emotion-{asset.emotion_value}",
+            'emotion_value': asset.emotion_value,
+            'hash': asset.original.digest,
+            'url': asset.original.url,
+            'variants': {
+                name: {'url': variant.url, 'hash': variant.digest, 'content_type': variant.content_type}
+                for name, variant in asset.variants.items()
+            }
+        }
+        if include_data:
+            inline = asset.original if include_data == 'original' else asset.variants.get(include_data, asset.original)
+            description['data'] = base64.b64encode(inline.data).decode('ascii')
+            description['content_type'] = inline.content_type
+        return description
+
+    def manifest(self, include_data: Optional[str] = None) -> list:
+        """全部情绪图片的资源描述，客户端可以一次预加载"""
+        return [self.describe(emotion_value, include_data) for emotion_value in self.assets]
+
+
+_table = None
+
+
+def get_emotion_assets(folder: str = EMOTION_IMG_FOLDER) -> EmotionAssetTable:
+    """获取情绪图片资源表，第一次调用时加载"""
+    global _table
+    if _table is None:
+        _table = EmotionAssetTable(folder)
+    return _table
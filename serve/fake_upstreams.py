@@ -0,0 +1,387 @@
+"""
+本地模拟的上游服务，用于离线压测（见benchmark.py）
+一个aiohttp应用在同一端口上提供三个服务，协议与真实服务一致：
+
+- ASR:  ws  /api/v3/sauc/bigmodel_nostream  与RequestBuilder/ResponseParser相同的二进制帧
+- TTS:  ws  /api/v1/tts/ws_binary           与parse_tts_response相同的二进制帧，连接可复用
+- LLM:  POST /api/v3/chat/completions       OpenAI兼容的对话接口，支持stream和include_usage
+
+每个服务的延迟（均值和抖动）与错误率可以单独配置；设置并发配额时，超出配额的请求收到与真实服务相同的限流错误
+（ASR 55000031、TTS 3003、LLM HTTP 429）。
+
+用法:
+    python fake_upstreams.py --port 9100 --llm-latency 0.5 --tts-error-rate 0.01
+然后设置 HUOHUO_ASR_URL / HUOHUO_TTS_URL / HUOHUO_ARK_BASE_URL 启动服务器
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+from typing import Optional
+
+from aiohttp import web, WSMsgType
+
+from upstream_protocol import (
+    MessageType, MessageTypeSpecificFlags, SerializationType, CompressionType,
+    build_frame, compress, parse_frame
+)
+
+logger = logging.getLogger(__name__)
+
+ASR_PATH = '/api/v3/sauc/bigmodel_nostream'
+TTS_PATH = '/api/v1/tts/ws_binary'
+LLM_BASE_PATH = '/api/v3'
+
+FAKE_RECOGNIZED_TEXTS = ['你好藿藿', '今天天气怎么样', '给我讲个故事吧', '你在做什么呀', '晚上吃什么好呢']
+FAKE_REPLIES = [
+    '你好呀，我是藿藿。今天也要一起加油哦！有什么想聊的吗？',
+    '嗯……让我想一想。其实我也不太确定，不过我们可以一起慢慢找答案。',
+    '好呀好呀！那我就给你讲一个十王司里的小故事吧，你要认真听哦。',
+    '唔，尾巴大爷又在嘀咕了，不用管它。我们继续说吧！',
+]
+TTS_BYTES_PER_CHAR = 1200  # 每个字大约对应的mp3字节数（24kbps、0.4秒）
+
+
+class UpstreamProfile:
+    """
+    一个模拟上游的延迟和错误设置
+
+    Args:
+        latency (float): 首包延迟均值（秒）
+        jitter (float): 延迟的标准差（秒）
+        error_rate (float): 返回错误的概率
+        interval (float): 流式输出时相邻两段之间的间隔（秒），LLM为每段文字，TTS为每段音频
+        max_concurrency (int): 并发配额，0表示不限制
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, interval: float = 0.0,
+                 max_concurrency: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.interval = interval
+        self.max_concurrency = max_concurrency
+        self.active = 0
+
+    def over_quota(self) -> bool:
+        return 0 < self.max_concurrency <= self.active
+
+    def delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter)) if self.jitter else self.latency
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def to_dict(self) -> dict:
+        return {'latency': self.latency, 'jitter': self.jitter, 'error_rate': self.error_rate,
+                'interval': self.interval, 'max_concurrency': self.max_concurrency}
+
+
+# ---------------------------------------------------------------------------
+# ASR
+
+def build_asr_response(sequence: int, payload: dict, last: bool = False) -> bytearray:
+    body = compress(json.dumps(payload).encode('utf-8'))
+    flags = MessageTypeSpecificFlags.NEG_WITH_SEQUENCE if last else MessageTypeSpecificFlags.POS_SEQUENCE
+    return build_frame(MessageType.SERVER_FULL_RESPONSE, flags, body, sequence)
+
+
+def build_asr_error(code: int, message: str) -> bytearray:
+    # 错误响应的错误码占据序号字段的位置
+    body = compress(json.dumps({'error': message}).encode('utf-8'))
+    return build_frame(MessageType.SERVER_ERROR_RESPONSE, MessageTypeSpecificFlags.NO_SEQUENCE, body, code)
+
+
+async def handle_asr(request: web.Request) -> web.WebSocketResponse:
+    profile = request.app['profiles']['asr']
+    stats = request.app['stats']['asr']
+    ws = web.WebSocketResponse(max_msg_size=0)
+    await ws.prepare(request)
+    stats['connections'] += 1
+
+    audio_bytes = 0
+    active = False
+    async for msg in ws:
+        if msg.type != WSMsgType.BINARY:
+            continue
+        frame = parse_frame(msg.data)
+        message_type, last, sequence = frame.message_type, frame.is_last, frame.sequence
+        if message_type == MessageType.CLIENT_FULL_REQUEST:
+            if profile.over_quota():
+                stats['throttled'] += 1
+                await ws.send_bytes(build_asr_error(55000031, 'fake concurrency quota exceeded'))
+                break
+            profile.active += 1
+            active = True
+            await ws.send_bytes(build_asr_response(sequence, {'audio_info': {}, 'result': {}}))
+            continue
+        if message_type != MessageType.CLIENT_AUDIO_ONLY_REQUEST:
+            await ws.send_bytes(build_asr_error(45000001, 'unexpected message type'))
+            break
+
+        audio_bytes += len(frame.decompressed())
+        if not last:
+            # 每个音频包回复一个不含文字的中间结果，自适应发送依赖这些确认
+            await ws.send_bytes(build_asr_response(sequence, {'result': {}}))
+            continue
+
+        await asyncio.sleep(profile.delay())
+        stats['requests'] += 1
+        if profile.should_fail():
+            stats['errors'] += 1
+            await ws.send_bytes(build_asr_error(55000031, 'fake server busy'))
+        else:
+            text = random.choice(FAKE_RECOGNIZED_TEXTS)
+            await ws.send_bytes(build_asr_response(sequence, {
+                'audio_info': {'duration': audio_bytes // 32},
+                'result': {'text': text}
+            }, last=True))
+        break
+
+    if active:
+        profile.active -= 1
+    await ws.close()
+    return ws
+
+
+# ---------------------------------------------------------------------------
+# TTS
+
+def build_tts_audio(sequence: int, chunk: bytes) -> bytearray:
+    flags = MessageTypeSpecificFlags.NEG_WITH_SEQUENCE if sequence < 0 else MessageTypeSpecificFlags.POS_SEQUENCE
+    return build_frame(MessageType.SERVER_AUDIO_ONLY_RESPONSE, flags, chunk, sequence,
+                       SerializationType.NO_SERIALIZATION, CompressionType.NO_COMPRESSION)
+
+
+def build_tts_ack() -> bytes:
+    return bytes([0x11, MessageType.SERVER_AUDIO_ONLY_RESPONSE << 4, 0x00, 0x00])
+
+
+def build_tts_error(code: int, message: str) -> bytearray:
+    return build_frame(MessageType.SERVER_ERROR_RESPONSE, MessageTypeSpecificFlags.NO_SEQUENCE,
+                       compress(message.encode('utf-8')), code, SerializationType.NO_SERIALIZATION)
+
+
+def parse_tts_request(data: bytes) -> dict:
+    return parse_frame(data).decoded()
+
+
+def fake_mp3(size: int) -> bytes:
+    """由重复的MPEG帧头填充的假音频数据"""
+    frame = b'\xff\xfb\x90\x64' + bytes(413)
+    return (frame * (size // len(frame) + 1))[:size]
+
+
+async def handle_tts(request: web.Request) -> web.WebSocketResponse:
+    profile = request.app['profiles']['tts']
+    stats = request.app['stats']['tts']
+    ws = web.WebSocketResponse(max_msg_size=0)
+    await ws.prepare(request)
+    stats['connections'] += 1
+
+    # 一条连接可以依次处理多次合成，TtsClient会复用连接
+    async for msg in ws:
+        if msg.type != WSMsgType.BINARY:
+            continue
+        text = parse_tts_request(msg.data)['request']['text']
+        stats['requests'] += 1
+        await ws.send_bytes(build_tts_ack())
+        if profile.over_quota():
+            stats['throttled'] += 1
+            await ws.send_bytes(build_tts_error(3003, 'fake concurrency quota exceeded'))
+            break
+
+        profile.active += 1
+        try:
+            await asyncio.sleep(profile.delay())
+
+            if profile.should_fail():
+                stats['errors'] += 1
+                await ws.send_bytes(build_tts_error(3031, 'fake synthesis error'))
+                break
+
+            audio = fake_mp3(max(1, len(text)) * TTS_BYTES_PER_CHAR)
+            chunk_size = 4 * TTS_BYTES_PER_CHAR
+            chunks = [audio[i:i + chunk_size] for i in range(0, len(audio), chunk_size)]
+            for index, chunk in enumerate(chunks, 1):
+                sequence = -index if index == len(chunks) else index
+                await ws.send_bytes(build_tts_audio(sequence, chunk))
+                if profile.interval and sequence > 0:
+                    await asyncio.sleep(profile.interval)
+        finally:
+            profile.active -= 1
+
+    await ws.close()
+    return ws
+
+
+# ---------------------------------------------------------------------------
+# LLM
+
+def split_reply(reply: str, size: int = 3):
+    return [reply[i:i + size] for i in range(0, len(reply), size)]
+
+
+def make_usage(messages: list, reply: str) -> dict:
+    prompt_tokens = sum(len(message.get('content') or '') for message in messages)
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': len(reply),
+        'total_tokens': prompt_tokens + len(reply),
+        'prompt_tokens_details': {'cached_tokens': 0}
+    }
+
+
+async def handle_chat_completions(request: web.Request) -> web.StreamResponse:
+    profile = request.app['profiles']['llm']
+    stats = request.app['stats']['llm']
+    body = await request.json()
+    messages = body.get('messages', [])
+    model = body.get('model', 'fake-model')
+    stats['requests'] += 1
+    if profile.over_quota():
+        stats['throttled'] += 1
+        return web.json_response({'error': {'code': 'RateLimitExceeded', 'message': 'fake concurrency quota exceeded',
+                                            'type': 'TooManyRequests'}}, status=429, headers={'Retry-After': '1'})
+
+    profile.active += 1
+    try:
+        return await complete_chat(request, profile, stats, body, messages, model)
+    finally:
+        profile.active -= 1
+
+
+async def complete_chat(request: web.Request, profile: UpstreamProfile, stats: dict, body: dict, messages: list,
+                        model: str) -> web.StreamResponse:
+    await asyncio.sleep(profile.delay())
+    if profile.should_fail():
+        stats['errors'] += 1
+        return web.json_response({'error': {'code': 'ServerOverloaded', 'message': 'fake server overloaded',
+                                            'type': 'TooManyRequests'}}, status=429)
+
+    # 每次回复都带上序号，避免被TTS缓存命中
+    reply = f"{random.choice(FAKE_REPLIES)}（第{stats['requests']}次）[情绪:{random.randint(1, 6)}]"
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:16]}"
+    created = int(time.time())
+    usage = make_usage(messages, reply)
+
+    if not body.get('stream'):
+        return web.json_response({
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': created,
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply},
+                         'finish_reason': 'stop'}],
+            'usage': usage
+        })
+
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+    await response.prepare(request)
+
+    async def send_event(data: dict) -> None:
+        await response.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+    def chunk(delta: dict, finish_reason: Optional[str] = None) -> dict:
+        return {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+    await send_event(chunk({'role': 'assistant', 'content': ''}))
+    for piece in split_reply(reply):
+        if profile.interval:
+            await asyncio.sleep(profile.interval)
+        await send_event(chunk({'content': piece}))
+    await send_event(chunk({}, 'stop'))
+    if (body.get('stream_options') or {}).get('include_usage'):
+        await send_event({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                          'model': model, 'choices': [], 'usage': usage})
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+# ---------------------------------------------------------------------------
+
+async def handle_stats(request: web.Request) -> web.Response:
+    return web.json_response({
+        'profiles': {name: profile.to_dict() for name, profile in request.app['profiles'].items()},
+        'stats': request.app['stats']
+    })
+
+
+def create_app(asr: UpstreamProfile = None, tts: UpstreamProfile = None,
+               llm: UpstreamProfile = None) -> web.Application:
+    """创建模拟上游服务的aiohttp应用"""
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app['profiles'] = {
+        'asr': asr or UpstreamProfile(),
+        'tts': tts or UpstreamProfile(),
+        'llm': llm or UpstreamProfile(),
+    }
+    app['stats'] = {name: {'connections': 0, 'requests': 0, 'errors': 0, 'throttled': 0} for name in app['profiles']}
+    app.router.add_get(ASR_PATH, handle_asr)
+    app.router.add_get(TTS_PATH, handle_tts)
+    app.router.add_post(f'{LLM_BASE_PATH}/chat/completions', handle_chat_completions)
+    app.router.add_get('/stats', handle_stats)
+    return app
+
+
+async def start_fake_upstreams(host: str = '127.0.0.1', port: int = 9100, **profiles) -> web.AppRunner:
+    """在当前事件循环中启动模拟上游服务"""
+    runner = web.AppRunner(create_app(**profiles), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"模拟上游服务已启动: http://{host}:{port}")
+    return runner
+
+
+def upstream_env(host: str = '127.0.0.1', port: int = 9100) -> dict:
+    """让服务器使用模拟上游服务的环境变量"""
+    return {
+        'HUOHUO_ASR_URL': f"ws://{host}:{port}{ASR_PATH}",
+        'HUOHUO_TTS_URL': f"ws://{host}:{port}{TTS_PATH}",
+        'HUOHUO_ARK_BASE_URL': f"http://{host}:{port}{LLM_BASE_PATH}",
+    }
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    """为三个上游服务添加延迟和错误率参数"""
+    defaults = {'asr': (0.3, 0.05, 0.0), 'llm': (0.5, 0.1, 0.02), 'tts': (0.2, 0.05, 0.05)}
+    for name, (latency, jitter, interval) in defaults.items():
+        parser.add_argument(f'--{name}-latency', type=float, default=latency, help=f'{name}首包延迟均值（秒）')
+        parser.add_argument(f'--{name}-jitter', type=float, default=jitter, help=f'{name}延迟标准差（秒）')
+        parser.add_argument(f'--{name}-error-rate', type=float, default=0.0, help=f'{name}错误率')
+        parser.add_argument(f'--{name}-max-concurrency', type=int, default=0, help=f'{name}并发配额，0为不限制')
+        if name != 'asr':
+            parser.add_argument(f'--{name}-interval', type=float, default=interval,
+                                help=f'{name}流式输出间隔（秒）')
+
+
+def profiles_from_args(args: argparse.Namespace) -> dict:
+    return {
+        name: UpstreamProfile(getattr(args, f'{name}_latency'), getattr(args, f'{name}_jitter'),
+                              getattr(args, f'{name}_error_rate'), getattr(args, f'{name}_interval', 0.0),
+                              getattr(args, f'{name}_max_concurrency'))
+        for name in ('asr', 'tts', 'llm')
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟的ASR/TTS/LLM上游服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for name, value in upstream_env(args.host, args.port).items():
+        print(f"export {name}={value}")
+    web.run_app(create_app(**profiles_from_args(args)), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
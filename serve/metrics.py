@@ -0,0 +1,311 @@
+"""
+运行指标
+进程内的计数器、仪表和直方图，以Prometheus文本格式从HTTP端口的 /metrics 导出
+
+- 不依赖prometheus_client，记录一次只需一次加锁和一次二分查找
+- 带标签的指标用labels()取得子指标，常用的子指标在模块加载时绑定好，热路径上不再查字典
+- 需要在导出时才读取的数值（连接数、队列长度等）通过register_collector注册回调
+"""
+
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+# 秒级延迟的默认分桶：覆盖几毫秒的本地操作到几十秒的上游调用
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    """指标基类，按标签值保存子指标"""
+
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self.new_child()
+
+    def new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """按标签值取得子指标"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}")
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self.new_child())
+        return child
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self.children.items()):
+            lines.extend(child.render(self.name, self.labelnames, key))
+        return lines
+
+    def __getattr__(self, attr):
+        # 没有标签的指标可以直接调用子指标的方法
+        children = self.__dict__.get('children')
+        if children is not None and () in children:
+            return getattr(children[()], attr)
+        raise AttributeError(attr)
+
+
+class CounterChild:
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def render(self, name: str, labelnames: tuple, key: tuple) -> List[str]:
+        return [f"{name}{format_labels(labelnames, key)} {format_value(self.value)}"]
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    kind = 'counter'
+
+    def new_child(self) -> CounterChild:
+        return CounterChild()
+
+
+class GaugeChild:
+    __slots__ = ('lock', 'value')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value -= amount
+
+    def track(self) -> 'InProgress':
+        """with块内数值加一，用于统计进行中的调用数"""
+        return InProgress(self)
+
+    def render(self, name: str, labelnames: tuple, key: tuple) -> List[str]:
+        return [f"{name}{format_labels(labelnames, key)} {format_value(self.value)}"]
+
+
+class InProgress:
+    __slots__ = ('gauge',)
+
+    def __init__(self, gauge: GaugeChild):
+        self.gauge = gauge
+
+    def __enter__(self):
+        self.gauge.inc()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.gauge.dec()
+        return False
+
+
+class Gauge(Metric):
+    """可增可减的仪表"""
+
+    kind = 'gauge'
+
+    def new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+
+class HistogramChild:
+    __slots__ = ('lock', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 每个分桶各自的数量，导出时再累加
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> 'Timer':
+        """with块的耗时记为一次观测，被取消（如用户打断）时不记录"""
+        return Timer(self)
+
+    def render(self, name: str, labelnames: tuple, key: tuple) -> List[str]:
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.bounds + (float('inf'),), counts):
+            cumulative += bucket
+            le = f'le="{format_value(bound)}"'
+            lines.append(f"{name}_bucket{format_labels(labelnames, key, le)} {cumulative}")
+        labels = format_labels(labelnames, key)
+        lines.append(f"{name}_sum{labels} {format_value(total)}")
+        lines.append(f"{name}_count{labels} {count}")
+        return lines
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: HistogramChild):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None or not issubclass(exc_type, asyncio.CancelledError):
+            self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram(Metric):
+    """按固定分桶统计分布的直方图"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"指标重复注册: {metric.name}")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def register_collector(self, collector: Callable[[], None]) -> None:
+        """注册导出前调用的回调，用于更新只在导出时读取的仪表"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        """以Prometheus文本格式导出全部指标"""
+        for collector in self.collectors:
+            collector()
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# 处理流程各阶段的耗时
+STAGE_SECONDS = registry.register(Histogram(
+    'huohuo_stage_seconds', 'Time spent in each pipeline stage', ('stage',)))
+# 一轮对话从收到请求到回复发送完毕的耗时
+REQUEST_SECONDS = registry.register(Histogram(
+    'huohuo_request_seconds', 'End-to-end time from receiving a request to the reply being sent', ('kind',)))
+UPSTREAM_ERRORS = registry.register(Counter(
+    'huohuo_upstream_errors_total', 'Failed upstream calls', ('upstream', 'kind')))
+UPSTREAM_IN_FLIGHT = registry.register(Gauge(
+    'huohuo_upstream_in_flight', 'Upstream calls in progress', ('upstream',)))
+CONNECTED_CLIENTS = registry.register(Gauge(
+    'huohuo_connected_clients', 'Connected WebSocket clients'))
+QUEUE_DEPTH = registry.register(Gauge(
+    'huohuo_queue_depth', 'Tasks waiting for an executor or transcoder slot', ('queue',)))
+# 发往上游的payload压缩前后的字节数，以及压缩耗费的CPU时间
+UPSTREAM_PAYLOAD_BYTES = registry.register(Counter(
+    'huohuo_upstream_payload_bytes_total', 'Upstream payload bytes before (raw) and after (sent) compression',
+    ('upstream', 'payload', 'stage')))
+COMPRESSION_SECONDS = registry.register(Counter(
+    'huohuo_upstream_compression_seconds_total', 'CPU time spent compressing upstream payloads',
+    ('upstream', 'payload')))
+# 语音活动检测处理的录音时长和其中丢弃的静音时长
+VAD_AUDIO_SECONDS = registry.register(Counter(
+    'huohuo_vad_audio_seconds_total', 'Seconds of recorded audio seen (input) and dropped as silence by VAD',
+    ('stage',)))
+VAD_NO_SPEECH = registry.register(Counter(
+    'huohuo_vad_no_speech_total', 'Recordings rejected by VAD because they contained no speech'))
+# 准入控制：各阶段进行中和排队中的请求数、排队时间和被拒绝的请求数
+ADMISSION_IN_FLIGHT = registry.register(Gauge(
+    'huohuo_admission_in_flight', 'Requests admitted and in progress in each stage', ('stage',)))
+ADMISSION_WAITING = registry.register(Gauge(
+    'huohuo_admission_waiting', 'Requests queued for a slot in each stage', ('stage',)))
+ADMISSION_WAIT_SECONDS = registry.register(Histogram(
+    'huohuo_admission_wait_seconds', 'Time admitted requests spent queued for a stage slot', ('stage',)))
+ADMISSION_REJECTED = registry.register(Counter(
+    'huohuo_admission_rejected_total', 'Requests rejected as busy, by stage and reason', ('stage', 'reason')))
+# 出站限流：按上游凭证排队等待配额的时间、上游返回的限流错误和截止时间前等不到配额的请求数
+UPSTREAM_WAIT_SECONDS = registry.register(Histogram(
+    'huohuo_upstream_wait_seconds', 'Time spent waiting for upstream quota (rate and concurrency)', ('upstream',)))
+UPSTREAM_THROTTLED = registry.register(Counter(
+    'huohuo_upstream_throttled_total', 'Throttling errors returned by upstreams', ('upstream',)))
+UPSTREAM_RATE_LIMITED = registry.register(Counter(
+    'huohuo_upstream_rate_limited_total', 'Requests rejected because upstream quota was not available in time',
+    ('upstream',)))
+# 超过端到端时限而被取消的请求，按被取消的阶段计数
+DEADLINE_EXCEEDED = registry.register(Counter(
+    'huohuo_deadline_exceeded_total', 'Requests cancelled for running past their end-to-end deadline, by stage',
+    ('stage',)))
+
+
+def is_timeout(error: BaseException) -> bool:
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError)) or 'timeout' in type(error).__name__.lower()
+
+
+def record_upstream_error(upstream: str, error: Optional[BaseException] = None) -> None:
+    """记录一次上游调用失败，超时单独计数"""
+    kind = 'timeout' if error is not None and is_timeout(error) else 'error'
+    UPSTREAM_ERRORS.labels(upstream, kind).inc()
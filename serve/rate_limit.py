@@ -0,0 +1,271 @@
+"""
+上游调用的出站限流
+上游服务按凭证（TTS的appid、ASR的app_key、方舟的API Key）限制每秒请求数和并发数。
+同一凭证的所有客户端共用一个OutboundLimiter，请求在发出前平滑排队，而不是让突发的请求撞上配额后失败
+
+- 令牌桶：按rate匀速发放，空闲时最多积攒burst个。用预约发放时间的方式实现（GCRA），
+  排队的请求按先后各自睡到自己的发放时间，不需要后台任务
+- 并发上限：同时进行的上游调用数，满员时按先来先到排队，名额直接交给下一个
+- 排队不超过截止时间：取max_wait和所在对话的排队截止时间（admission.deadline_scope）中较早的一个，
+  等不到时抛出admission.BusyError（reason为rate_limit）；不需要排队时不受截止时间限制
+- 自适应退避：上游返回限流错误时发放速率减半并暂停发放一段时间，连续限流时暂停时间加倍；
+  之后每次调用成功恢复一部分速率，直到配置值
+- 限流器可以被多个事件循环共用（例如voice_server的请求线程），状态由线程锁保护
+- 排队时间和退避状态见get_stats，以及 /metrics 的huohuo_upstream_wait_seconds
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+from admission import BusyError, BusyReason, request_deadline
+from metrics import UPSTREAM_WAIT_SECONDS, UPSTREAM_THROTTLED, UPSTREAM_RATE_LIMITED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WAIT = 10.0  # 配额中没有指定时的最长排队秒数
+MIN_RATE_FACTOR = 0.1  # 退避后的发放速率不低于配置值的该比例
+INITIAL_BACKOFF = 0.5  # 第一次被限流后暂停发放的秒数
+MAX_BACKOFF = 8.0
+RECOVERY_STEP = 0.1  # 每次调用成功恢复配置速率的该比例
+
+
+def mask_credential(credential: str) -> str:
+    """统计信息中只显示凭证的最后4位"""
+    return f"***{credential[-4:]}" if len(credential) > 4 else '***'
+
+
+class OutboundLimiter:
+    """
+    一个上游凭证的令牌桶和并发上限
+
+    用法: 调用前await acquire()，结束后release()；上游返回限流错误时调用throttled()，成功时调用succeeded()
+
+    Args:
+        upstream (str): 上游名称 (asr/tts/llm)
+        credential (str): 凭证，只用于区分限流器和显示
+        rate (float): 每秒发放的令牌数
+        burst (int): 最多积攒的令牌数
+        max_concurrency (int): 同时进行的调用数上限
+        max_wait (float): 最长排队秒数
+    """
+
+    def __init__(self, upstream: str, credential: str, rate: float, burst: int, max_concurrency: int,
+                 max_wait: float = DEFAULT_MAX_WAIT):
+        if rate <= 0 or burst < 1 or max_concurrency < 1:
+            raise ValueError(f"{upstream}的配额无效: rate={rate}, burst={burst}, concurrency={max_concurrency}")
+        self.upstream = upstream
+        self.credential = mask_credential(credential)
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+
+        # 令牌桶状态
+        self.current_rate = rate  # 退避后降低的发放速率
+        self.next_token = 0.0  # 下一个令牌的理论发放时间（time.monotonic()）
+        self.paused_until = 0.0
+        self.backoff = 0.0  # 最近一次暂停的秒数，成功后清零
+        # 并发状态
+        self.in_flight = 0
+        self.waiters = deque()  # (事件循环, future)
+
+        # 统计信息
+        self.requests = 0
+        self.delayed = 0  # 经过排队的请求数
+        self.total_wait = 0.0
+        self.max_seen_wait = 0.0
+        self.throttles = 0
+        self.rejected = 0
+        self.wait_histogram = UPSTREAM_WAIT_SECONDS.labels(upstream)
+        self.throttled_counter = UPSTREAM_THROTTLED.labels(upstream)
+        self.rejected_counter = UPSTREAM_RATE_LIMITED.labels(upstream)
+
+    @classmethod
+    def parse(cls, upstream: str, credential: str, spec: str) -> 'OutboundLimiter':
+        """
+        按配置字符串创建限流器
+
+        Args:
+            spec (str): 每秒请求数:突发数:并发数[:最长排队秒数]，例如 10:10:10 或 10:10:10:5
+        """
+        parts = spec.strip().split(':')
+        if len(parts) not in (3, 4):
+            raise ValueError(f"{upstream}的配额格式应为 每秒请求数:突发数:并发数[:最长排队秒数]: {spec}")
+        max_wait = float(parts[3]) if len(parts) == 4 else DEFAULT_MAX_WAIT
+        return cls(upstream, credential, float(parts[0]), int(parts[1]), int(parts[2]), max_wait)
+
+    async def acquire(self) -> float:
+        """
+        等待并发名额和令牌，返回排队的秒数
+
+        Raises:
+            BusyError: 截止时间前等不到
+        """
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        turn_deadline = request_deadline.get()
+        if turn_deadline is not None:
+            deadline = min(deadline, turn_deadline)
+
+        await self._acquire_slot(deadline)
+        try:
+            await self._take_token(deadline)
+        except BaseException:
+            self.release()
+            raise
+
+        waited = time.monotonic() - start
+        with self.lock:
+            self.requests += 1
+            if waited > 0.001:
+                self.delayed += 1
+            self.total_wait += waited
+            self.max_seen_wait = max(self.max_seen_wait, waited)
+        self.wait_histogram.observe(waited)
+        return waited
+
+    def release(self) -> None:
+        """结束一次调用，有人排队时把名额直接交给最早的一个"""
+        with self.lock:
+            while self.waiters:
+                loop, waiter = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._wake, waiter)
+                    return
+                except RuntimeError:
+                    continue  # 等待者的事件循环已经关闭
+            self.in_flight -= 1
+
+    def throttled(self, retry_after: Optional[float] = None) -> None:
+        """上游返回了限流错误：降低发放速率并暂停发放，retry_after为上游建议的等待秒数"""
+        with self.lock:
+            self.throttles += 1
+            self.current_rate = max(self.rate * MIN_RATE_FACTOR, self.current_rate / 2)
+            self.backoff = min(MAX_BACKOFF, self.backoff * 2 if self.backoff else INITIAL_BACKOFF)
+            pause = max(self.backoff, retry_after or 0.0)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            # 暂停结束后按降低的速率匀速发放，不再突发
+            self.next_token = max(self.next_token, self.paused_until + (self.burst - 1) / self.current_rate)
+            rate = self.current_rate
+        self.throttled_counter.inc()
+        logger.warning(f"{self.upstream}上游限流({self.credential})，暂停{pause:.1f}秒，速率降为{rate:.2f}/秒")
+
+    def succeeded(self) -> None:
+        """一次调用成功，逐步恢复发放速率"""
+        if self.current_rate >= self.rate and not self.backoff:
+            return
+        with self.lock:
+            self.backoff = 0.0
+            self.current_rate = min(self.rate, self.current_rate + self.rate * RECOVERY_STEP)
+
+    async def _acquire_slot(self, deadline: float) -> None:
+        with self.lock:
+            # 有空闲名额时直接占用，不受截止时间限制
+            if self.in_flight < self.max_concurrency and not self.waiters:
+                self.in_flight += 1
+                return
+            loop = asyncio.get_event_loop()
+            waiter = loop.create_future()
+            entry = (loop, waiter)
+            self.waiters.append(entry)
+
+        try:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise asyncio.TimeoutError()
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as e:
+            with self.lock:
+                try:
+                    self.waiters.remove(entry)
+                except ValueError:
+                    pass
+            if waiter.done() and not waiter.cancelled():
+                # 名额已经交过来，但请求在轮到的同时放弃了，转给下一个
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject()
+            raise
+
+    def _wake(self, waiter: asyncio.Future) -> None:
+        if waiter.done():
+            # 等待者已经超时或被取消
+            self.release()
+        else:
+            waiter.set_result(None)
+
+    async def _take_token(self, deadline: float) -> None:
+        with self.lock:
+            now = time.monotonic()
+            interval = 1.0 / self.current_rate
+            scheduled = max(self.next_token, now)
+            # 空闲期间积攒的令牌允许最多burst个请求立即发出
+            send_at = max(now, scheduled - (self.burst - 1) * interval, self.paused_until)
+            # 只有需要等待时才看截止时间，对话已经超过排队截止时间也可以立即使用空闲的令牌
+            if send_at > now and send_at > deadline:
+                rejected = True
+            else:
+                rejected = False
+                self.next_token = max(scheduled, send_at) + interval
+        if rejected:
+            self._reject()
+        delay = send_at - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _reject(self) -> None:
+        with self.lock:
+            self.rejected += 1
+        self.rejected_counter.inc()
+        raise BusyError(self.upstream, BusyReason.RATE_LIMIT)
+
+    def get_stats(self) -> dict:
+        """返回配额、当前占用、退避状态和排队时间"""
+        with self.lock:
+            return {
+                'credential': self.credential,
+                'rate': self.rate,
+                'current_rate': round(self.current_rate, 2),
+                'burst': self.burst,
+                'max_concurrency': self.max_concurrency,
+                'in_flight': self.in_flight,
+                'waiting': len(self.waiters),
+                'paused_ms': round(max(0.0, self.paused_until - time.monotonic()) * 1000, 1),
+                'requests': self.requests,
+                'delayed': self.delayed,
+                'throttled': self.throttles,
+                'rejected': self.rejected,
+                'avg_wait_ms': round(self.total_wait * 1000 / self.requests, 1) if self.requests else 0.0,
+                'max_wait_ms': round(self.max_seen_wait * 1000, 1)
+            }
+
+
+# 进程内按(上游, 凭证)共享的限流器
+_limiters: Dict[Tuple[str, str], OutboundLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_outbound_limiter(upstream: str, credential: str, spec: str) -> OutboundLimiter:
+    """获取一个上游凭证的限流器，spec只在第一次创建时生效"""
+    key = (upstream, credential)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = OutboundLimiter.parse(upstream, credential, spec)
+            _limiters[key] = limiter
+        return limiter
+
+
+def get_outbound_limiters() -> List[OutboundLimiter]:
+    with _limiters_lock:
+        return list(_limiters.values())
+
+
+def get_outbound_stats() -> dict:
+    """全部上游凭证的限流统计"""
+    return {f"{limiter.upstream}:{limiter.credential}": limiter.get_stats() for limiter in get_outbound_limiters()}
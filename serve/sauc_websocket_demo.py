@@ -6,8 +6,18 @@ import gzip
 import uuid
 import logging
 import os
-import subprocess
-from typing import Optional, List, Dict, Any, Tuple, AsyncGenerator
+import time
+from collections import deque
+from typing import Optional, List, Dict, Any, Tuple, AsyncGenerator, Union
+
+from audio_transcoder import get_transcoder
+from compression import CompressionPolicy
+from rate_limit import get_outbound_limiter
+from vad import trim_silence, NoSpeechError
+from upstream_protocol import (
+    MessageType, SerializationType, Encoder, gzip_encode, build_full_request, build_audio_request, parse_frame,
+    split_segments
+)
 
 # 配置日志
 logging.basicConfig(
@@ -23,28 +33,38 @@ logger = logging.getLogger(__name__)
 # 常量定义
 DEFAULT_SAMPLE_RATE = 16000
 
-class ProtocolVersion:
-    V1 = 0b0001
-
-class MessageType:
-    CLIENT_FULL_REQUEST = 0b0001
-    CLIENT_AUDIO_ONLY_REQUEST = 0b0010
-    SERVER_FULL_RESPONSE = 0b1001
-    SERVER_ERROR_RESPONSE = 0b1111
-
-class MessageTypeSpecificFlags:
-    NO_SEQUENCE = 0b0000
-    POS_SEQUENCE = 0b0001
-    NEG_SEQUENCE = 0b0010
-    NEG_WITH_SEQUENCE = 0b0011
-
-class SerializationType:
-    NO_SERIALIZATION = 0b0000
-    JSON = 0b0001
-
-class CompressionType:
-    GZIP = 0b0001
-
+# 自动分段时的取值范围（毫秒）
+MIN_SEGMENT_DURATION = 200
+MAX_SEGMENT_DURATION = 1000
+# 快速发送模式下一段录音大致切分的包数
+TARGET_SEGMENT_COUNT = 16
+# 自适应模式下允许未确认的音频包数量
+ADAPTIVE_WINDOW = 4
+
+# 上游payload的压缩策略 (none / gzip[:级别] / adaptive[:节省比例])，见compression.py
+# 16bit PCM几乎压缩不了，音频包默认自适应；JSON控制请求压缩率高，默认gzip
+ASR_AUDIO_COMPRESSION = os.environ.get("HUOHUO_ASR_AUDIO_COMPRESSION", "adaptive")
+ASR_CONTROL_COMPRESSION = os.environ.get("HUOHUO_ASR_CONTROL_COMPRESSION", "gzip")
+asr_audio_compression = CompressionPolicy.parse(ASR_AUDIO_COMPRESSION, 'asr', 'audio')
+asr_control_compression = CompressionPolicy.parse(ASR_CONTROL_COMPRESSION, 'asr', 'control')
+
+# 该app_key的配额：每秒请求数:突发数:并发数[:最长排队秒数]，见rate_limit.py
+ASR_QUOTA = os.environ.get("HUOHUO_ASR_QUOTA", "10:10:20")
+ASR_THROTTLE_CODES = (55000031,)  # 服务器繁忙
+ASR_THROTTLE_RETRIES = 2  # 开启会话时被限流，退避后重试的次数
+
+# 识别的音频来源：文件路径，或已经在内存中的音频数据（不经过磁盘）
+AudioSource = Union[str, bytes, bytearray, memoryview]
+
+# WAV头中fmt子块的格式、声道数、采样率，位深，以及子块大小
+WAV_FMT = struct.Struct('<HHI')
+WAV_BITS = struct.Struct('<H')
+WAV_CHUNK_SIZE = struct.Struct('<I')
+
+class PacingMode:
+    REALTIME = "realtime"  # 按音频时长逐包发送，模拟实时录音
+    BURST = "burst"        # 不等待，尽快发送完所有音频包
+    ADAPTIVE = "adaptive"  # 根据上游确认控制在途包数量
 
 class Config:
     def __init__(self):
@@ -80,28 +100,12 @@ class CommonUtils:
         return data[:4] == b'RIFF' and data[8:12] == b'WAVE'
 
     @staticmethod
-    def convert_wav_with_path(audio_path: str, sample_rate: int = DEFAULT_SAMPLE_RATE) -> bytes:
-        try:
-            cmd = [
-                "ffmpeg", "-v", "quiet", "-y", "-i", audio_path,
-                "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate),
-                "-f", "wav", "-"
-            ]
-            result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            
-            # 尝试删除原始文件
-            try:
-                os.remove(audio_path)
-            except OSError as e:
-                logger.warning(f"Failed to remove original file: {e}")
-                
-            return result.stdout
-        except subprocess.CalledProcessError as e:
-            logger.error(f"FFmpeg conversion failed: {e.stderr.decode()}")
-            raise RuntimeError(f"Audio conversion failed: {e.stderr.decode()}")
+    def read_file(file_path: str) -> bytes:
+        with open(file_path, 'rb') as f:
+            return f.read()
 
     @staticmethod
-    def read_wav_info(data: bytes) -> Tuple[int, int, int, int, bytes]:
+    def read_wav_info(data: bytes) -> Tuple[int, int, int, int, memoryview]:
         if len(data) < 44:
             raise ValueError("Invalid WAV file: too short")
             
@@ -115,18 +119,17 @@ class CommonUtils:
             raise ValueError("Invalid WAV file: not WAVE format")
             
         # 解析fmt子块
-        audio_format = struct.unpack('<H', data[20:22])[0]
-        num_channels = struct.unpack('<H', data[22:24])[0]
-        sample_rate = struct.unpack('<I', data[24:28])[0]
-        bits_per_sample = struct.unpack('<H', data[34:36])[0]
+        audio_format, num_channels, sample_rate = WAV_FMT.unpack_from(data, 20)
+        bits_per_sample = WAV_BITS.unpack_from(data, 34)[0]
         
         # 查找data子块
         pos = 36
         while pos < len(data) - 8:
             subchunk_id = data[pos:pos+4]
-            subchunk_size = struct.unpack('<I', data[pos+4:pos+8])[0]
+            subchunk_size = WAV_CHUNK_SIZE.unpack_from(data, pos + 4)[0]
             if subchunk_id == b'data':
-                wave_data = data[pos+8:pos+8+subchunk_size]
+                # 音频数据用memoryview引用原始文件内容，后续分段也不拷贝
+                wave_data = memoryview(data)[pos+8:pos+8+subchunk_size]
                 return (
                     num_channels,
                     bits_per_sample // 8,
@@ -138,46 +141,6 @@ class CommonUtils:
             
         raise ValueError("Invalid WAV file: no data subchunk found")
 
-class AsrRequestHeader:
-    def __init__(self):
-        self.message_type = MessageType.CLIENT_FULL_REQUEST
-        self.message_type_specific_flags = MessageTypeSpecificFlags.POS_SEQUENCE
-        self.serialization_type = SerializationType.JSON
-        self.compression_type = CompressionType.GZIP
-        self.reserved_data = bytes([0x00])
-
-    def with_message_type(self, message_type: int) -> 'AsrRequestHeader':
-        self.message_type = message_type
-        return self
-
-    def with_message_type_specific_flags(self, flags: int) -> 'AsrRequestHeader':
-        self.message_type_specific_flags = flags
-        return self
-
-    def with_serialization_type(self, serialization_type: int) -> 'AsrRequestHeader':
-        self.serialization_type = serialization_type
-        return self
-
-    def with_compression_type(self, compression_type: int) -> 'AsrRequestHeader':
-        self.compression_type = compression_type
-        return self
-
-    def with_reserved_data(self, reserved_data: bytes) -> 'AsrRequestHeader':
-        self.reserved_data = reserved_data
-        return self
-
-    def to_bytes(self) -> bytes:
-        header = bytearray()
-        header.append((ProtocolVersion.V1 << 4) | 1)
-        header.append((self.message_type << 4) | self.message_type_specific_flags)
-        header.append((self.serialization_type << 4) | self.compression_type)
-        header.extend(self.reserved_data)
-        return bytes(header)
-
-    @staticmethod
-    def default_header() -> 'AsrRequestHeader':
-        return AsrRequestHeader()
-
 class RequestBuilder:
     @staticmethod
     def new_auth_headers() -> Dict[str, str]:
@@ -190,17 +153,15 @@ class RequestBuilder:
         }
 
     @staticmethod
-    def new_full_client_request(seq: int) -> bytes:  # 添加seq参数
-        header = AsrRequestHeader.default_header() \
-            .with_message_type_specific_flags(MessageTypeSpecificFlags.POS_SEQUENCE)
-        
+    def new_full_client_request(seq: int, audio_format: str = "wav", audio_codec: str = "raw",
+                                encode: Encoder = gzip_encode) -> bytearray:  # 添加seq参数
         payload = {
             "user": {
                 "uid": "demo_uid"
             },
             "audio": {
-                "format": "wav",
-                "codec": "raw",
+                "format": audio_format,
+                "codec": audio_codec,
                 "rate": 16000,
                 "bits": 16,
                 "channel": 1
@@ -214,40 +175,17 @@ class RequestBuilder:
                 "enable_nonstream": False
             }
         }
-        
-        payload_bytes = json.dumps(payload).encode('utf-8')
-        compressed_payload = CommonUtils.gzip_compress(payload_bytes)
-        payload_size = len(compressed_payload)
-        
-        request = bytearray()
-        request.extend(header.to_bytes())
-        request.extend(struct.pack('>i', seq))  # 使用传入的seq
-        request.extend(struct.pack('>I', payload_size))
-        request.extend(compressed_payload)
-        
-        return bytes(request)
+        return build_full_request(payload, seq, encode)
 
     @staticmethod
-    def new_audio_only_request(seq: int, segment: bytes, is_last: bool = False) -> bytes:
-        header = AsrRequestHeader.default_header()
-        if is_last:  # 最后一个包特殊处理
-            header.with_message_type_specific_flags(MessageTypeSpecificFlags.NEG_WITH_SEQUENCE)
-            seq = -seq  # 设为负值
-        else:
-            header.with_message_type_specific_flags(MessageTypeSpecificFlags.POS_SEQUENCE)
-        header.with_message_type(MessageType.CLIENT_AUDIO_ONLY_REQUEST)
-        
-        request = bytearray()
-        request.extend(header.to_bytes())
-        request.extend(struct.pack('>i', seq))
-        
-        compressed_segment = CommonUtils.gzip_compress(segment)
-        request.extend(struct.pack('>I', len(compressed_segment)))
-        request.extend(compressed_segment)
-        
-        return bytes(request)
+    def new_audio_only_request(seq: int, segment: bytes, is_last: bool = False,
+                               encode: Encoder = gzip_encode) -> bytearray:
+        # 最后一个包序号取负
+        return build_audio_request(seq, segment, is_last, encode)
 
 class AsrResponse:
+    __slots__ = ('code', 'event', 'is_last_package', 'payload_sequence', 'payload_size', 'payload_msg')
+
     def __init__(self):
         self.code = 0
         self.event = 0
@@ -270,90 +208,243 @@ class ResponseParser:
     @staticmethod
     def parse_response(msg: bytes) -> AsrResponse:
         response = AsrResponse()
-        
-        header_size = msg[0] & 0x0f
-        message_type = msg[1] >> 4
-        message_type_specific_flags = msg[1] & 0x0f
-        serialization_method = msg[2] >> 4
-        message_compression = msg[2] & 0x0f
-        
-        payload = msg[header_size*4:]
-        
-        # 解析message_type_specific_flags
-        if message_type_specific_flags & 0x01:
-            response.payload_sequence = struct.unpack('>i', payload[:4])[0]
-            payload = payload[4:]
-        if message_type_specific_flags & 0x02:
-            response.is_last_package = True
-        if message_type_specific_flags & 0x04:
-            response.event = struct.unpack('>i', payload[:4])[0]
-            payload = payload[4:]
-            
-        # 解析message_type
-        if message_type == MessageType.SERVER_FULL_RESPONSE:
-            response.payload_size = struct.unpack('>I', payload[:4])[0]
-            payload = payload[4:]
-        elif message_type == MessageType.SERVER_ERROR_RESPONSE:
-            response.code = struct.unpack('>i', payload[:4])[0]
-            response.payload_size = struct.unpack('>I', payload[4:8])[0]
-            payload = payload[8:]
-            
-        if not payload:
+        frame = parse_frame(msg)
+        response.payload_sequence = frame.sequence
+        response.is_last_package = frame.is_last
+        response.event = frame.event
+        if frame.message_type in (MessageType.SERVER_FULL_RESPONSE, MessageType.SERVER_ERROR_RESPONSE):
+            response.code = frame.code
+            response.payload_size = frame.payload_size
+
+        if not frame.payload:
             return response
-            
+
         # 解压缩
-        if message_compression == CompressionType.GZIP:
-            try:
-                payload = CommonUtils.gzip_decompress(payload)
-            except Exception as e:
-                logger.error(f"Failed to decompress payload: {e}")
-                return response
-                
+        try:
+            payload = frame.decompressed()
+        except Exception as e:
+            logger.error(f"Failed to decompress payload: {e}")
+            return response
+
         # 解析payload
         try:
-            if serialization_method == SerializationType.JSON:
-                response.payload_msg = json.loads(payload.decode('utf-8'))
+            if frame.serialization == SerializationType.JSON:
+                response.payload_msg = json.loads(str(payload, 'utf-8'))
         except Exception as e:
             logger.error(f"Failed to parse payload: {e}")
-            
+
         return response
 
+class AsrConnectionPool:
+    """
+    进程内共享的ASR连接管理器
+
+    持有一个长期存在的aiohttp会话（复用DNS缓存和连接器），并预先建立少量
+    已鉴权的WebSocket连接。每个识别请求借用一个热连接，用完即关闭并在后台补充。
+    出错、被上游关闭或空闲过久的连接会被淘汰。
+
+    Args:
+        url (str): ASR WebSocket地址
+        size (int): 预热连接数
+        max_idle (float): 预热连接最长空闲时间（秒），超过后淘汰
+    """
+
+    def __init__(self, url: str, size: int = 2, max_idle: float = 30.0):
+        self.url = url
+        self.size = size
+        self.max_idle = max_idle
+        self.session = None
+        self.idle = deque()  # (连接, 建立时间)
+        self.refill_task = None
+        self.closed = False
+
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.retired = 0
+        self.errors = 0
+
+    async def start(self) -> None:
+        """创建共享会话并开始预热连接"""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(ttl_dns_cache=300)
+            )
+        self.refill()
+
+    async def dial(self) -> aiohttp.ClientWebSocketResponse:
+        """建立一个新的已鉴权连接"""
+        return await self.session.ws_connect(self.url, headers=RequestBuilder.new_auth_headers())
+
+    async def acquire(self) -> aiohttp.ClientWebSocketResponse:
+        """借用一个连接，优先使用预热连接"""
+        if self.session is None:
+            await self.start()
+
+        now = time.monotonic()
+        while self.idle:
+            conn, created_at = self.idle.popleft()
+            if conn.closed or now - created_at > self.max_idle:
+                await self.retire(conn)
+                continue
+            self.hits += 1
+            self.refill()
+            return conn
+
+        self.misses += 1
+        self.refill()
+        try:
+            return await self.dial()
+        except Exception:
+            self.errors += 1
+            raise
+
+    async def release(self, conn: aiohttp.ClientWebSocketResponse, error: bool = False) -> None:
+        """归还连接：ASR连接只承载一次请求，归还即关闭"""
+        if error:
+            self.errors += 1
+        await self.retire(conn)
+
+    async def retire(self, conn: aiohttp.ClientWebSocketResponse) -> None:
+        self.retired += 1
+        if not conn.closed:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.warning(f"Failed to close ASR connection: {e}")
+
+    def refill(self) -> None:
+        """在后台补充预热连接"""
+        if self.closed or (self.refill_task and not self.refill_task.done()):
+            return
+        if len(self.idle) < self.size:
+            self.refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self) -> None:
+        while not self.closed and len(self.idle) < self.size:
+            try:
+                conn = await self.dial()
+            except Exception as e:
+                # 连接失败时不重试，等下一次借用时再补充
+                self.errors += 1
+                logger.warning(f"Failed to prewarm ASR connection: {e}")
+                return
+            self.idle.append((conn, time.monotonic()))
+
+    async def close(self) -> None:
+        self.closed = True
+        if self.refill_task and not self.refill_task.done():
+            self.refill_task.cancel()
+        while self.idle:
+            conn, _ = self.idle.popleft()
+            await self.retire(conn)
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+    def get_stats(self) -> Dict[str, int]:
+        """返回连接池的统计信息"""
+        return {
+            'size': self.size,
+            'idle': len(self.idle),
+            'hits': self.hits,
+            'misses': self.misses,
+            'retired': self.retired,
+            'errors': self.errors
+        }
+
 class AsrWsClient:
-    def __init__(self, url: str, segment_duration: int = 200):
+    def __init__(self, url: str, segment_duration: Optional[int] = 200, pacing: str = PacingMode.REALTIME,
+                 pool: Optional[AsrConnectionPool] = None, audio_compression: Optional[CompressionPolicy] = None,
+                 control_compression: Optional[CompressionPolicy] = None, vad: bool = False):
         self.seq = 1
         self.url = url
-        self.segment_duration = segment_duration
+        # segment_duration为None时根据音频时长和发送模式自动选择
+        self.auto_segment = segment_duration is None
+        self.segment_duration = segment_duration or MIN_SEGMENT_DURATION
+        self.pacing = pacing
+        self.acked = 0  # 已收到的上游响应数，用于自适应发送
+        self.ack_event = asyncio.Event()
         self.conn = None
         self.session = None  # 添加session引用
+        self.pool = pool  # 共享连接池，为None时每次新建会话
+        self.stream_task = None  # 流式会话的接收任务
+        # 压缩策略，默认使用进程内共享的策略
+        self.audio_compression = audio_compression or asr_audio_compression
+        self.control_compression = control_compression or asr_control_compression
+        # 解码后先做语音活动检测，裁剪静音；没有人声时抛出vad.NoSpeechError，不连接上游
+        self.vad = vad
+        self.vad_result = None
+        self.stream_responses = []
+        # 同一app_key的识别会话共用配额，从建立连接到关闭连接占用一个并发名额
+        self.limiter = get_outbound_limiter('asr', config.app_key, ASR_QUOTA)
+        self.holding_quota = False
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        if self.pool is None:
+            self.session = aiohttp.ClientSession()
         return self
     
     async def __aexit__(self, exc_type, exc, tb):
-        if self.conn and not self.conn.closed:
-            await self.conn.close()
-        if self.session and not self.session.closed:
+        await self.close_connection(exc_type is not None)
+        if self.pool is None and self.session and not self.session.closed:
             await self.session.close()
+
+    async def close_connection(self, error: bool = False) -> None:
+        """关闭当前连接，使用连接池时归还给连接池"""
+        conn, self.conn = self.conn, None
+        if self.holding_quota:
+            self.holding_quota = False
+            self.limiter.release()
+        if conn is None:
+            return
+        if self.pool is not None:
+            await self.pool.release(conn, error)
+        elif not conn.closed:
+            await conn.close()
         
-    async def read_audio_data(self, file_path: str) -> bytes:
+    async def read_audio_data(self, source: AudioSource) -> bytes:
+        """
+        读取并解码音频
+
+        Args:
+            source: 文件路径（在线程池中读取），或bytes/bytearray/memoryview（直接使用，不经过磁盘）
+        """
         try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
+            loop = asyncio.get_event_loop()
+            if isinstance(source, str):
+                content = await loop.run_in_executor(None, CommonUtils.read_file, source)
+            else:
+                content = source
                 
-            if not CommonUtils.judge_wav(content):
+            is_wav = CommonUtils.judge_wav(content)
+            if not is_wav:
                 logger.info("Converting audio to WAV format...")
-                content = CommonUtils.convert_wav_with_path(file_path, DEFAULT_SAMPLE_RATE)
                 
+            # WAV只在需要时重采样/混音，其他格式经管道交给ffmpeg，均不阻塞事件循环
+            content = await get_transcoder().to_wav(content)
+            if self.vad:
+                content, self.vad_result = await loop.run_in_executor(None, trim_silence, content)
             return content
+        except NoSpeechError:
+            raise
         except Exception as e:
             logger.error(f"Failed to read audio data: {e}")
             raise
             
+    def choose_segment_duration(self, audio_duration: int) -> int:
+        """根据音频时长（毫秒）和发送模式选择每包时长"""
+        if self.pacing == PacingMode.REALTIME:
+            return MIN_SEGMENT_DURATION
+        duration = -(-audio_duration // TARGET_SEGMENT_COUNT // 100) * 100  # 向上取整到100ms
+        return max(MIN_SEGMENT_DURATION, min(MAX_SEGMENT_DURATION, duration))
+
     def get_segment_size(self, content: bytes) -> int:
         try:
-            channel_num, samp_width, frame_rate, _, _ = CommonUtils.read_wav_info(content)[:5]
+            channel_num, samp_width, frame_rate, frame_count, _ = CommonUtils.read_wav_info(content)[:5]
             size_per_sec = channel_num * samp_width * frame_rate
+            if self.auto_segment:
+                self.segment_duration = self.choose_segment_duration(frame_count * 1000 // frame_rate)
+                logger.info(f"Auto segment duration: {self.segment_duration}ms (pacing: {self.pacing})")
             segment_size = size_per_sec * self.segment_duration // 1000
             return segment_size
         except Exception as e:
@@ -361,8 +452,15 @@ class AsrWsClient:
             raise
             
     async def create_connection(self) -> None:
-        headers = RequestBuilder.new_auth_headers()
+        if not self.holding_quota:
+            await self.limiter.acquire()
+            self.holding_quota = True
         try:
+            if self.pool is not None:
+                self.conn = await self.pool.acquire()
+                logger.info(f"Borrowed connection to {self.url}, pool: {self.pool.get_stats()}")
+                return
+            headers = RequestBuilder.new_auth_headers()
             self.conn = await self.session.ws_connect(  # 使用self.session
                 self.url,
                 headers=headers
@@ -372,8 +470,9 @@ class AsrWsClient:
             logger.error(f"Failed to connect to WebSocket: {e}")
             raise
             
-    async def send_full_client_request(self) -> None:
-        request = RequestBuilder.new_full_client_request(self.seq)
+    async def send_full_client_request(self, audio_format: str = "wav", audio_codec: str = "raw") -> Optional[AsrResponse]:
+        request = RequestBuilder.new_full_client_request(self.seq, audio_format, audio_codec,
+                                                         self.control_compression.encode)
         self.seq += 1  # 发送后递增
         try:
             await self.conn.send_bytes(request)
@@ -383,11 +482,29 @@ class AsrWsClient:
             if msg.type == aiohttp.WSMsgType.BINARY:
                 response = ResponseParser.parse_response(msg.data)
                 logger.info(f"Received response: {response.to_dict()}")
-            else:
-                logger.error(f"Unexpected message type: {msg.type}")
+                return response
+            logger.error(f"Unexpected message type: {msg.type}")
+            return None
         except Exception as e:
             logger.error(f"Failed to send full client request: {e}")
             raise
+
+    async def open_session(self, audio_format: str = "wav", audio_codec: str = "raw") -> None:
+        """建立连接并发送完整客户端请求，上游返回限流错误时按限流器的退避等待后重试"""
+        retries = ASR_THROTTLE_RETRIES
+        while True:
+            self.seq = 1
+            await self.create_connection()
+            response = await self.send_full_client_request(audio_format, audio_codec)
+            if response is None or response.code not in ASR_THROTTLE_CODES:
+                return
+            self.limiter.throttled()
+            # 归还配额，重新排队
+            await self.close_connection(error=True)
+            if retries <= 0:
+                raise RuntimeError(f"ASR service busy: {response.code}")
+            retries -= 1
+            logger.info(f"ASR throttled, retrying after backoff ({retries} retries left)")
             
     async def send_messages(self, segment_size: int, content: bytes) -> AsyncGenerator[None, None]:
         audio_segments = self.split_audio(content, segment_size)
@@ -398,7 +515,8 @@ class AsrWsClient:
             request = RequestBuilder.new_audio_only_request(
                 self.seq, 
                 segment,
-                is_last=is_last
+                is_last=is_last,
+                encode=self.audio_compression.encode
             )
             await self.conn.send_bytes(request)
             logger.info(f"Sent audio segment with seq: {self.seq} (last: {is_last})")
@@ -406,17 +524,37 @@ class AsrWsClient:
             if not is_last:
                 self.seq += 1
                 
-            await asyncio.sleep(self.segment_duration / 1000) # 逐个发送，间隔时间模拟实时流
+            if self.pacing == PacingMode.REALTIME:
+                await asyncio.sleep(self.segment_duration / 1000) # 逐个发送，间隔时间模拟实时流
+            elif self.pacing == PacingMode.ADAPTIVE and not is_last:
+                await self.wait_for_ack(i + 1)
+            else:
+                await asyncio.sleep(0)
             # 让出控制权，允许接受消息
             yield
+
+    async def wait_for_ack(self, sent: int) -> None:
+        """在途包数达到窗口上限时等待上游确认，超时则按实时节奏继续"""
+        while sent - self.acked >= ADAPTIVE_WINDOW:
+            self.ack_event.clear()
+            try:
+                await asyncio.wait_for(self.ack_event.wait(), self.segment_duration / 1000)
+            except asyncio.TimeoutError:
+                break
             
     async def recv_messages(self) -> AsyncGenerator[AsrResponse, None]:
         try:
             async for msg in self.conn:
                 if msg.type == aiohttp.WSMsgType.BINARY:
                     response = ResponseParser.parse_response(msg.data)
+                    self.acked += 1
+                    self.ack_event.set()
                     yield response
                     
+                    if response.code in ASR_THROTTLE_CODES:
+                        self.limiter.throttled()
+                    elif response.is_last_package and response.code == 0:
+                        self.limiter.succeeded()
                     if response.is_last_package or response.code != 0:
                         break
                 elif msg.type == aiohttp.WSMsgType.ERROR:
@@ -448,50 +586,117 @@ class AsrWsClient:
                 pass
                 
     @staticmethod
-    def split_audio(data: bytes, segment_size: int) -> List[bytes]:
-        if segment_size <= 0:
-            return []
-            
-        segments = []
-        for i in range(0, len(data), segment_size):
-            end = i + segment_size
-            if end > len(data):
-                end = len(data)
-            segments.append(data[i:end])
-        return segments
+    def split_audio(data: bytes, segment_size: int) -> List[memoryview]:
+        # 分段是对原始音频的memoryview，不拷贝数据
+        return split_segments(data, segment_size)
         
-    async def execute(self, file_path: str) -> AsyncGenerator[AsrResponse, None]:
-        if not file_path:
-            raise ValueError("File path is empty")
+    async def execute(self, source: AudioSource) -> AsyncGenerator[AsrResponse, None]:
+        """
+        识别一段完整的录音
+
+        Args:
+            source: 文件路径，或内存中的音频数据（任意ffmpeg支持的格式）
+        """
+        if not source:
+            raise ValueError("Audio source is empty")
             
         if not self.url:
             raise ValueError("URL is empty")
             
         self.seq = 1
+        self.acked = 0
+        failed = False
         
         try:
-            # 1. 读取音频文件
-            content = await self.read_audio_data(file_path)
+            # 1. 读取并解码音频
+            content = await self.read_audio_data(source)
             
             # 2. 计算分段大小
             segment_size = self.get_segment_size(content)
             
-            # 3. 创建WebSocket连接
-            await self.create_connection()
+            # 3. 创建WebSocket连接并发送完整客户端请求（排队等待配额，被限流时退避重试）
+            await self.open_session()
             
-            # 4. 发送完整客户端请求
-            await self.send_full_client_request()
-            
-            # 5. 启动音频流处理
+            # 4. 启动音频流处理
             async for response in self.start_audio_stream(segment_size, content):
                 yield response
                 
+        except asyncio.CancelledError:
+            # 被取消时会话没有正常结束，连接不能再放回连接池
+            failed = True
+            raise
+        except NoSpeechError:
+            # 没有人声时还没有连接上游
+            raise
         except Exception as e:
+            failed = True
             logger.error(f"Error in ASR execution: {e}")
             raise
         finally:
-            if self.conn:
-                await self.conn.close()
+            await self.close_connection(failed)
+
+    async def start_session(self, audio_format: str = "pcm", audio_codec: str = "raw") -> None:
+        """
+        开启流式识别会话：录音开始时即建立上游连接，之后边录边传
+
+        Args:
+            audio_format (str): 音频容器格式 (pcm/wav/ogg/mp3)，pcm需为16kHz 16bit单声道
+            audio_codec (str): 音频编码 (raw/opus)
+        """
+        if not self.url:
+            raise ValueError("URL is empty")
+
+        self.acked = 0
+        self.stream_responses = []
+        await self.open_session(audio_format, audio_codec)
+
+        async def collector():
+            async for response in self.recv_messages():
+                self.stream_responses.append(response)
+
+        self.stream_task = asyncio.create_task(collector())
+
+    async def feed(self, chunk: bytes) -> None:
+        """把一段录音数据直接发送给识别服务"""
+        if not chunk:
+            return
+        request = RequestBuilder.new_audio_only_request(self.seq, chunk, encode=self.audio_compression.encode)
+        await self.conn.send_bytes(request)
+        self.seq += 1
+
+    async def finish_session(self, timeout: float = 10.0) -> List[AsrResponse]:
+        """
+        结束流式识别会话：发送负序号的最后一包，等待最终识别结果
+
+        Args:
+            timeout (float): 等待最终结果的超时时间（秒）
+
+        Returns:
+            List[AsrResponse]: 会话期间收到的全部响应
+        """
+        try:
+            request = RequestBuilder.new_audio_only_request(self.seq, b"", is_last=True,
+                                                            encode=self.audio_compression.encode)
+            await self.conn.send_bytes(request)
+            logger.info(f"Sent last audio packet with seq: {-self.seq}")
+
+            await asyncio.wait_for(self.stream_task, timeout)
+        except (Exception, asyncio.CancelledError):
+            await self.abort_session(error=True)
+            raise
+        await self.abort_session()
+        return self.stream_responses
+
+    async def abort_session(self, error: bool = False) -> None:
+        """放弃当前流式会话并关闭上游连接"""
+        if self.stream_task and not self.stream_task.done():
+            self.stream_task.cancel()
+            try:
+                await self.stream_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        self.stream_task = None
+        await self.close_connection(error)
 
 async def main():
     import argparse
@@ -504,17 +709,25 @@ async def main():
     #wss://openspeech.bytedance.com/api/v3/sauc/bigmodel_nostream
     parser.add_argument("--url", type=str, default="wss://openspeech.bytedance.com/api/v3/sauc/bigmodel_nostream", 
                        help="WebSocket URL")
-    parser.add_argument("--seg-duration", type=int, default=200, 
-                       help="Audio duration(ms) per packet, default:200")
+    parser.add_argument("--seg-duration", type=int, default=None, 
+                       help="Audio duration(ms) per packet, default: chosen by pacing mode")
+    parser.add_argument("--pacing", type=str, default=PacingMode.BURST,
+                       choices=[PacingMode.REALTIME, PacingMode.BURST, PacingMode.ADAPTIVE],
+                       help="Packet pacing for recorded audio, default:burst")
+    parser.add_argument("--compression", type=str, default=ASR_AUDIO_COMPRESSION,
+                       help="Audio payload compression: none, gzip[:level] or adaptive[:min_saving]")
     
     args = parser.parse_args()
+    audio_compression = CompressionPolicy.parse(args.compression, 'asr', 'audio')
     
-    async with AsrWsClient(args.url, args.seg_duration) as client:  # 使用async with
+    async with AsrWsClient(args.url, args.seg_duration, args.pacing,
+                           audio_compression=audio_compression) as client:  # 使用async with
         try:
             async for response in client.execute(args.file):
                 logger.info(f"Received response: {json.dumps(response.to_dict(), indent=2, ensure_ascii=False)}")
         except Exception as e:
             logger.error(f"ASR processing failed: {e}")
+    logger.info(f"Audio compression: {audio_compression.get_stats()}")
 
 if __name__ == "__main__":
     asyncio.run(main())
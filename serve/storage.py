@@ -0,0 +1,283 @@
+"""
+音频文件存储
+管理上传录音（uploads/audio）和回复语音（reply_video）两个目录
+
+- 目录默认位于本模块所在目录下，与启动时的工作目录无关，可用环境变量改到别处
+- 文件按文件名哈希的前两位分散到256个子目录，单个目录不会积累大量文件；
+  服务启动时（open）在线程池中建立索引，并把旧版本直接放在根目录下的文件迁移到子目录，
+  导入模块本身不访问磁盘
+- 内存索引记录每个文件的大小和时间，列出文件时不再遍历和stat整个目录
+- 按文件存放时间、总大小和文件数设置保留策略，后台定期回收，
+  删除操作在线程池中执行，不阻塞事件循环
+- 正在读取或下发的文件持有租约，回收时跳过
+- 索引和租约只在本进程内有效：voice_server和websocket_server同时运行时各自索引、各自回收同一目录，
+  一个进程持有的租约不能阻止另一个进程删除文件（被删的文件在另一进程中按不存在处理）。
+  两个服务同时部署时只应让其中一个运行回收（另一个设置HUOHUO_STORAGE_GC=0），或者为它们配置不同的目录
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_DIR = os.environ.get("HUOHUO_UPLOAD_DIR", os.path.join(BASE_DIR, 'uploads', 'audio'))
+UPLOAD_MAX_BYTES = 500 * 1024 * 1024  # 上传录音最大总大小
+UPLOAD_MAX_AGE = 7 * 24 * 3600  # 上传录音保留时间（秒）
+GC_INTERVAL = 60  # 后台回收间隔（秒）
+# 是否在本进程中运行后台回收，同一目录只应由一个进程回收
+STORAGE_GC = os.environ.get("HUOHUO_STORAGE_GC", "1") != "0"
+
+TEMP_SUFFIX = '.part'
+
+
+def shard_of(filename: str) -> str:
+    """文件所在的子目录名：文件名哈希的前两位十六进制"""
+    return hashlib.md5(filename.encode('utf-8')).hexdigest()[:2]
+
+
+class FileStore:
+    """
+    一个按子目录分散存放的文件目录，线程安全
+
+    Args:
+        directory (str): 根目录
+        max_bytes (int): 最大总大小，为None时不限制
+        max_age (float): 文件最后一次使用后的保留时间（秒），为None时不限制
+        max_files (int): 最多文件数，为None时不限制
+        accept: 判断文件名是否由本存储管理的函数，默认管理所有文件
+        on_remove: 文件被回收后的回调，参数为文件名
+    """
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None, max_age: Optional[float] = None,
+                 max_files: Optional[int] = None, accept: Optional[Callable[[str], bool]] = None,
+                 on_remove: Optional[Callable[[str], None]] = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_files = max_files
+        self.accept = accept
+        self.on_remove = on_remove
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # 文件名 -> [大小, 创建时间, 最后使用时间]，按最后使用时间排序
+        self.total_bytes = 0
+        self.leases = {}  # 文件名 -> 租约数
+
+        # 统计信息
+        self.gc_runs = 0
+        self.removed_files = 0
+        self.removed_bytes = 0
+        self.skipped_leased = 0
+        self.last_gc_time = 0.0
+
+    def accepts(self, filename: str) -> bool:
+        if filename.startswith('.') or filename.endswith(TEMP_SUFFIX):
+            return False
+        return self.accept is None or self.accept(filename)
+
+    def path_for(self, filename: str, create: bool = False) -> str:
+        """
+        文件的存放路径
+
+        Args:
+            filename (str): 文件名（不含目录）
+            create (bool): 是否创建所在的子目录，写入新文件前使用
+        """
+        shard_dir = os.path.join(self.directory, shard_of(filename))
+        if create:
+            os.makedirs(shard_dir, exist_ok=True)
+        return os.path.join(shard_dir, filename)
+
+    async def open(self) -> None:
+        """在线程池中建立索引，服务开始处理请求前调用"""
+        await asyncio.get_event_loop().run_in_executor(None, self.scan)
+
+    def scan(self) -> None:
+        """建立内存索引，并把根目录下的旧文件迁移到子目录（阻塞）"""
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                if not self.accepts(entry.name):
+                    continue
+                target = self.path_for(entry.name, create=True)
+                try:
+                    os.replace(entry.path, target)
+                except OSError as e:
+                    logger.warning(f"迁移文件失败: {entry.path}, {str(e)}")
+                    continue
+                stat = os.stat(target)
+                found.append((stat.st_mtime, entry.name, stat.st_size))
+            elif entry.is_dir() and len(entry.name) == 2:
+                for sub in os.scandir(entry.path):
+                    if sub.is_file() and self.accepts(sub.name):
+                        stat = sub.stat()
+                        found.append((stat.st_mtime, sub.name, stat.st_size))
+
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+            for mtime, name, size in sorted(found):
+                self.entries[name] = [size, mtime, mtime]
+                self.total_bytes += size
+        logger.info(f"文件索引已建立: {self.directory}, {len(found)} 个文件, {self.total_bytes} bytes")
+
+    def add(self, filename: str, size: int) -> None:
+        """登记一个已写入完成的文件"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.total_bytes -= entry[0]
+            self.entries[filename] = [size, now, now]
+            self.total_bytes += size
+
+    def touch(self, filename: str) -> Optional[int]:
+        """标记文件被使用，返回文件大小，不在索引中时返回None"""
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None:
+                return None
+            entry[2] = time.time()
+            self.entries.move_to_end(filename)
+            return entry[0]
+
+    def discard(self, filename: str) -> None:
+        """把文件移出索引（不删除文件）"""
+        with self.lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                self.total_bytes -= entry[0]
+
+    def __contains__(self, filename: str) -> bool:
+        with self.lock:
+            return filename in self.entries
+
+    def acquire(self, filename: str) -> bool:
+        """取得文件的租约，持有期间不会被回收；文件不在索引中时返回False"""
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is None:
+                return False
+            entry[2] = time.time()
+            self.entries.move_to_end(filename)
+            self.leases[filename] = self.leases.get(filename, 0) + 1
+            return True
+
+    def release(self, filename: str) -> None:
+        with self.lock:
+            count = self.leases.get(filename, 0) - 1
+            if count > 0:
+                self.leases[filename] = count
+            else:
+                self.leases.pop(filename, None)
+
+    @contextmanager
+    def lease(self, filename: str):
+        """在with块内持有文件的租约，返回是否取得"""
+        acquired = self.acquire(filename)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.release(filename)
+
+    def list_files(self, suffix: Optional[str] = None) -> List[Tuple[str, int, float]]:
+        """按创建时间从新到旧列出文件: [(文件名, 大小, 创建时间)]"""
+        with self.lock:
+            files = [(name, entry[0], entry[1]) for name, entry in self.entries.items()
+                     if suffix is None or name.endswith(suffix)]
+        files.sort(key=lambda item: item[2], reverse=True)
+        return files
+
+    def _over_limit(self, count: int, size: int) -> bool:
+        return ((self.max_files is not None and count > self.max_files) or
+                (self.max_bytes is not None and size > self.max_bytes))
+
+    def collect(self) -> int:
+        """
+        回收过期和超出限制的文件（阻塞，应在线程池中调用）
+
+        Returns:
+            int: 删除的文件数
+        """
+        start = time.perf_counter()
+        now = time.time()
+        victims = []
+        with self.lock:
+            count = len(self.entries)
+            size = self.total_bytes
+            for filename, (file_size, _, last_used) in self.entries.items():
+                expired = self.max_age is not None and now - last_used > self.max_age
+                if not expired and not self._over_limit(count, size):
+                    # 之后的文件使用时间更近，也不需要回收
+                    break
+                if filename in self.leases:
+                    self.skipped_leased += 1
+                    continue
+                victims.append((filename, file_size))
+                count -= 1
+                size -= file_size
+
+            for filename, file_size in victims:
+                del self.entries[filename]
+                self.total_bytes -= file_size
+
+        for filename, file_size in victims:
+            try:
+                os.remove(self.path_for(filename))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除文件失败: {filename}, {str(e)}")
+            if self.on_remove is not None:
+                self.on_remove(filename)
+
+        with self.lock:
+            self.gc_runs += 1
+            self.removed_files += len(victims)
+            self.removed_bytes += sum(file_size for _, file_size in victims)
+            self.last_gc_time = time.perf_counter() - start
+        if victims:
+            logger.info(f"文件回收: {self.directory}, 删除 {len(victims)} 个文件, "
+                        f"剩余 {len(self.entries)} 个, {self.total_bytes} bytes")
+        return len(victims)
+
+    def get_stats(self) -> dict:
+        """返回存储的统计信息"""
+        with self.lock:
+            return {
+                'files': len(self.entries),
+                'bytes': self.total_bytes,
+                'leased': len(self.leases),
+                'max_bytes': self.max_bytes,
+                'max_age': self.max_age,
+                'max_files': self.max_files,
+                'gc_runs': self.gc_runs,
+                'removed_files': self.removed_files,
+                'removed_bytes': self.removed_bytes,
+                'skipped_leased': self.skipped_leased,
+                'last_gc_ms': round(self.last_gc_time * 1000, 1)
+            }
+
+
+async def run_gc(stores: List[FileStore], interval: float = GC_INTERVAL) -> None:
+    """后台定期回收各存储的文件，直到任务被取消"""
+    loop = asyncio.get_event_loop()
+    while True:
+        for store in stores:
+            try:
+                await loop.run_in_executor(None, store.collect)
+            except Exception as e:
+                logger.error(f"文件回收失败: {store.directory}, {str(e)}")
+        await asyncio.sleep(interval)
+
+
+upload_store = FileStore(UPLOAD_DIR, max_bytes=UPLOAD_MAX_BYTES, max_age=UPLOAD_MAX_AGE)
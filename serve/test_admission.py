@@ -0,0 +1,134 @@
+"""
+测试准入控制的阶段限流器
+不需要启动服务器，直接运行: python test_admission.py
+"""
+import asyncio
+import time
+
+from admission import StageLimiter, BusyError, BusyReason, deadline_scope
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_queue_full():
+    """并发和排队都满时立即拒绝"""
+    print("----- 队列已满测试 -----")
+
+    async def main():
+        limiter = StageLimiter('asr', max_concurrency=1, max_queue=1, max_wait=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        try:
+            await limiter.acquire()
+            error = None
+        except BusyError as e:
+            error = e
+        limiter.release()
+        await waiter
+        limiter.release()
+        return error, limiter.get_stats()
+
+    error, stats = run(main())
+    print(f"拒绝: {error}  统计: {stats['rejected']}")
+    assert error is not None and error.reason == BusyReason.QUEUE_FULL
+    assert stats['in_flight'] == 0 and stats['admitted'] == 2 and stats['queued'] == 1
+
+
+def test_timeout():
+    """排到最长排队时间仍未轮到时拒绝，并让出队列位置"""
+    print("----- 排队超时测试 -----")
+
+    async def main():
+        limiter = StageLimiter('llm', max_concurrency=1, max_queue=4, max_wait=0.05)
+        await limiter.acquire()
+        try:
+            await limiter.acquire()
+            error = None
+        except BusyError as e:
+            error = e
+        limiter.release()
+        return error, limiter.get_stats()
+
+    error, stats = run(main())
+    print(f"拒绝: {error}  排队: {error.waited * 1000:.0f} ms  统计: {stats['rejected']}")
+    assert error.reason == BusyReason.TIMEOUT and error.waited >= 0.04
+    assert stats['in_flight'] == 0 and stats['waiting'] == 0
+
+
+def test_deadline():
+    """排队时间不超过对话的截止时间，已经过期时排不上立即拒绝"""
+    print("----- 对话截止时间测试 -----")
+
+    async def main():
+        limiter = StageLimiter('tts', max_concurrency=1, max_queue=4, max_wait=10)
+        await limiter.acquire()
+        results = []
+        for seconds in (0.05, 0.0):
+            with deadline_scope(seconds):
+                start = time.monotonic()
+                try:
+                    await limiter.acquire()
+                except BusyError as e:
+                    results.append((e.reason, time.monotonic() - start))
+        limiter.release()
+        return results
+
+    results = run(main())
+    print(f"结果: {[(reason, round(waited * 1000)) for reason, waited in results]} ms")
+    assert [reason for reason, _ in results] == [BusyReason.TIMEOUT, BusyReason.TIMEOUT]
+    assert results[0][1] < 1 and results[1][1] < 0.01
+
+
+def test_expired_deadline_idle():
+    """对话已经超过截止时间，有空闲名额时仍立即放行"""
+    print("----- 截止时间已过 + 空闲名额测试 -----")
+
+    async def main():
+        limiter = StageLimiter('tts', max_concurrency=1, max_queue=0)
+        with deadline_scope(0.0):
+            waited = await limiter.acquire()
+        limiter.release()
+        return waited
+
+    waited = run(main())
+    print(f"排队时间: {waited * 1000:.1f} ms")
+    assert waited == 0.0
+
+
+def test_handoff():
+    """名额按先来先到交给排队的请求，被取消的请求让出位置"""
+    print("----- 名额交接测试 -----")
+
+    async def main():
+        limiter = StageLimiter('turn', max_concurrency=1, max_queue=4, max_wait=1)
+        order = []
+
+        async def request(i):
+            async with limiter:
+                order.append(i)
+                await asyncio.sleep(0.01)
+
+        await limiter.acquire()
+        tasks = [asyncio.ensure_future(request(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks[1].cancel()
+        limiter.release()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return order, limiter.get_stats()
+
+    order, stats = run(main())
+    print(f"完成顺序: {order}  统计: in_flight={stats['in_flight']} waiting={stats['waiting']}")
+    assert order == [0, 2]
+    assert stats['in_flight'] == 0 and stats['waiting'] == 0
+
+
+if __name__ == "__main__":
+    test_queue_full()
+    test_timeout()
+    test_deadline()
+    test_expired_deadline_idle()
+    test_handoff()
+    print("\n全部通过")
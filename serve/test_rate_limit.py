@@ -0,0 +1,121 @@
+"""
+测试上游出站限流器
+不需要启动服务器，直接运行: python test_rate_limit.py
+"""
+import asyncio
+import time
+
+from admission import BusyError, BusyReason, deadline_scope
+from rate_limit import OutboundLimiter
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_burst():
+    """空闲时最多burst个请求立即发出，之后按rate匀速发放"""
+    print("----- 突发和匀速发放测试 -----")
+
+    async def main():
+        limiter = OutboundLimiter('llm', 'test-key', rate=20, burst=3, max_concurrency=10)
+        waits = []
+        for _ in range(5):
+            waits.append(await limiter.acquire())
+            limiter.release()
+        return waits
+
+    waits = run(main())
+    print(f"排队时间: {[round(w * 1000) for w in waits]} ms")
+    assert all(w < 0.01 for w in waits[:3])
+    assert all(0.03 < w < 0.1 for w in waits[3:])
+
+
+def test_concurrency_handoff():
+    """并发满员时排队，名额按先后交给下一个"""
+    print("----- 并发名额交接测试 -----")
+
+    async def main():
+        limiter = OutboundLimiter('tts', 'test-key', rate=1000, burst=100, max_concurrency=1)
+        order = []
+
+        async def call(i):
+            await limiter.acquire()
+            order.append(i)
+            await asyncio.sleep(0.01)
+            limiter.release()
+
+        await asyncio.gather(*(call(i) for i in range(3)))
+        return order, limiter.get_stats()
+
+    order, stats = run(main())
+    print(f"完成顺序: {order}  统计: in_flight={stats['in_flight']} delayed={stats['delayed']}")
+    assert order == [0, 1, 2]
+    assert stats['in_flight'] == 0 and stats['delayed'] == 2
+
+
+def test_backoff():
+    """上游限流后暂停发放并降低速率，成功后逐步恢复"""
+    print("----- 自适应退避测试 -----")
+
+    async def main():
+        limiter = OutboundLimiter('asr', 'test-key', rate=100, burst=10, max_concurrency=10)
+        limiter.throttled(retry_after=0.05)
+        assert limiter.current_rate == 50
+        waited = await limiter.acquire()
+        limiter.release()
+        limiter.succeeded()
+        return waited, limiter.current_rate
+
+    waited, rate = run(main())
+    print(f"暂停后排队: {waited * 1000:.0f} ms  恢复后速率: {rate}")
+    assert waited >= 0.04
+    assert rate == 60
+
+
+def test_deadline_reject():
+    """需要等待且截止时间前等不到时拒绝"""
+    print("----- 截止时间拒绝测试 -----")
+
+    async def main():
+        limiter = OutboundLimiter('llm', 'test-key', rate=1, burst=1, max_concurrency=10)
+        await limiter.acquire()
+        limiter.release()
+        with deadline_scope(0.1):
+            try:
+                await limiter.acquire()
+            except BusyError as e:
+                return e, limiter.get_stats()
+        return None, limiter.get_stats()
+
+    error, stats = run(main())
+    print(f"拒绝: {error}  统计: in_flight={stats['in_flight']} rejected={stats['rejected']}")
+    assert error is not None and error.reason == BusyReason.RATE_LIMIT
+    assert stats['in_flight'] == 0 and stats['rejected'] == 1
+
+
+def test_expired_deadline_idle():
+    """对话已经超过排队截止时间，限流器空闲时仍立即放行"""
+    print("----- 截止时间已过 + 限流器空闲测试 -----")
+
+    async def main():
+        limiter = OutboundLimiter('tts', 'test-key', rate=10, burst=2, max_concurrency=2)
+        with deadline_scope(0.05):
+            await asyncio.sleep(0.1)
+            start = time.monotonic()
+            await limiter.acquire()
+            limiter.release()
+            return time.monotonic() - start, limiter.get_stats()
+
+    waited, stats = run(main())
+    print(f"排队时间: {waited * 1000:.1f} ms  统计: requests={stats['requests']} rejected={stats['rejected']}")
+    assert stats['requests'] == 1 and stats['rejected'] == 0
+
+
+if __name__ == "__main__":
+    test_burst()
+    test_concurrency_handoff()
+    test_backoff()
+    test_deadline_reject()
+    test_expired_deadline_idle()
+    print("\n全部通过")
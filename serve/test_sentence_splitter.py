@@ -0,0 +1,60 @@
+"""
+测试流式回复的逐句切分
+不需要启动服务器，直接运行: python test_sentence_splitter.py
+"""
+from chart import SentenceSplitter
+
+
+def split(deltas, min_length: int = 6):
+    splitter = SentenceSplitter(min_length)
+    sentences = []
+    for delta in deltas:
+        sentences.extend(splitter.feed(delta))
+    return sentences, splitter.flush()
+
+
+def test_split():
+    """按中文标点切分，跨片段的句子拼接完整"""
+    print("----- 逐句切分测试 -----")
+    sentences, rest = split(["你好呀，我是藿", "藿！今天过得怎么", "样？我们一起加油吧"])
+    print(f"句子: {sentences}  剩余: {rest}")
+    assert sentences == ["你好呀，我是藿藿！", "今天过得怎么样？"]
+    assert rest == ["我们一起加油吧"]
+
+
+def test_short_sentences_merged():
+    """过短的句子与下一句合并，连续的标点归入同一句，结尾的短句在输出结束时给出"""
+    print("----- 短句合并测试 -----")
+    sentences, rest = split(["嗯！好的！！我知道了。"])
+    print(f"句子: {sentences}  剩余: {rest}")
+    assert sentences == ["嗯！好的！！"]
+    assert rest == ["我知道了。"]
+
+
+def test_emotion_tag():
+    """情绪标记不进入句子，分段输出的标记前缀暂时保留"""
+    print("----- 情绪标记测试 -----")
+    sentences, rest = split(["抱歉，我有点害怕…… [情", "绪:2]"])
+    print(f"句子: {sentences}  剩余: {rest}")
+    assert sentences == ["抱歉，我有点害怕……"]
+    assert rest == []
+
+    sentences, rest = split(["太好了，我们一起加油吧 [情绪:"])
+    print(f"句子: {sentences}  剩余: {rest}")
+    assert sentences == [] and rest == ["太好了，我们一起加油吧"]
+
+
+def test_unspeakable():
+    """只有标点或空白的片段不合成语音"""
+    print("----- 无文字片段测试 -----")
+    sentences, rest = split(["……！！！\n", "  "], min_length=1)
+    print(f"句子: {sentences}  剩余: {rest}")
+    assert sentences == [] and rest == []
+
+
+if __name__ == "__main__":
+    test_split()
+    test_short_sentences_merged()
+    test_emotion_tag()
+    test_unspeakable()
+    print("\n全部通过")
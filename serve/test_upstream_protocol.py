@@ -0,0 +1,90 @@
+"""
+测试ASR/TTS上游二进制协议的构建和解析
+不需要启动服务器，直接运行: python test_upstream_protocol.py
+"""
+import gzip
+import os
+
+from upstream_protocol import (
+    MessageType, MessageTypeSpecificFlags, SerializationType, CompressionType, CODE_SIZE, ZERO_COPY_MIN_BYTES,
+    build_frame, build_full_request, gzip_encode, build_audio_request, parse_frame, split_segments, type_byte, format_byte
+)
+
+
+def raw_encode(data):
+    return data, CompressionType.NO_COMPRESSION
+
+
+def test_full_request():
+    """JSON请求带序号（ASR）和不带序号（TTS）时都能原样解析回来"""
+    print("----- 完整请求测试 -----")
+    payload = {'user': {'uid': 'test'}, 'request': {'text': '你好，我是藿藿'}}
+    for sequence in (1, None):
+        for encode in (gzip_encode, raw_encode):
+            frame = build_full_request(payload, sequence, encode)
+            parsed = parse_frame(bytes(frame))
+            print(f"序号: {sequence}  压缩: {parsed.compression}  长度: {len(frame)}")
+            assert parsed.message_type == MessageType.CLIENT_FULL_REQUEST
+            assert parsed.sequence == (sequence or 0)
+            assert parsed.payload_size == len(parsed.payload)
+            assert parsed.decoded() == payload
+    # gzip payload与gzip模块兼容
+    frame = parse_frame(bytes(build_full_request(payload)))
+    assert gzip.decompress(bytes(frame.payload)).decode('utf-8').startswith('{')
+
+
+def test_audio_request():
+    """音频包的序号、最后一包标志和数据"""
+    print("----- 音频包测试 -----")
+    segment = os.urandom(3200)
+    middle = parse_frame(bytes(build_audio_request(3, memoryview(segment))))
+    last = parse_frame(bytes(build_audio_request(4, segment, is_last=True, encode=raw_encode)))
+    print(f"中间包: 序号{middle.sequence} 最后{middle.is_last}  最后一包: 序号{last.sequence} 最后{last.is_last}")
+    assert middle.sequence == 3 and not middle.is_last
+    assert bytes(middle.decompressed()) == segment
+    assert last.sequence == -4 and last.is_last
+    assert last.serialization == SerializationType.NO_SERIALIZATION
+    assert bytes(last.payload) == segment
+
+
+def test_server_responses():
+    """TTS音频响应、确认帧和错误响应"""
+    print("----- 服务端响应测试 -----")
+    audio = os.urandom(ZERO_COPY_MIN_BYTES * 2)
+    frame = build_frame(MessageType.SERVER_AUDIO_ONLY_RESPONSE, MessageTypeSpecificFlags.NEG_WITH_SEQUENCE, audio, -5,
+                        SerializationType.NO_SERIALIZATION, CompressionType.NO_COMPRESSION)
+    parsed = parse_frame(bytes(frame))
+    print(f"音频: 序号{parsed.sequence} 最后{parsed.is_last} payload类型{type(parsed.payload).__name__}")
+    assert parsed.is_last and parsed.sequence == -5 and parsed.payload_size == len(audio)
+    assert isinstance(parsed.payload, memoryview) and bytes(parsed.payload) == audio
+
+    ack = parse_frame(bytes([0x11, type_byte(MessageType.SERVER_AUDIO_ONLY_RESPONSE, 0), 0, 0]))
+    assert not ack.is_last and ack.payload_size == 0 and not ack.payload
+
+    message = '{"error": "quota exceeded"}'.encode('utf-8')
+    error = bytearray([0x11, type_byte(MessageType.SERVER_ERROR_RESPONSE, 0),
+                       format_byte(SerializationType.JSON, CompressionType.NO_COMPRESSION), 0])
+    error += CODE_SIZE.pack(45000292, len(message)) + message
+    parsed = parse_frame(bytes(error))
+    print(f"错误: {parsed.code} {parsed.decoded()}")
+    assert parsed.code == 45000292 and parsed.decoded() == {'error': 'quota exceeded'}
+    assert isinstance(parsed.payload, bytes)
+
+
+def test_split_segments():
+    """分段不拷贝数据，拼接后与原数据相同"""
+    print("----- 音频分段测试 -----")
+    data = os.urandom(10000)
+    segments = split_segments(data, 3200)
+    print(f"分段: {[len(segment) for segment in segments]}")
+    assert [len(segment) for segment in segments] == [3200, 3200, 3200, 400]
+    assert b''.join(segments) == data
+    assert split_segments(data, 0) == []
+
+
+if __name__ == "__main__":
+    test_full_request()
+    test_audio_request()
+    test_server_responses()
+    test_split_segments()
+    print("\n全部通过")
@@ -0,0 +1,79 @@
+"""
+测试识别前的静音裁剪
+不需要启动服务器，直接运行: python test_vad.py
+"""
+import numpy as np
+
+from audio_transcoder import build_wav
+from vad import trim_silence, NoSpeechError, PAD_MS
+
+SAMPLE_RATE = 16000
+
+
+def make_wav(segments, channels: int = 1) -> bytes:
+    """按[(秒数, 是否有声音)]生成16bit WAV，静音段带有轻微底噪"""
+    rng = np.random.default_rng(0)
+    parts = []
+    for seconds, voiced in segments:
+        count = int(seconds * SAMPLE_RATE)
+        noise = rng.normal(0, 30, count)
+        if voiced:
+            t = np.arange(count) / SAMPLE_RATE
+            noise += 8000 * np.sin(2 * np.pi * 440 * t)
+        parts.append(noise)
+    samples = np.concatenate(parts).astype('<i2')
+    if channels > 1:
+        samples = np.repeat(samples, channels)
+    return build_wav(samples.tobytes(), SAMPLE_RATE, channels)
+
+
+def test_trim():
+    """前后的静音被裁掉，人声两侧保留PAD_MS"""
+    print("----- 静音裁剪测试 -----")
+    wav = make_wav([(1.0, False), (1.0, True), (1.0, False)])
+    trimmed, result = trim_silence(wav)
+    print(f"检测结果: {result.to_dict()}  大小: {len(wav)} -> {len(trimmed)} bytes")
+    assert result.applied and result.has_speech
+    assert result.input_ms == 3000
+    assert abs(result.speech_ms - 1000) <= 40
+    assert abs(result.output_ms - (1000 + 2 * PAD_MS)) <= 80
+    assert trimmed[:4] == b'RIFF' and len(trimmed) < len(wav)
+
+
+def test_no_speech():
+    """全程静音时抛出NoSpeechError"""
+    print("----- 没有人声测试 -----")
+    try:
+        trim_silence(make_wav([(2.0, False)]))
+    except NoSpeechError as e:
+        print(f"拒绝: {e}")
+        assert e.result.input_ms == 2000 and e.result.speech_ms == 0
+        return
+    raise AssertionError("全程静音的录音没有被拒绝")
+
+
+def test_all_speech():
+    """全程说话的录音原样返回"""
+    print("----- 全程说话测试 -----")
+    wav = make_wav([(1.0, True)])
+    trimmed, result = trim_silence(wav)
+    print(f"检测结果: {result.to_dict()}")
+    assert trimmed == wav and result.dropped_ms == 0
+
+
+def test_unsupported_format():
+    """不支持的格式不检测，原样返回"""
+    print("----- 不支持的格式测试 -----")
+    wav = make_wav([(1.0, False), (0.5, True)], channels=2)
+    trimmed, result = trim_silence(wav)
+    print(f"检测结果: {result.to_dict()}")
+    assert trimmed == wav and not result.applied and result.has_speech
+    assert trim_silence(b'not a wav')[1].applied is False
+
+
+if __name__ == "__main__":
+    test_trim()
+    test_no_speech()
+    test_all_speech()
+    test_unsupported_format()
+    print("\n全部通过")
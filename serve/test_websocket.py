@@ -13,6 +13,8 @@ import base64
 import os
 import sys
 
+from ws_protocol import build_frame, FrameKind, AudioCodec
+
 async def test_websocket_connection():
     """测试WebSocket连接"""
     uri = "ws://localhost:8765"
@@ -123,6 +125,47 @@ async def test_audio_message():
     
     return True
 
+async def test_binary_audio_message():
+    """测试二进制帧音频消息（使用模拟数据）"""
+    uri = "ws://localhost:8765"
+    
+    try:
+        print("\n 测试二进制音频消息...")
+        async with websockets.connect(uri) as websocket:
+            # 跳过欢迎消息
+            await websocket.recv()
+            
+            # 音频数据直接放在二进制帧中，无需base64编码
+            test_audio_data = b"fake_audio_data_for_testing"
+            frame = build_frame(FrameKind.AUDIO, test_audio_data, request_id="test-1", codec=AudioCodec.WEBM)
+            
+            await websocket.send(frame)
+            print(" 已发送二进制音频消息")
+            
+            # 接收响应
+            timeout_count = 0
+            while timeout_count < 15:
+                try:
+                    response = await asyncio.wait_for(websocket.recv(), timeout=10.0)
+                    data = json.loads(response)
+                    print(f" 收到响应: {data}")
+                    
+                    if data.get('type') in ('error', 'assistant_reply'):
+                        if data.get('request_id') == 'test-1':
+                            print("✅ 二进制音频消息测试完成！")
+                        break
+                        
+                except asyncio.TimeoutError:
+                    timeout_count += 1
+                    print(f"⏰ 等待响应超时 ({timeout_count}/15)")
+                    continue
+            
+    except Exception as e:
+        print(f"❌ 二进制音频测试失败: {str(e)}")
+        return False
+    
+    return True
+
 def check_dependencies():
     """检查依赖文件是否存在"""
     print(" 检查依赖文件...")
@@ -131,7 +174,8 @@ def check_dependencies():
         "websocket_server.py",
         "sauc_websocket_demo.py", 
         "chart.py",
-        "tts_service.py"
+        "tts_service.py",
+        "ws_protocol.py"
     ]
     
     missing_files = []
@@ -166,6 +210,9 @@ async def main():
     # 测试音频消息
     await test_audio_message()
     
+    # 测试二进制帧音频消息
+    await test_binary_audio_message()
+    
     print("\n 测试完成！")
     print("\n 提示:")
     print("   - 如果看到连接错误，请先启动WebSocket服务器")
@@ -13,11 +13,22 @@ import asyncio
 import websockets
 import uuid
 import json
-import gzip
 import copy
 import os
+import io
+import time
+import hashlib
 import logging
-from datetime import datetime
+import threading
+import weakref
+from collections import deque, OrderedDict
+from typing import Optional, AsyncGenerator
+
+from metrics import record_upstream_error
+from compression import CompressionPolicy
+from rate_limit import get_outbound_limiter
+from storage import FileStore
+from upstream_protocol import MessageType, Encoder, gzip_encode, build_full_request, parse_frame
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -35,15 +46,35 @@ TTS_CONFIG = {
     "cluster": "volcano_icl",
     "voice_type": "S_jhlSRP7D1",  # 可以配置不同的声音类型
     "host": "openspeech.bytedance.com",
+    "encoding": "mp3",
 }
 
-# 创建reply_video目录
-REPLY_AUDIO_DIR = 'reply_video'
-if not os.path.exists(REPLY_AUDIO_DIR):
-    os.makedirs(REPLY_AUDIO_DIR)
+# TTS连接池配置
+TTS_API_URL = os.environ.get("HUOHUO_TTS_URL", f"wss://{TTS_CONFIG['host']}/api/v1/tts/ws_binary")
+TTS_POOL_SIZE = 2  # 最多保留的空闲连接数
+TTS_IDLE_TIMEOUT = 30  # 空闲连接超过该秒数后关闭
+TTS_HEALTH_CHECK_AFTER = 5  # 空闲超过该秒数的连接复用前先ping检查
+TTS_PING_TIMEOUT = 2
+# 请求payload的压缩策略 (none / gzip[:级别] / adaptive[:节省比例])，见compression.py
+TTS_COMPRESSION = os.environ.get("HUOHUO_TTS_COMPRESSION", "gzip")
+# 该appid的配额：每秒请求数:突发数:并发数[:最长排队秒数]，见rate_limit.py
+TTS_QUOTA = os.environ.get("HUOHUO_TTS_QUOTA", "10:10:10")
+TTS_THROTTLE_CODES = (3003, 3005)  # 并发超限、服务繁忙
+TTS_THROTTLE_RETRIES = 2  # 被限流且还没有产出音频时，退避后重试的次数
+
+# TTS音频缓存配置
+TTS_CACHE_PREFIX = 'tts_'
+TTS_LEGACY_PREFIX = 'reply_'  # 按内容寻址之前的回复语音，由缓存接管后按同样的策略回收
+TTS_CACHE_MAX_FILES = 1000  # 磁盘缓存最多文件数
+TTS_CACHE_MAX_BYTES = 200 * 1024 * 1024  # 磁盘缓存最大总大小
+TTS_CACHE_MAX_AGE = 30 * 24 * 3600  # 超过该秒数未使用的缓存文件被回收
+TTS_CACHE_MEMORY_BYTES = 16 * 1024 * 1024  # 内存热缓存最大总大小
+TTS_CACHE_MEMORY_ITEM_BYTES = 512 * 1024  # 超过该大小的音频不放入内存
+SPEECH_STREAM_CHUNK_SIZE = 16 * 1024  # 缓存命中时按该大小分块下发
 
-# 默认请求头
-default_header = bytearray(b'\x11\x10\x11\x00')
+# 回复语音目录，默认位于本模块所在目录下，与启动时的工作目录无关
+REPLY_AUDIO_DIR = os.environ.get("HUOHUO_REPLY_AUDIO_DIR",
+                                 os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reply_video'))
 
 def create_tts_request(text: str, voice_type: str = None, speed_ratio: float = 1.0) -> dict:
     """
@@ -71,7 +102,7 @@ def create_tts_request(text: str, voice_type: str = None, speed_ratio: float = 1
         },
         "audio": {
             "voice_type": voice_type,
-            "encoding": "mp3",
+            "encoding": TTS_CONFIG["encoding"],
             "speed_ratio": speed_ratio,
             "volume_ratio": 1.0,
             "pitch_ratio": 1.0,
@@ -85,46 +116,21 @@ def create_tts_request(text: str, voice_type: str = None, speed_ratio: float = 1
     }
 
 def parse_tts_response(res, file):
-    """解析TTS响应并写入文件"""
+    """解析TTS响应并写入文件，较大的音频片段以对res的memoryview写入"""
     try:
-        protocol_version = res[0] >> 4
-        header_size = res[0] & 0x0f
-        message_type = res[1] >> 4
-        message_type_specific_flags = res[1] & 0x0f
-        serialization_method = res[2] >> 4
-        message_compression = res[2] & 0x0f
-        reserved = res[3]
-        header_extensions = res[4:header_size*4]
-        payload = res[header_size*4:]
-        
-        if message_type == 0xb:  # audio-only server response
-            if message_type_specific_flags == 0:  # no sequence number as ACK
-                return False
-            else:
-                sequence_number = int.from_bytes(payload[:4], "big", signed=True)
-                payload_size = int.from_bytes(payload[4:8], "big", signed=False)
-                payload = payload[8:]
-                
-            file.write(payload)
-            if sequence_number < 0:
-                return True
-            else:
+        frame = parse_frame(res)
+        
+        if frame.message_type == MessageType.SERVER_AUDIO_ONLY_RESPONSE:
+            if frame.flags == 0:  # no sequence number as ACK
                 return False
-        elif message_type == 0xf:  # error response
-            code = int.from_bytes(payload[:4], "big", signed=False)
-            msg_size = int.from_bytes(payload[4:8], "big", signed=False)
-            error_msg = payload[8:]
-            if message_compression == 1:
-                error_msg = gzip.decompress(error_msg)
-            error_msg = str(error_msg, "utf-8")
-            logger.error(f"TTS错误 - 代码: {code}, 消息: {error_msg}")
+            file.write(frame.payload)
+            return frame.is_last
+        elif frame.message_type == MessageType.SERVER_ERROR_RESPONSE:
+            error_msg = str(frame.decompressed(), "utf-8")
+            logger.error(f"TTS错误 - 代码: {frame.code}, 消息: {error_msg}")
             return True
-        elif message_type == 0xc:  # frontend server response
-            msg_size = int.from_bytes(payload[:4], "big", signed=False)
-            payload = payload[4:]
-            if message_compression == 1:
-                payload = gzip.decompress(payload)
-            logger.info(f"TTS前端消息: {payload}")
+        elif frame.message_type == MessageType.SERVER_FRONTEND_RESPONSE:
+            logger.info(f"TTS前端消息: {bytes(frame.decompressed())}")
         else:
             logger.warning("未定义的消息类型!")
             return True
@@ -132,9 +138,380 @@ def parse_tts_response(res, file):
         logger.error(f"解析TTS响应失败: {str(e)}")
         return True
 
+class ChunkSink:
+    """收集parse_tts_response写出的音频片段"""
+    
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data: bytes) -> None:
+        if data:
+            self.chunks.append(data)
+
+def build_full_client_request(text: str, voice_type: str = None, speed_ratio: float = 1.0,
+                              encode: Encoder = gzip_encode) -> bytearray:
+    """构建TTS完整客户端请求帧"""
+    return build_full_request(create_tts_request(text, voice_type, speed_ratio), encode=encode)
+
+class TtsClient:
+    """
+    可复用连接的TTS客户端
+    
+    合成结束后如果上游没有关闭连接，连接会放回空闲池供下一次请求使用；
+    借出连接时会在后台预先建立下一条连接，避免下一次请求等待握手。
+    空闲过久的连接会被关闭，复用前检查连接状态。
+    同一appid的合成请求经过进程内共享的出站限流器（rate_limit.py），按配额排队发出。
+    
+    Args:
+        max_size (int): 最多保留的空闲连接数
+        idle_timeout (float): 空闲连接超时时间（秒）
+        compression (CompressionPolicy): 请求payload的压缩策略，默认按TTS_COMPRESSION创建
+    """
+    
+    def __init__(self, max_size: int = TTS_POOL_SIZE, idle_timeout: float = TTS_IDLE_TIMEOUT,
+                 compression: Optional[CompressionPolicy] = None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.compression = compression or CompressionPolicy.parse(TTS_COMPRESSION, 'tts', 'control')
+        self.limiter = get_outbound_limiter('tts', TTS_CONFIG['appid'], TTS_QUOTA)
+        self.idle = deque()  # (连接, 最后使用时间)
+        self.predial_task = None
+        self.closed = False
+        
+        # 统计信息
+        self.hits = 0
+        self.misses = 0
+        self.retired = 0
+        self.in_use = 0
+    
+    async def dial(self):
+        """建立新的TTS连接"""
+        header = {"Authorization": f"Bearer; {TTS_CONFIG['token']}"}
+        return await websockets.connect(TTS_API_URL, extra_headers=header, ping_interval=None)
+    
+    async def is_healthy(self, ws, idle_time: float) -> bool:
+        """检查空闲连接是否可用"""
+        if not ws.open or idle_time > self.idle_timeout:
+            return False
+        if idle_time < TTS_HEALTH_CHECK_AFTER:
+            return True
+        try:
+            pong = await ws.ping()
+            await asyncio.wait_for(pong, TTS_PING_TIMEOUT)
+            return True
+        except Exception:
+            return False
+    
+    async def acquire(self):
+        """借出一条连接，返回(连接, 是否为复用连接)"""
+        while self.idle:
+            ws, last_used = self.idle.pop()
+            if await self.is_healthy(ws, time.monotonic() - last_used):
+                self.hits += 1
+                self.in_use += 1
+                self.predial()
+                return ws, True
+            await self.retire(ws)
+        
+        self.misses += 1
+        ws = await self.dial()
+        self.in_use += 1
+        self.predial()
+        return ws, False
+    
+    async def release(self, ws, reusable: bool) -> None:
+        """归还连接，可复用时放回空闲池"""
+        self.in_use -= 1
+        if reusable and not self.closed and ws.open and len(self.idle) < self.max_size:
+            self.idle.append((ws, time.monotonic()))
+        else:
+            await self.retire(ws)
+    
+    async def retire(self, ws) -> None:
+        self.retired += 1
+        try:
+            await ws.close()
+        except Exception as e:
+            logger.warning(f"关闭TTS连接失败: {str(e)}")
+    
+    def predial(self) -> None:
+        """没有空闲连接时在后台预先建立下一条连接"""
+        if self.closed or self.idle or self.max_size <= 0:
+            return
+        if self.predial_task and not self.predial_task.done():
+            return
+        self.predial_task = asyncio.create_task(self._predial())
+    
+    async def _predial(self) -> None:
+        try:
+            ws = await self.dial()
+        except Exception as e:
+            logger.warning(f"预建TTS连接失败: {str(e)}")
+            return
+        if self.closed or len(self.idle) >= self.max_size:
+            await self.retire(ws)
+        else:
+            self.idle.append((ws, time.monotonic()))
+    
+    async def stream(self, text: str, voice_type: str = None, speed_ratio: float = 1.0) -> AsyncGenerator[bytes, None]:
+        """
+        合成语音，上游每返回一段音频就立即产出
+        
+        Args:
+            text (str): 要转换的文字
+            voice_type (str): 声音类型
+            speed_ratio (float): 语速比例
+        
+        Raises:
+            RuntimeError: TTS服务返回错误
+            admission.BusyError: 截止时间前等不到该appid的配额
+        """
+        full_client_request = build_full_client_request(text, voice_type, speed_ratio, self.compression.encode)
+        retries = TTS_THROTTLE_RETRIES
+        streamed = False
+        
+        # 在借用连接之前排队等待配额
+        await self.limiter.acquire()
+        holding = True
+        try:
+            while True:
+                ws, reused = await self.acquire()
+                reusable = False
+                received = False
+                throttled = False
+                try:
+                    await ws.send(full_client_request)
+                    while True:
+                        res = await ws.recv()
+                        received = True
+                        sink = ChunkSink()
+                        done = parse_tts_response(res, sink)
+                        for chunk in sink.chunks:
+                            streamed = True
+                            yield chunk
+                        if done:
+                            # 只有正常结束（最后一个音频包）的连接才可以复用
+                            reusable = (res[1] >> 4) == 0xb
+                            if reusable:
+                                self.limiter.succeeded()
+                                return
+                            code = parse_frame(res).code
+                            if code in TTS_THROTTLE_CODES:
+                                self.limiter.throttled()
+                                throttled = not streamed and retries > 0
+                                if throttled:
+                                    break
+                            raise RuntimeError(f'TTS服务返回错误: {code}')
+                except websockets.exceptions.ConnectionClosed as e:
+                    if not (reused and not received):
+                        record_upstream_error('tts', e)
+                        raise
+                    # 复用的连接已被上游关闭，换一条新连接重试
+                    logger.info("复用的TTS连接已关闭，重新建立连接")
+                except Exception as e:
+                    record_upstream_error('tts', e)
+                    raise
+                finally:
+                    await self.release(ws, reusable)
+                
+                if throttled:
+                    # 被上游限流：归还配额，等限流器退避结束后重试
+                    retries -= 1
+                    logger.info(f"TTS被限流，退避后重试，剩余重试次数: {retries}")
+                    self.limiter.release()
+                    holding = False
+                    await self.limiter.acquire()
+                    holding = True
+        finally:
+            if holding:
+                self.limiter.release()
+    
+    async def synthesize(self, text: str, file, voice_type: str = None, speed_ratio: float = 1.0) -> None:
+        """
+        合成语音并写入文件
+        
+        Args:
+            text (str): 要转换的文字
+            file: 以二进制写模式打开的文件对象
+            voice_type (str): 声音类型
+            speed_ratio (float): 语速比例
+        """
+        upstream = self.stream(text, voice_type, speed_ratio)
+        try:
+            async for chunk in upstream:
+                file.write(chunk)
+        finally:
+            # 被取消时立即关闭上游连接，不等垃圾回收
+            await upstream.aclose()
+    
+    async def close(self) -> None:
+        self.closed = True
+        if self.predial_task and not self.predial_task.done():
+            self.predial_task.cancel()
+        while self.idle:
+            ws, _ = self.idle.pop()
+            await self.retire(ws)
+    
+    def get_stats(self) -> dict:
+        """返回连接池的统计信息"""
+        return {
+            'max_size': self.max_size,
+            'idle': len(self.idle),
+            'in_use': self.in_use,
+            'hits': self.hits,
+            'misses': self.misses,
+            'retired': self.retired,
+            'compression': self.compression.get_stats(),
+            'quota': self.limiter.get_stats()
+        }
+
+# 每个事件循环一个TTS客户端（websockets连接不能跨事件循环使用）
+_tts_clients = weakref.WeakKeyDictionary()
+
+def get_tts_client() -> TtsClient:
+    """获取当前事件循环的TTS客户端"""
+    loop = asyncio.get_event_loop()
+    client = _tts_clients.get(loop)
+    if client is None:
+        client = TtsClient()
+        _tts_clients[loop] = client
+    return client
+
+async def close_tts_client() -> None:
+    """关闭当前事件循环的TTS客户端及其连接"""
+    client = _tts_clients.pop(asyncio.get_event_loop(), None)
+    if client is not None:
+        await client.close()
+
+class TtsCache:
+    """
+    按内容寻址的TTS音频缓存
+    
+    以(文字, 声音类型, 语速, 编码)的哈希作为文件名保存在reply_video中，
+    相同的回复不再重复合成。磁盘文件由FileStore管理，按文件数、总大小和
+    未使用时间在后台回收，最近使用的小文件同时保存在内存热缓存中。线程安全。
+    旧版本按时间命名的reply_*文件也纳入管理，服务启动时（store.open）迁移到子目录，之后同样被回收。
+    
+    Args:
+        directory (str): 缓存目录
+        max_files (int): 磁盘缓存最多文件数
+        max_bytes (int): 磁盘缓存最大总大小
+        memory_bytes (int): 内存热缓存最大总大小
+        max_age (float): 缓存文件未使用的最长保留时间（秒）
+    """
+    
+    def __init__(self, directory: str = REPLY_AUDIO_DIR, max_files: int = TTS_CACHE_MAX_FILES,
+                 max_bytes: int = TTS_CACHE_MAX_BYTES, memory_bytes: int = TTS_CACHE_MEMORY_BYTES,
+                 max_age: float = TTS_CACHE_MAX_AGE):
+        self.memory_bytes = memory_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # 文件名 -> 音频数据
+        self.memory_size = 0
+        
+        # 统计信息
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        
+        self.store = FileStore(directory, max_bytes=max_bytes, max_age=max_age, max_files=max_files,
+                               accept=self.manages, on_remove=self.forget)
+    
+    @staticmethod
+    def make_key(text: str, voice_type: str = None, speed_ratio: float = 1.0, encoding: str = None) -> str:
+        """计算缓存键"""
+        identity = json.dumps([
+            text,
+            voice_type or TTS_CONFIG["voice_type"],
+            float(speed_ratio),
+            encoding or TTS_CONFIG["encoding"]
+        ], ensure_ascii=False)
+        return hashlib.sha256(identity.encode('utf-8')).hexdigest()[:32]
+    
+    @staticmethod
+    def filename_for(key: str, encoding: str = None) -> str:
+        return f"{TTS_CACHE_PREFIX}{key}.{encoding or TTS_CONFIG['encoding']}"
+    
+    @staticmethod
+    def is_cache_file(filename: str) -> bool:
+        return filename.startswith(TTS_CACHE_PREFIX) and not filename.endswith('.part')
+    
+    @staticmethod
+    def manages(filename: str) -> bool:
+        """是否由缓存的存储管理：缓存文件和旧版本的回复语音"""
+        return filename.startswith((TTS_CACHE_PREFIX, TTS_LEGACY_PREFIX)) and not filename.endswith('.part')
+    
+    def path_for(self, filename: str, create: bool = False) -> str:
+        """缓存文件的存放路径"""
+        return self.store.path_for(filename, create)
+    
+    def lookup(self, filename: str) -> Optional[int]:
+        """查找缓存，命中时返回文件大小"""
+        size = self.store.touch(filename)
+        with self.lock:
+            if size is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return size
+    
+    def get_bytes(self, filename: str) -> Optional[bytes]:
+        """从内存热缓存读取音频数据，不在内存中时返回None"""
+        with self.lock:
+            data = self.memory.get(filename)
+            if data is not None:
+                self.memory.move_to_end(filename)
+                self.memory_hits += 1
+            return data
+    
+    def add(self, filename: str, data: bytes) -> None:
+        """登记一个已写入磁盘的缓存文件，超出限制的文件由后台回收"""
+        self.store.add(filename, len(data))
+        if len(data) <= TTS_CACHE_MEMORY_ITEM_BYTES:
+            with self.lock:
+                self._remember(filename, data)
+    
+    def _remember(self, filename: str, data: bytes) -> None:
+        if filename in self.memory:
+            self.memory_size -= len(self.memory.pop(filename))
+        self.memory[filename] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_bytes and self.memory:
+            _, dropped = self.memory.popitem(last=False)
+            self.memory_size -= len(dropped)
+    
+    def forget(self, filename: str) -> None:
+        """缓存文件被回收后同时移出内存热缓存"""
+        with self.lock:
+            if filename in self.memory:
+                self.memory_size -= len(self.memory.pop(filename))
+    
+    def get_stats(self) -> dict:
+        """返回缓存的统计信息"""
+        store_stats = self.store.get_stats()
+        with self.lock:
+            return {
+                'files': store_stats['files'],
+                'bytes': store_stats['bytes'],
+                'memory_files': len(self.memory),
+                'memory_bytes': self.memory_size,
+                'hits': self.hits,
+                'memory_hits': self.memory_hits,
+                'misses': self.misses,
+                'evictions': store_stats['removed_files']
+            }
+
+tts_cache = TtsCache()
+
+def write_file(file_path: str, data: bytes) -> None:
+    """先写临时文件再原子替换，避免读到写了一半的缓存文件"""
+    temp_path = f"{file_path}.{uuid.uuid4().hex[:8]}.part"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, file_path)
+
 async def generate_speech(text: str, voice_type: str = None, speed_ratio: float = 1.0) -> dict:
     """
-    将文字转换为语音文件
+    将文字转换为语音文件，相同的文字和声音参数直接使用缓存
     
     Args:
         text (str): 要转换的文字
@@ -147,48 +524,41 @@ async def generate_speech(text: str, voice_type: str = None, speed_ratio: float
     try:
         logger.info(f"开始TTS转换: {text}")
         
-        # 生成唯一文件名
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_id = str(uuid.uuid4())[:8]
-        filename = f"reply_{timestamp}_{unique_id}.mp3"
-        file_path = os.path.join(REPLY_AUDIO_DIR, filename)
-        
-        # 创建TTS请求
-        request_config = create_tts_request(text, voice_type, speed_ratio)
+        # 按内容寻址的文件名
+        filename = TtsCache.filename_for(TtsCache.make_key(text, voice_type, speed_ratio))
+        file_path = tts_cache.path_for(filename, create=True)
         
-        # 准备请求数据
-        payload_bytes = str.encode(json.dumps(request_config))
-        payload_bytes = gzip.compress(payload_bytes)
-        full_client_request = bytearray(default_header)
-        full_client_request.extend((len(payload_bytes)).to_bytes(4, 'big'))
-        full_client_request.extend(payload_bytes)
-        
-        # 连接TTS服务
-        api_url = f"wss://{TTS_CONFIG['host']}/api/v1/tts/ws_binary"
-        header = {"Authorization": f"Bearer; {TTS_CONFIG['token']}"}
+        cached_size = tts_cache.lookup(filename)
+        if cached_size is not None:
+            logger.info(f"TTS缓存命中: {filename}")
+            return {
+                'success': True,
+                'filename': filename,
+                'file_path': file_path,
+                'file_size': cached_size,
+                'text': text,
+                'cached': True
+            }
         
-        file_to_save = open(file_path, "wb")
+        # 通过可复用连接的TTS客户端合成
+        buffer = io.BytesIO()
+        await get_tts_client().synthesize(text, buffer, voice_type, speed_ratio)
+        audio_data = buffer.getvalue()
         
-        async with websockets.connect(api_url, extra_headers=header, ping_interval=None) as ws:
-            await ws.send(full_client_request)
-            while True:
-                res = await ws.recv()
-                done = parse_tts_response(res, file_to_save)
-                if done:
-                    file_to_save.close()
-                    break
-        
-        # 检查文件是否成功生成
-        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-            file_size = os.path.getsize(file_path)
-            logger.info(f"TTS转换成功: {filename}, 大小: {file_size} bytes")
+        # 检查是否成功生成
+        if audio_data:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, write_file, file_path, audio_data)
+            tts_cache.add(filename, audio_data)
+            logger.info(f"TTS转换成功: {filename}, 大小: {len(audio_data)} bytes")
             
             return {
                 'success': True,
                 'filename': filename,
                 'file_path': file_path,
-                'file_size': file_size,
-                'text': text
+                'file_size': len(audio_data),
+                'text': text,
+                'cached': False
             }
         else:
             logger.error("TTS文件生成失败或文件为空")
@@ -204,6 +574,92 @@ async def generate_speech(text: str, voice_type: str = None, speed_ratio: float
             'error': str(e)
         }
 
+def read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as f:
+        return f.read()
+
+class SpeechStream:
+    """
+    边合成边下发的TTS语音流
+    
+    迭代得到上游返回的每一段音频；tee为True时合成结束后同时写入缓存文件，
+    之后可以通过audio_url再次访问。缓存命中时直接分块读出缓存的音频。
+    迭代结束后result与generate_speech的返回值格式相同。
+    
+    Args:
+        text (str): 要转换的文字
+        voice_type (str): 声音类型
+        speed_ratio (float): 语速比例
+        tee (bool): 是否同时写入文件
+    """
+    
+    def __init__(self, text: str, voice_type: str = None, speed_ratio: float = 1.0, tee: bool = True):
+        self.text = text
+        self.voice_type = voice_type
+        self.speed_ratio = speed_ratio
+        self.tee = tee
+        self.reply_id = uuid.uuid4().hex[:12]
+        self.filename = TtsCache.filename_for(TtsCache.make_key(text, voice_type, speed_ratio))
+        self.file_path = tts_cache.path_for(self.filename, create=True)
+        self.result = None
+    
+    def __aiter__(self):
+        return self.iterate()
+    
+    async def iterate(self) -> AsyncGenerator[bytes, None]:
+        loop = asyncio.get_event_loop()
+        
+        cached_size = tts_cache.lookup(self.filename)
+        if cached_size is not None:
+            data = tts_cache.get_bytes(self.filename)
+            if data is None:
+                try:
+                    # 持有租约，读取期间文件不会被后台回收
+                    with tts_cache.store.lease(self.filename):
+                        data = await loop.run_in_executor(None, read_file, self.file_path)
+                except OSError as e:
+                    logger.warning(f"读取TTS缓存文件失败: {str(e)}")
+            if data is not None:
+                logger.info(f"TTS缓存命中(流式): {self.filename}")
+                view = memoryview(data)
+                for offset in range(0, len(data), SPEECH_STREAM_CHUNK_SIZE):
+                    yield view[offset:offset + SPEECH_STREAM_CHUNK_SIZE]
+                self.result = self._make_result(len(data), True)
+                return
+        
+        logger.info(f"开始流式TTS转换: {self.text}")
+        chunks = []
+        size = 0
+        upstream = get_tts_client().stream(self.text, self.voice_type, self.speed_ratio)
+        try:
+            async for chunk in upstream:
+                size += len(chunk)
+                if self.tee:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            await upstream.aclose()
+        
+        if not size:
+            raise RuntimeError('TTS音频为空')
+        
+        if self.tee:
+            audio_data = b''.join(chunks)
+            await loop.run_in_executor(None, write_file, self.file_path, audio_data)
+            tts_cache.add(self.filename, audio_data)
+        logger.info(f"流式TTS转换成功: {self.filename}, 大小: {size} bytes")
+        self.result = self._make_result(size, False)
+    
+    def _make_result(self, size: int, cached: bool) -> dict:
+        return {
+            'success': True,
+            'filename': self.filename,
+            'file_path': self.file_path,
+            'file_size': size,
+            'text': self.text,
+            'cached': cached
+        }
+
 def test_tts():
     """测试TTS功能"""
     async def run_test():
@@ -0,0 +1,249 @@
+"""
+上游语音服务（ASR/TTS）的二进制帧编解码
+ASR客户端（sauc_websocket_demo.py）、TTS客户端（tts_service.py）和压测用的模拟服务（fake_upstreams.py）共用
+
+帧格式（大端序）:
+    字节0      协议版本(高4位) | 头部长度/4(低4位)
+    字节1      消息类型(高4位) | 类型相关标志(低4位)
+    字节2      序列化方式(高4位) | 压缩方式(低4位)
+    字节3      保留
+    之后依次为（按消息类型和标志出现）:
+               序号 int32      标志位0x01；TTS音频响应只要标志不为0就带序号
+               事件 int32      标志位0x04
+               错误码 int32    错误响应
+               payload大小 uint32
+               payload
+
+- 多字节字段预编译为struct.Struct，用unpack_from/pack_into按偏移读写，不切片
+- 解析结果中较大的payload是对原始消息的memoryview，不发生拷贝；
+  识别结果和较小的音频包直接切片，创建memoryview比拷贝这么少的数据更慢
+- 音频包一次分配整帧，头部、序号和大小一次写入
+"""
+
+import json
+import struct
+import zlib
+from typing import Any, Callable, Optional, Tuple, Union
+
+PROTOCOL_VERSION = 0b0001
+HEADER_WORDS = 1  # 头部长度为4字节
+
+
+class MessageType:
+    CLIENT_FULL_REQUEST = 0b0001
+    CLIENT_AUDIO_ONLY_REQUEST = 0b0010
+    SERVER_FULL_RESPONSE = 0b1001
+    SERVER_AUDIO_ONLY_RESPONSE = 0b1011  # TTS音频
+    SERVER_FRONTEND_RESPONSE = 0b1100  # TTS前端消息
+    SERVER_ERROR_RESPONSE = 0b1111
+
+
+class MessageTypeSpecificFlags:
+    NO_SEQUENCE = 0b0000
+    POS_SEQUENCE = 0b0001
+    NEG_SEQUENCE = 0b0010
+    NEG_WITH_SEQUENCE = 0b0011
+    WITH_EVENT = 0b0100
+
+
+class SerializationType:
+    NO_SERIALIZATION = 0b0000
+    JSON = 0b0001
+
+
+class CompressionType:
+    NO_COMPRESSION = 0b0000
+    GZIP = 0b0001
+
+
+INT32 = struct.Struct('>i')
+UINT32 = struct.Struct('>I')
+SEQUENCE_SIZE = struct.Struct('>iI')
+CODE_SIZE = struct.Struct('>iI')
+# 带序号的帧头: 头部 + 序号 + payload大小
+SEQUENCED_PREFIX = struct.Struct('>BBBBiI')
+# 不带序号的帧头: 头部 + payload大小
+UNSEQUENCED_PREFIX = struct.Struct('>BBBBI')
+
+FIRST_BYTE = (PROTOCOL_VERSION << 4) | HEADER_WORDS
+# 在可选的序号/事件之后紧跟payload大小的消息类型
+SIZED_MESSAGE_TYPES = frozenset((
+    MessageType.CLIENT_FULL_REQUEST, MessageType.CLIENT_AUDIO_ONLY_REQUEST,
+    MessageType.SERVER_FULL_RESPONSE, MessageType.SERVER_FRONTEND_RESPONSE,
+))
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+# 与gzip.compress的默认压缩级别相同
+GZIP_LEVEL = 9
+# zlib的wbits取16+15时读写gzip格式，比gzip模块少一层封装，且直接接受memoryview
+GZIP_WBITS = 31
+# payload不小于该字节数时解析为memoryview，否则切片拷贝（约16KB以下拷贝比创建memoryview更快）
+ZERO_COPY_MIN_BYTES = 16 * 1024
+
+
+def type_byte(message_type: int, flags: int) -> int:
+    return (message_type << 4) | flags
+
+
+def format_byte(serialization: int, compression: int) -> int:
+    return (serialization << 4) | compression
+
+
+def compress(data: BytesLike, compression: int = CompressionType.GZIP) -> BytesLike:
+    return zlib.compress(data, GZIP_LEVEL, GZIP_WBITS) if compression == CompressionType.GZIP else data
+
+
+# 编码函数：输入原始payload，返回(写入帧的payload, 压缩方式)，每帧可以各自选择是否压缩
+Encoder = Callable[[BytesLike], Tuple[BytesLike, int]]
+
+
+def gzip_encode(data: BytesLike) -> Tuple[BytesLike, int]:
+    return zlib.compress(data, GZIP_LEVEL, GZIP_WBITS), CompressionType.GZIP
+
+
+AUDIO_TYPE_BYTE = type_byte(MessageType.CLIENT_AUDIO_ONLY_REQUEST, MessageTypeSpecificFlags.POS_SEQUENCE)
+AUDIO_LAST_TYPE_BYTE = type_byte(MessageType.CLIENT_AUDIO_ONLY_REQUEST, MessageTypeSpecificFlags.NEG_WITH_SEQUENCE)
+
+
+def build_frame(message_type: int, flags: int, body: BytesLike, sequence: Optional[int] = None,
+                serialization: int = SerializationType.JSON,
+                compression: int = CompressionType.GZIP) -> bytearray:
+    """
+    构建一帧，body为已经压缩好的payload
+
+    Args:
+        sequence (int): 序号，为None时不写入序号字段
+    """
+    if sequence is None:
+        prefix = UNSEQUENCED_PREFIX
+        frame = bytearray(prefix.size + len(body))
+        prefix.pack_into(frame, 0, FIRST_BYTE, type_byte(message_type, flags),
+                         format_byte(serialization, compression), 0, len(body))
+    else:
+        prefix = SEQUENCED_PREFIX
+        frame = bytearray(prefix.size + len(body))
+        prefix.pack_into(frame, 0, FIRST_BYTE, type_byte(message_type, flags),
+                         format_byte(serialization, compression), 0, sequence, len(body))
+    frame[prefix.size:] = body
+    return frame
+
+
+def build_full_request(payload: dict, sequence: Optional[int] = None, encode: Encoder = gzip_encode) -> bytearray:
+    """
+    构建完整客户端请求（JSON payload）
+
+    Args:
+        payload (dict): 请求参数
+        sequence (int): ASR请求带正序号，TTS请求不带序号
+        encode: 压缩payload的编码函数，默认gzip
+    """
+    body, compression = encode(json.dumps(payload).encode('utf-8'))
+    flags = MessageTypeSpecificFlags.NO_SEQUENCE if sequence is None else MessageTypeSpecificFlags.POS_SEQUENCE
+    return build_frame(MessageType.CLIENT_FULL_REQUEST, flags, body, sequence, SerializationType.JSON, compression)
+
+
+def build_audio_request(sequence: int, segment: BytesLike, is_last: bool = False,
+                        encode: Encoder = gzip_encode) -> bytearray:
+    """
+    构建音频包，最后一包的序号取负
+
+    Args:
+        sequence (int): 包序号（正数）
+        segment: 音频数据，可以是memoryview
+        encode: 压缩payload的编码函数，默认gzip
+    """
+    # 音频包是最频繁的帧，头部字节预先算好，直接写入一次分配好的整帧
+    body, compression = encode(segment)
+    frame = bytearray(SEQUENCED_PREFIX.size + len(body))
+    # 音频包不做序列化，格式字节就是压缩方式
+    if is_last:
+        SEQUENCED_PREFIX.pack_into(frame, 0, FIRST_BYTE, AUDIO_LAST_TYPE_BYTE, compression, 0, -sequence, len(body))
+    else:
+        SEQUENCED_PREFIX.pack_into(frame, 0, FIRST_BYTE, AUDIO_TYPE_BYTE, compression, 0, sequence, len(body))
+    frame[SEQUENCED_PREFIX.size:] = body
+    return frame
+
+
+class Frame:
+    """解析后的一帧，payload较大时是对原始消息的memoryview"""
+
+    __slots__ = ('message_type', 'flags', 'serialization', 'compression',
+                 'sequence', 'event', 'code', 'payload_size', 'is_last', 'payload')
+
+    def __init__(self, message_type: int, flags: int, serialization: int, compression: int,
+                 sequence: int, event: int, code: int, payload_size: int, is_last: bool, payload: BytesLike):
+        self.message_type = message_type
+        self.flags = flags
+        self.serialization = serialization
+        self.compression = compression
+        self.sequence = sequence
+        self.event = event
+        self.code = code
+        self.payload_size = payload_size
+        self.is_last = is_last
+        self.payload = payload
+
+    def decompressed(self) -> BytesLike:
+        """解压后的payload"""
+        if self.compression == CompressionType.GZIP and self.payload:
+            return zlib.decompress(self.payload, GZIP_WBITS)
+        return self.payload
+
+    def decoded(self) -> Any:
+        """解压并按序列化方式解析后的payload，JSON以外原样返回"""
+        data = self.decompressed()
+        if self.serialization == SerializationType.JSON and data:
+            return json.loads(str(data, 'utf-8'))
+        return data
+
+
+def parse_frame(message: BytesLike) -> Frame:
+    """
+    解析一帧，客户端请求和服务端响应通用
+
+    Raises:
+        struct.error: 帧长度不足
+        IndexError: 帧头不完整
+    """
+    # 单个字节直接索引比unpack_from更快，多字节字段才用预编译的Struct，单值用元组解包而不是[0]
+    second = message[1]
+    message_type = second >> 4
+    flags = second & 0x0f
+    offset = (message[0] & 0x0f) * 4
+    sequence = event = code = payload_size = 0
+
+    if message_type == MessageType.SERVER_AUDIO_ONLY_RESPONSE:
+        # TTS音频：标志为0是不带数据的确认，其他情况都带序号，序号为负表示最后一包
+        if flags:
+            sequence, payload_size = SEQUENCE_SIZE.unpack_from(message, offset)
+            offset += SEQUENCE_SIZE.size
+        is_last = sequence < 0
+    else:
+        if flags & MessageTypeSpecificFlags.POS_SEQUENCE:
+            sequence, = INT32.unpack_from(message, offset)
+            offset += INT32.size
+        is_last = flags & MessageTypeSpecificFlags.NEG_SEQUENCE != 0
+        if flags & MessageTypeSpecificFlags.WITH_EVENT:
+            event, = INT32.unpack_from(message, offset)
+            offset += INT32.size
+
+        if message_type == MessageType.SERVER_ERROR_RESPONSE:
+            code, payload_size = CODE_SIZE.unpack_from(message, offset)
+            offset += CODE_SIZE.size
+        elif message_type in SIZED_MESSAGE_TYPES:
+            payload_size, = UINT32.unpack_from(message, offset)
+            offset += UINT32.size
+
+    third = message[2]
+    payload = memoryview(message)[offset:] if len(message) - offset >= ZERO_COPY_MIN_BYTES else message[offset:]
+    return Frame(message_type, flags, third >> 4, third & 0x0f, sequence, event, code, payload_size, is_last,
+                 payload)
+
+
+def split_segments(data: BytesLike, segment_size: int) -> list:
+    """把音频按固定大小分段，返回memoryview列表，不拷贝数据"""
+    if segment_size <= 0:
+        return []
+    view = memoryview(data)
+    return [view[i:i + segment_size] for i in range(0, len(view), segment_size)]
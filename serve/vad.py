@@ -0,0 +1,165 @@
+"""
+语音活动检测（VAD）和静音裁剪
+录音在送入ASR之前去掉首尾的静音，把过长的停顿缩短，完全没有人声的录音不再上传识别
+
+- 音频按20ms分帧，用NumPy向量化计算每帧的能量和过零率
+- 能量阈值随录音的底噪自适应，并限制在固定区间内；能量略低但过零率高的帧（清辅音）也算作人声
+- 人声帧向两侧各扩展PAD_MS，扩展后仍未覆盖的部分被丢弃：首尾只保留PAD_MS的静音，
+  超过2*PAD_MS的停顿缩短为2*PAD_MS
+- 未安装numpy或不是16bit单声道PCM WAV时原样返回
+"""
+
+import logging
+import time
+from typing import Optional, Tuple
+
+from audio_transcoder import parse_wav, build_wav, WAV_FORMAT_PCM
+from metrics import STAGE_SECONDS, VAD_AUDIO_SECONDS, VAD_NO_SPEECH
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+FRAME_MS = 20
+PAD_MS = 200  # 人声前后保留的静音，停顿最长保留2*PAD_MS
+MIN_SPEECH_MS = 100  # 人声帧总时长不足该值视为没有说话
+NOISE_PERCENTILE = 10  # 取能量的该百分位数作为底噪
+NOISE_MARGIN_DB = 12  # 人声比底噪至少高出的分贝数
+MIN_THRESHOLD_DB = -50  # 能量阈值的下限（dBFS），安静环境中也不会把细小噪声当作人声
+MAX_THRESHOLD_DB = -35  # 能量阈值的上限（dBFS），全程说话的录音不会因底噪估计偏高而被裁掉
+FRICATIVE_MARGIN_DB = 10  # 清辅音帧的能量可以比阈值低的分贝数
+FRICATIVE_ZCR = 0.25  # 清辅音帧的最低过零率
+
+VAD_STAGE_SECONDS = STAGE_SECONDS.labels('vad')
+VAD_INPUT_SECONDS = VAD_AUDIO_SECONDS.labels('input')
+VAD_DROPPED_SECONDS = VAD_AUDIO_SECONDS.labels('dropped')
+
+
+class NoSpeechError(Exception):
+    """录音中没有检测到人声"""
+
+    def __init__(self, result: 'VadResult'):
+        super().__init__(f"没有检测到人声（{result.input_ms}ms）")
+        self.result = result
+
+
+class VadResult:
+    """一段录音的检测结果"""
+
+    __slots__ = ('input_ms', 'output_ms', 'speech_ms', 'applied')
+
+    def __init__(self, input_ms: int = 0, output_ms: int = 0, speech_ms: int = 0, applied: bool = False):
+        self.input_ms = input_ms
+        self.output_ms = output_ms
+        self.speech_ms = speech_ms
+        self.applied = applied  # 为False表示格式不支持或未安装numpy，没有检测
+
+    @property
+    def dropped_ms(self) -> int:
+        return self.input_ms - self.output_ms
+
+    @property
+    def has_speech(self) -> bool:
+        return not self.applied or self.speech_ms >= MIN_SPEECH_MS
+
+    def to_dict(self) -> dict:
+        return {
+            'applied': self.applied,
+            'input_ms': self.input_ms,
+            'output_ms': self.output_ms,
+            'dropped_ms': self.dropped_ms,
+            'speech_ms': self.speech_ms
+        }
+
+
+def detect_speech(samples, sample_rate: int) -> Tuple[Optional[object], int]:
+    """
+    逐帧判断是否为人声
+
+    Args:
+        samples: int16样本数组
+        sample_rate (int): 采样率
+
+    Returns:
+        (每帧是否人声的布尔数组, 每帧样本数)，录音不足一帧时数组为None
+    """
+    frame_len = sample_rate * FRAME_MS // 1000
+    frame_count = len(samples) // frame_len
+    if frame_count == 0:
+        return None, frame_len
+
+    frames = samples[:frame_count * frame_len].reshape(frame_count, frame_len).astype(np.float32)
+    # 能量换算为相对满幅的dBFS，加上极小值避免对0取对数
+    energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) / (32768.0 * 32768.0) + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (frame_len - 1)
+
+    noise_db = np.percentile(energy_db, NOISE_PERCENTILE)
+    threshold = min(max(noise_db + NOISE_MARGIN_DB, MIN_THRESHOLD_DB), MAX_THRESHOLD_DB)
+    return (energy_db > threshold) | ((energy_db > threshold - FRICATIVE_MARGIN_DB) & (zcr > FRICATIVE_ZCR)), \
+        frame_len
+
+
+def keep_mask(speech, pad_frames: int):
+    """人声帧向两侧各扩展pad_frames帧，得到需要保留的帧"""
+    if pad_frames <= 0:
+        return speech
+    window = np.ones(2 * pad_frames + 1, dtype=np.int32)
+    return np.convolve(speech.astype(np.int32), window, mode='same') > 0
+
+
+def trim_silence(wav: bytes) -> Tuple[bytes, VadResult]:
+    """
+    裁剪录音中的静音
+
+    Args:
+        wav (bytes): 16bit单声道PCM WAV
+
+    Returns:
+        (裁剪后的WAV, 检测结果)，没有需要丢弃的部分时返回原WAV
+
+    Raises:
+        NoSpeechError: 没有检测到人声
+    """
+    info = parse_wav(wav)
+    if np is None or info is None:
+        return wav, VadResult()
+    audio_format, channels, sample_rate, bits, pcm = info
+    if audio_format != WAV_FORMAT_PCM or channels != 1 or bits != 16 or sample_rate <= 0:
+        return wav, VadResult()
+
+    start = time.perf_counter()
+    samples = np.frombuffer(pcm[:len(pcm) // 2 * 2], dtype='<i2')
+    input_ms = len(samples) * 1000 // sample_rate
+    speech, frame_len = detect_speech(samples, sample_rate)
+    if speech is None:
+        result = VadResult(input_ms, 0, 0, True)
+    else:
+        keep = keep_mask(speech, PAD_MS // FRAME_MS)
+        frame_count = len(keep)
+        frames = samples[:frame_count * frame_len].reshape(frame_count, frame_len)
+        kept = frames[keep].reshape(-1)
+        # 不足一帧的尾部跟随最后一帧
+        if keep[-1]:
+            kept = np.concatenate((kept, samples[frame_count * frame_len:]))
+        result = VadResult(input_ms, len(kept) * 1000 // sample_rate,
+                           int(np.count_nonzero(speech)) * FRAME_MS, True)
+    VAD_STAGE_SECONDS.observe(time.perf_counter() - start)
+    VAD_INPUT_SECONDS.inc(result.input_ms / 1000)
+
+    if not result.has_speech:
+        VAD_NO_SPEECH.inc()
+        VAD_DROPPED_SECONDS.inc(result.input_ms / 1000)
+        result.output_ms = 0
+        logger.info(f"VAD: 没有检测到人声，丢弃 {result.input_ms}ms 录音")
+        raise NoSpeechError(result)
+
+    VAD_DROPPED_SECONDS.inc(result.dropped_ms / 1000)
+    logger.info(f"VAD: 录音 {result.input_ms}ms，人声 {result.speech_ms}ms，"
+                f"保留 {result.output_ms}ms，丢弃 {result.dropped_ms}ms")
+    if result.dropped_ms <= 0:
+        return wav, result
+    return build_wav(kept.tobytes(), sample_rate), result
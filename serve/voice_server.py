@@ -4,44 +4,55 @@ import os
 import uuid
 import logging
 import asyncio
-import subprocess
 import sys
+import time
+import atexit
 from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, File, Field, Data, Epilogue, NEED_DATA
+
+from admission import deadline_scope, time_left
+from metrics import registry, CONTENT_TYPE, REQUEST_SECONDS, DEADLINE_EXCEEDED
+from storage import upload_store, run_gc, STORAGE_GC
+from vad import NoSpeechError
+
+# 配置日志（下面的可选模块导入失败时需要记录警告）
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # 导入语音识别模块
 try:
-    from sauc_websocket_demo import AsrWsClient
+    from sauc_websocket_demo import AsrWsClient, AsrConnectionPool
 except ImportError:
     logger.warning("无法导入语音识别模块，请确保sauc_websocket_demo.py文件存在")
     AsrWsClient = None
+    AsrConnectionPool = None
 
 # 导入AI对话模块
 try:
-    from chart import get_ai_response
+    from chart import get_ai_response_async, close_llm_client
 except ImportError:
     logger.warning("无法导入AI对话模块，请确保chart.py文件存在")
-    get_ai_response = None
+    get_ai_response_async = None
+    close_llm_client = None
 
 # 导入TTS服务模块
 try:
-    from tts_service import generate_speech
+    from tts_service import generate_speech, close_tts_client, tts_cache
 except ImportError:
     logger.warning("无法导入TTS服务模块，请确保tts_service.py文件存在")
     generate_speech = None
-
-# 配置日志
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+    close_tts_client = None
+    tts_cache = None
 
 app = Flask(__name__)
 CORS(app)  # 允许跨域请求
 
 # 配置上传文件夹
-UPLOAD_FOLDER = 'uploads/audio'
-REPLY_AUDIO_FOLDER = 'reply_video'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+UPLOAD_FOLDER = upload_store.directory
+REPLY_AUDIO_FOLDER = tts_cache.store.directory if tts_cache is not None else 'reply_video'
 if not os.path.exists(REPLY_AUDIO_FOLDER):
     os.makedirs(REPLY_AUDIO_FOLDER)
 
@@ -49,11 +60,83 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 限制文件大小为16MB
 
 # ASR配置
-ASR_URL = "wss://openspeech.bytedance.com/api/v3/sauc/bigmodel_nostream"
-ASR_SEGMENT_DURATION = 200
+ASR_URL = os.environ.get("HUOHUO_ASR_URL", "wss://openspeech.bytedance.com/api/v3/sauc/bigmodel_nostream")
+ASR_SEGMENT_DURATION = None  # None表示按音频时长和发送模式自动分段
+ASR_PACING = 'burst'  # 已录完的音频无需模拟实时发送：realtime / burst / adaptive
+ASR_VAD = os.environ.get("HUOHUO_ASR_VAD", "1") != "0"  # 识别前裁剪静音，没有人声时不上传识别
+
+# 一次语音请求（识别+对话+合成）的总时限（秒），各阶段只能使用剩余的时间
+VOICE_REQUEST_TIMEOUT = float(os.environ.get("HUOHUO_VOICE_REQUEST_TIMEOUT", "50"))
+VOICE_REQUEST_SECONDS = REQUEST_SECONDS.labels('voice_http')
+
+# 异步模式：所有请求的处理流程提交到同一个长期运行的后台事件循环，共用ASR连接池和TTS/LLM客户端的连接；
+# 设为0时每个请求使用独立的事件循环，结束后关闭其中的连接
+VOICE_ASYNC = os.environ.get("HUOHUO_VOICE_ASYNC", "1") != "0"
+ASR_POOL_SIZE = 2  # 预热的ASR连接数
+ASR_POOL_MAX_IDLE = 30  # 预热连接最长空闲秒数
+UPLOAD_CHUNK_SIZE = 64 * 1024  # 接收上传音频时每次读取的字节数
+
+class BackgroundLoop:
+    """
+    在后台线程中长期运行的事件循环
+    
+    Flask的请求线程用run()把协程提交给它并等待结果。TTS/LLM客户端按事件循环缓存，
+    因此所有请求共用同一组客户端和其中的连接；ASR连接池也只有一个
+    """
+    
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = Lock()
+        self.asr_pool = AsrConnectionPool(ASR_URL, ASR_POOL_SIZE, ASR_POOL_MAX_IDLE) \
+            if AsrConnectionPool is not None else None
+    
+    def start(self) -> asyncio.AbstractEventLoop:
+        """第一次使用时启动后台线程"""
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = Thread(target=self._run, args=(self.loop,), name='voice-loop', daemon=True)
+                self.thread.start()
+            return self.loop
+    
+    def _run(self, loop: asyncio.AbstractEventLoop) -> None:
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+    
+    def run(self, coro):
+        """在后台循环中运行协程并返回结果，调用线程等待期间被中断时取消该协程"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.start())
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+    
+    def stop(self) -> None:
+        """关闭循环上的客户端和连接池，然后停止后台线程"""
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_clients(), loop).result(timeout=10)
+        except Exception as e:
+            logger.warning(f"关闭后台事件循环上的客户端失败: {e}")
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join(timeout=10)
+        loop.close()
+    
+    async def _close_clients(self) -> None:
+        if self.asr_pool is not None:
+            await self.asr_pool.close()
+        await close_loop_clients()
 
-async def process_audio_with_asr(file_path: str) -> dict:
-    """使用ASR处理音频文件"""
+background_loop = BackgroundLoop()
+atexit.register(background_loop.stop)
+
+async def process_audio_with_asr(file_path: str, asr_pool=None) -> dict:
+    """使用ASR处理音频文件，asr_pool为共用的ASR连接池"""
     try:
         if AsrWsClient is None:
             logger.warning("语音识别服务不可用")
@@ -62,7 +145,7 @@ async def process_audio_with_asr(file_path: str) -> dict:
         logger.info(f"开始处理音频文件: {file_path}")
         
         # 创建ASR客户端
-        async with AsrWsClient(ASR_URL, ASR_SEGMENT_DURATION) as client:
+        async with AsrWsClient(ASR_URL, ASR_SEGMENT_DURATION, ASR_PACING, vad=ASR_VAD, pool=asr_pool) as client:
             responses = []
             async for response in client.execute(file_path):
                 responses.append(response.to_dict())
@@ -79,36 +162,70 @@ async def process_audio_with_asr(file_path: str) -> dict:
             return {
                 'success': True,
                 'recognized_text': recognized_text.strip(),
-                'raw_responses': responses
+                'raw_responses': responses,
+                'vad': client.vad_result.to_dict() if client.vad_result is not None else None
             }
             
+    except NoSpeechError as e:
+        # 没有人声时识别结果为空，后续流程按没听清处理
+        logger.info(f"录音中没有人声: {file_path}")
+        return {'success': True, 'recognized_text': '', 'raw_responses': [], 'vad': e.result.to_dict()}
     except Exception as e:
         logger.error(f"ASR处理失败: {str(e)}")
         return {'success': False, 'error': str(e)}
 
-def run_asr_in_thread(file_path: str, result_container: dict):
-    """在线程中运行ASR处理"""
-    try:
-        # 在新的事件循环中运行ASR
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(process_audio_with_asr(file_path))
-        result_container.update(result)
-        loop.close()
-    except Exception as e:
-        logger.error(f"线程ASR处理失败: {str(e)}")
-        result_container.update({'success': False, 'error': str(e)})
-
 def process_voice_to_ai_reply(file_path: str) -> dict:
     """
     完整的语音处理流程：语音识别 -> AI对话 -> TTS语音合成 -> 返回结果
     
+    整个流程共用VOICE_REQUEST_TIMEOUT秒的时限，超时的阶段被取消（关闭上游连接），不会在返回后继续运行。
+    异步模式下在后台事件循环中运行，否则在本次请求独立的事件循环中运行
+    
     Args:
         file_path (str): 音频文件路径
     
     Returns:
         dict: 包含语音识别结果、AI回复和TTS语音文件的字典
     """
+    if VOICE_ASYNC:
+        return background_loop.run(voice_to_ai_reply_async(file_path, background_loop.asr_pool))
+    return asyncio.run(run_voice_pipeline(file_path))
+
+async def run_voice_pipeline(file_path: str) -> dict:
+    """在本次请求的事件循环中运行处理流程，结束后释放该循环上的客户端"""
+    try:
+        return await voice_to_ai_reply_async(file_path)
+    finally:
+        # 事件循环即将关闭，释放该循环上客户端持有的连接
+        await close_loop_clients()
+
+async def close_loop_clients() -> None:
+    """关闭当前事件循环上的TTS和LLM客户端"""
+    if close_llm_client is not None:
+        await close_llm_client()
+    if close_tts_client is not None:
+        await close_tts_client()
+
+async def run_stage(stage: str, coro):
+    """
+    在请求剩余的时间内运行一个阶段
+    
+    Raises:
+        asyncio.TimeoutError: 剩余时间用完，该阶段已被取消
+    """
+    remaining = time_left()
+    if remaining is not None and remaining <= 0:
+        coro.close()
+        DEADLINE_EXCEEDED.labels(stage).inc()
+        raise asyncio.TimeoutError()
+    try:
+        return await asyncio.wait_for(coro, remaining)
+    except asyncio.TimeoutError:
+        DEADLINE_EXCEEDED.labels(stage).inc()
+        raise
+
+async def voice_to_ai_reply_async(file_path: str, asr_pool=None) -> dict:
+    """process_voice_to_ai_reply的异步实现，asr_pool为共用的ASR连接池"""
     result = {
         'asr_success': False,
         'ai_success': False,
@@ -118,127 +235,183 @@ def process_voice_to_ai_reply(file_path: str) -> dict:
         'tts_file': None,
         'error': None
     }
+    start = time.perf_counter()
+    timed_out = False
     
-    # 步骤1：进行语音识别
-    if AsrWsClient is not None:
-        try:
-            logger.info(f"开始语音识别: {file_path}")
-            
-            asr_container = {}
-            asr_thread = Thread(target=run_asr_in_thread, args=(file_path, asr_container))
-            asr_thread.daemon = True
-            asr_thread.start()
-            asr_thread.join(timeout=30)  # 最多等待30秒
-            
-            if asr_container and asr_container.get('success'):
-                result['asr_success'] = True
-                result['recognized_text'] = asr_container.get('recognized_text', '')
-                logger.info(f"语音识别成功: {result['recognized_text']}")
-            else:
-                result['error'] = asr_container.get('error', '语音识别超时或失败')
-                logger.warning(f"语音识别失败: {result['error']}")
-                
-        except Exception as e:
-            result['error'] = f'语音识别异常: {str(e)}'
-            logger.error(result['error'])
-    else:
-        result['error'] = '语音识别服务不可用'
-    
-    # 步骤2：如果语音识别成功，调用AI模型
-    if result['asr_success'] and result['recognized_text'].strip():
-        if get_ai_response is not None:
-            try:
-                logger.info(f"调用AI模型，输入: {result['recognized_text']}")
+    try:
+        with deadline_scope(VOICE_REQUEST_TIMEOUT):
+            # 步骤1：进行语音识别
+            if AsrWsClient is not None:
+                try:
+                    logger.info(f"开始语音识别: {file_path}")
                 
-                ai_result = get_ai_response(result['recognized_text'])
+                    asr_result = await run_stage('asr', process_audio_with_asr(file_path, asr_pool))
                 
-                if ai_result['success']:
-                    result['ai_success'] = True
-                    result['ai_reply'] = ai_result['ai_reply']
-                    logger.info(f"AI回复成功: {result['ai_reply']}")
-                else:
-                    result['ai_reply'] = ai_result.get('ai_reply', '抱歉，我现在有点问题，请稍后再试~')
-                    logger.warning(f"AI回复失败: {ai_result.get('error', '未知错误')}")
+                    if asr_result.get('success'):
+                        result['asr_success'] = True
+                        result['recognized_text'] = asr_result.get('recognized_text', '')
+                        logger.info(f"语音识别成功: {result['recognized_text']}")
+                    else:
+                        result['error'] = asr_result.get('error', '语音识别失败')
+                        logger.warning(f"语音识别失败: {result['error']}")
                     
-            except Exception as e:
-                result['ai_reply'] = '抱歉，我现在有点忙，请稍后再试~'
-                logger.error(f"AI对话异常: {str(e)}")
-        else:
-            result['ai_reply'] = '抱歉，AI对话服务不可用。'
-            logger.warning("AI对话服务不可用")
-    else:
-        # 语音识别失败或识别结果为空时，不提供AI回复
-        logger.info("语音识别失败或结果为空，跳过AI回复和TTS处理")
-        result['ai_reply'] = ''  # 设置为空字符串，表示不需要AI回复
-        return result  # 直接返回，不进行TTS处理
-    
-    # 步骤3：将AI回复转换为语音（TTS）
-    if result['ai_reply'] and generate_speech is not None:
-        try:
-            logger.info(f"开始TTS转换: {result['ai_reply']}")
-            
-            # 在线程中执行TTS处理
-            tts_container = {}
-            tts_thread = Thread(target=run_tts_in_thread, args=(result['ai_reply'], tts_container))
-            tts_thread.daemon = True
-            tts_thread.start()
-            tts_thread.join(timeout=20)  # 最多等待20秒
-            
-            if tts_container and tts_container.get('success'):
-                result['tts_success'] = True
-                result['tts_file'] = tts_container
-                logger.info(f"TTS转换成功: {tts_container.get('filename')}")
+                except asyncio.TimeoutError:
+                    result['error'] = '语音识别超时'
+                    logger.warning(f"语音识别超时，已取消: {file_path}")
+                except Exception as e:
+                    result['error'] = f'语音识别异常: {str(e)}'
+                    logger.error(result['error'])
+            else:
+                result['error'] = '语音识别服务不可用'
+        
+            # 步骤2：如果语音识别成功，调用AI模型
+            if result['asr_success'] and result['recognized_text'].strip():
+                if get_ai_response_async is not None:
+                    try:
+                        logger.info(f"调用AI模型，输入: {result['recognized_text']}")
+                    
+                        ai_result = await run_stage('llm', get_ai_response_async(result['recognized_text']))
+                    
+                        if ai_result['success']:
+                            result['ai_success'] = True
+                            result['ai_reply'] = ai_result['ai_reply']
+                            logger.info(f"AI回复成功: {result['ai_reply']}")
+                        else:
+                            result['ai_reply'] = ai_result.get('ai_reply', '抱歉，我现在有点问题，请稍后再试~')
+                            logger.warning(f"AI回复失败: {ai_result.get('error', '未知错误')}")
+                        
+                    except asyncio.TimeoutError:
+                        timed_out = True
+                        result['ai_reply'] = '抱歉，我现在有点忙，请稍后再试~'
+                        logger.warning("AI对话超时，已取消")
+                    except Exception as e:
+                        result['ai_reply'] = '抱歉，我现在有点忙，请稍后再试~'
+                        logger.error(f"AI对话异常: {str(e)}")
+                else:
+                    result['ai_reply'] = '抱歉，AI对话服务不可用。'
+                    logger.warning("AI对话服务不可用")
             else:
-                logger.warning(f"TTS转换失败: {tts_container.get('error', 'TTS超时')}")
+                # 语音识别失败或识别结果为空时，不提供AI回复
+                logger.info("语音识别失败或结果为空，跳过AI回复和TTS处理")
+                result['ai_reply'] = ''  # 设置为空字符串，表示不需要AI回复
+                return result  # 直接返回，不进行TTS处理
+        
+            # 步骤3：将AI回复转换为语音（TTS），时间已经用完时只返回文字
+            if result['ai_reply'] and generate_speech is not None and not timed_out:
+                try:
+                    logger.info(f"开始TTS转换: {result['ai_reply']}")
                 
-        except Exception as e:
-            logger.error(f"TTS处理异常: {str(e)}")
-    else:
-        if generate_speech is None:
-            logger.warning("TTS服务不可用")
-    
+                    tts_result = await run_stage('tts', generate_speech(result['ai_reply']))
+                
+                    if tts_result.get('success'):
+                        result['tts_success'] = True
+                        result['tts_file'] = tts_result
+                        logger.info(f"TTS转换成功: {tts_result.get('filename')}")
+                    else:
+                        logger.warning(f"TTS转换失败: {tts_result.get('error', '未知错误')}")
+                    
+                except asyncio.TimeoutError:
+                    logger.warning("TTS转换超时，已取消")
+                except Exception as e:
+                    logger.error(f"TTS处理异常: {str(e)}")
+            else:
+                if generate_speech is None:
+                    logger.warning("TTS服务不可用")
+    finally:
+        VOICE_REQUEST_SECONDS.observe(time.perf_counter() - start)
     return result
 
-def run_tts_in_thread(text: str, result_container: dict):
-    """在线程中运行TTS处理"""
-    try:
-        # 在新的事件循环中运行TTS
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(generate_speech(text))
-        result_container.update(result)
-        loop.close()
-    except Exception as e:
-        logger.error(f"线程TTS处理失败: {str(e)}")
-        result_container.update({'success': False, 'error': str(e)})
+def receive_audio(file_path: str) -> int:
+    """
+    把请求中的音频边接收边写入文件，不在内存或临时文件中缓存整个上传
+    
+    支持multipart/form-data中的audio字段，以及Content-Type为audio/*、直接作为请求体上传的音频
+    
+    Args:
+        file_path (str): 保存的文件路径
+    
+    Returns:
+        int: 文件大小
+    
+    Raises:
+        ValueError: 请求中没有音频文件，或上传的数据不完整
+        RequestEntityTooLarge: 超过MAX_CONTENT_LENGTH
+    """
+    content_type, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if content_type.startswith('audio/'):
+        size = 0
+        with open(file_path, 'wb') as output:
+            for chunk in iter(lambda: request.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                output.write(chunk)
+                size += len(chunk)
+        return size
+    if content_type != 'multipart/form-data' or not options.get('boundary'):
+        raise ValueError('没有音频文件')
+    
+    decoder = MultipartDecoder(options['boundary'].encode('latin-1'))
+    size = None  # 遇到audio字段后开始计数
+    writing = False
+    with open(file_path, 'wb') as output:
+        finished = False
+        while not finished:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            while True:
+                try:
+                    event = decoder.next_event()
+                except ValueError as e:
+                    raise ValueError('上传的数据不完整') from e
+                if event is NEED_DATA:
+                    break
+                if isinstance(event, File):
+                    if event.name == 'audio' and size is None:
+                        if not event.filename:
+                            raise ValueError('没有选择文件')
+                        size = 0
+                        writing = True
+                    else:
+                        writing = False
+                elif isinstance(event, Field):
+                    writing = False
+                elif isinstance(event, Data) and writing:
+                    output.write(event.data)
+                    size += len(event.data)
+                elif isinstance(event, Epilogue):
+                    finished = True
+                    break
+            if not chunk and not finished:
+                raise ValueError('上传的数据不完整')
+    if size is None:
+        raise ValueError('没有音频文件')
+    return size
 
 @app.route('/api/upload_audio', methods=['POST'])
 def upload_audio():
     """接收并保存音频文件，然后进行语音识别和AI对话"""
     try:
-        if 'audio' not in request.files:
-            return jsonify({'error': '没有音频文件'}), 400
-        
-        audio_file = request.files['audio']
-        
-        if audio_file.filename == '':
-            return jsonify({'error': '没有选择文件'}), 400
-        
         # 生成唯一文件名
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         unique_id = str(uuid.uuid4())[:8]
         filename = f"voice_{timestamp}_{unique_id}.mp3"
         
-        # 保存文件
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        audio_file.save(file_path)
+        # 边接收边保存文件
+        file_path = upload_store.path_for(filename, create=True)
+        try:
+            file_size = receive_audio(file_path)
+        except (ValueError, RequestEntityTooLarge) as e:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            if isinstance(e, RequestEntityTooLarge):
+                return jsonify({'error': '文件过大'}), 413
+            return jsonify({'error': str(e)}), 400
         
         # 记录文件信息
-        file_size = os.path.getsize(file_path)
+        upload_store.add(filename, file_size)
         logger.info(f"音频文件已保存: {filename}, 大小: {file_size} bytes")
         
-        # 进行完整的语音处理流程（语音识别 + AI对话）
-        voice_result = process_voice_to_ai_reply(file_path)
+        # 进行完整的语音处理流程（语音识别 + AI对话），处理期间文件不会被回收
+        with upload_store.lease(filename):
+            voice_result = process_voice_to_ai_reply(file_path)
         
         # 构建返回结果
         response_data = {
@@ -274,19 +447,12 @@ def upload_audio():
 def list_audio_files():
     """获取已上传的音频文件列表"""
     try:
-        files = []
-        upload_dir = app.config['UPLOAD_FOLDER']
-        
-        if os.path.exists(upload_dir):
-            for filename in os.listdir(upload_dir):
-                if filename.endswith('.mp3'):
-                    file_path = os.path.join(upload_dir, filename)
-                    file_stat = os.stat(file_path)
-                    files.append({
-                        'filename': filename,
-                        'size': file_stat.st_size,
-                        'created_time': datetime.fromtimestamp(file_stat.st_ctime).strftime('%Y-%m-%d %H:%M:%S')
-                    })
+        # 从内存索引读取，不遍历目录
+        files = [{
+            'filename': filename,
+            'size': size,
+            'created_time': datetime.fromtimestamp(created).strftime('%Y-%m-%d %H:%M:%S')
+        } for filename, size, created in upload_store.list_files('.mp3')]
         
         return jsonify({
             'success': True,
@@ -307,15 +473,16 @@ def recognize_audio():
             return jsonify({'error': '缺少文件名参数'}), 400
         
         filename = data['filename']
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        file_path = upload_store.path_for(filename)
         
-        if not os.path.exists(file_path):
-            return jsonify({'error': f'文件不存在: {filename}'}), 404
-        
-        logger.info(f"手动进行语音处理: {file_path}")
-        
-        # 进行完整的语音处理流程
-        voice_result = process_voice_to_ai_reply(file_path)
+        with upload_store.lease(filename) as acquired:
+            if not acquired or not os.path.exists(file_path):
+                return jsonify({'error': f'文件不存在: {filename}'}), 404
+            
+            logger.info(f"手动进行语音处理: {file_path}")
+            
+            # 进行完整的语音处理流程
+            voice_result = process_voice_to_ai_reply(file_path)
         
         # 构建返回结果
         response_data = {
@@ -344,6 +511,11 @@ def recognize_audio():
         logger.error(f"语音处理失败: {str(e)}")
         return jsonify({'error': f'语音处理失败: {str(e)}'}), 500
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus文本格式的运行指标"""
+    return registry.render(), 200, {'Content-Type': CONTENT_TYPE}
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """健康检查接口"""
@@ -357,14 +529,17 @@ def health_check():
 def serve_audio_file(filename):
     """提供音频文件访问服务"""
     try:
-        # 检查文件是否在reply_video目录中
+        # 按文件名在两个存储中查找，持有租约直到文件被打开
+        stores = [upload_store] if tts_cache is None else [tts_cache.store, upload_store]
+        for store in stores:
+            with store.lease(filename) as acquired:
+                if acquired:
+                    file_path = store.path_for(filename)
+                    return send_from_directory(os.path.dirname(file_path), filename, as_attachment=False)
+        # 旧版本直接放在reply_video目录下的文件
         if os.path.exists(os.path.join(REPLY_AUDIO_FOLDER, filename)):
             return send_from_directory(REPLY_AUDIO_FOLDER, filename, as_attachment=False)
-        # 检查文件是否在uploads/audio目录中
-        elif os.path.exists(os.path.join(UPLOAD_FOLDER, filename)):
-            return send_from_directory(UPLOAD_FOLDER, filename, as_attachment=False)
-        else:
-            return jsonify({'error': '文件不存在'}), 404
+        return jsonify({'error': '文件不存在'}), 404
     except Exception as e:
         logger.error(f"提供音频文件时发生错误: {str(e)}")
         return jsonify({'error': f'文件访问失败: {str(e)}'}), 500
@@ -379,6 +554,7 @@ if __name__ == '__main__':
     print("   GET  /api/audio_files     - 获取音频文件列表")
     print("   GET  /api/audio/<filename> - 访问音频文件")
     print("   GET  /api/health          - 健康检查")
+    print("   GET  /metrics             - 运行指标")
     
     # 检查服务状态
     print("\n 服务状态检查:")
@@ -387,7 +563,7 @@ if __name__ == '__main__':
     else:
         print("   ✅ 语音识别: 服务已加载")
         
-    if get_ai_response is None:
+    if get_ai_response_async is None:
         print("   ⚠️  AI对话: 服务不可用")
     else:
         print("   ✅ AI对话: 服务已加载")
@@ -397,5 +573,18 @@ if __name__ == '__main__':
     else:
         print("   ✅ TTS语音合成: 服务已加载")
     
+    if VOICE_ASYNC:
+        print("   ✅ 异步模式: 所有请求共用后台事件循环和上游连接")
+    else:
+        print("   ⚠️  异步模式: 已关闭，每个请求使用独立的事件循环")
+    
+    # 建立音频文件索引（迁移旧文件），之后在后台回收过期和超出容量的文件。
+    # 索引和租约只在本进程内有效，与websocket_server同时运行时只应让其中一个回收，见storage.py
+    gc_stores = [upload_store] if tts_cache is None else [upload_store, tts_cache.store]
+    for store in gc_stores:
+        store.scan()
+    if STORAGE_GC:
+        Thread(target=asyncio.run, args=(run_gc(gc_stores),), daemon=True).start()
+    
     print("\n 服务启动中...")
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
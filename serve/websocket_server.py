@@ -5,32 +5,49 @@ import base64
 import os
 import uuid
 import logging
-import threading
 import time
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-import socketserver
-from urllib.parse import urlparse
+from aiohttp import web
 
 # 导入现有模块
 try:
-    from sauc_websocket_demo import AsrWsClient
+    from sauc_websocket_demo import AsrWsClient, AsrConnectionPool, asr_audio_compression, asr_control_compression
 except ImportError:
     print("无法导入语音识别模块，请确保sauc_websocket_demo.py文件存在")
     AsrWsClient = None
+    AsrConnectionPool = None
 
 try:
-    from chart import get_ai_response
+    from chart import get_ai_response_async, stream_ai_response, SentenceSplitter, get_llm_client, close_llm_client
+    from character_config import parse_emotion_from_reply
+    from chart import summarize_conversation
 except ImportError:
     print("无法导入AI对话模块，请确保chart.py文件存在")
-    get_ai_response = None
+    get_ai_response_async = None
+    stream_ai_response = None
+    get_llm_client = None
 
 try:
-    from tts_service import generate_speech
+    from tts_service import (generate_speech, tts_cache, SpeechStream, read_file, write_file, get_tts_client,
+                             close_tts_client)
 except ImportError:
     print("无法导入TTS服务模块，请确保tts_service.py文件存在")
     generate_speech = None
+    get_tts_client = None
+    close_tts_client = None
+    tts_cache = None
+    SpeechStream = None
+
+from audio_transcoder import get_transcoder
+from conversation import ConversationMemory
+from metrics import (registry, STAGE_SECONDS, REQUEST_SECONDS, UPSTREAM_IN_FLIGHT, CONNECTED_CLIENTS,
+                     QUEUE_DEPTH, CONTENT_TYPE, record_upstream_error)
+from storage import upload_store, run_gc, STORAGE_GC
+from vad import NoSpeechError
+from admission import StageLimiter, BusyError, deadline_scope
+from rate_limit import get_outbound_stats
+from emotion_assets import get_emotion_assets
+from ws_protocol import parse_client_frame, build_frame, FrameKind, AudioCodec, CODEC_EXTENSIONS
 
 # 配置日志
 logging.basicConfig(
@@ -44,124 +61,369 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # 配置
-UPLOAD_FOLDER = 'uploads/audio'
-REPLY_AUDIO_FOLDER = 'reply_video'
+UPLOAD_FOLDER = upload_store.directory
+REPLY_AUDIO_FOLDER = tts_cache.store.directory if tts_cache is not None else 'reply_video'
 EMOTION_IMG_FOLDER = 'emotion_img'  # 情绪图片文件夹
-ASR_URL = "wss://openspeech.bytedance.com/api/v3/sauc/bigmodel_nostream"
-ASR_SEGMENT_DURATION = 200
+# 上游地址和监听端口可通过环境变量修改（例如压测时指向本地模拟服务，见benchmark.py）
+ASR_URL = os.environ.get("HUOHUO_ASR_URL", "wss://openspeech.bytedance.com/api/v3/sauc/bigmodel_nostream")
+ASR_SEGMENT_DURATION = None  # None表示按音频时长和发送模式自动分段
+ASR_PACING = 'burst'  # 已录完的音频无需模拟实时发送：realtime / burst / adaptive
+ASR_STREAM_FINAL_TIMEOUT = 10  # 录音结束后等待最终识别结果的秒数
+STREAM_MAX_BYTES = 16 * 1024 * 1024  # 一次边录边传的录音最多接收的字节数，与单条消息的上限相同
+STREAM_QUEUE_CHUNKS = 256  # 等待转发给识别服务的录音片段数上限
+MAX_STREAMS_PER_CLIENT = 2  # 每个连接同时进行的录音会话数上限
+ASR_POOL_SIZE = 2  # 预热的ASR连接数
+ASR_POOL_MAX_IDLE = 30  # 预热连接最长空闲秒数
+# 识别前裁剪录音首尾静音、缩短长停顿，没有人声时直接回复没听清（边录边传的会话不经过该步骤）
+ASR_VAD = os.environ.get("HUOHUO_ASR_VAD", "1") != "0"
+# 录音在内存中完成转码和识别，同时在后台另存一份到上传目录以便审计，设为0时不落盘
+UPLOAD_SPILL = os.environ.get("HUOHUO_UPLOAD_SPILL", "1") != "0"
+LLM_MAX_CONCURRENCY = 16  # 同时进行的AI请求数上限，超出的请求排队等待
+# 准入控制（见admission.py）：同时处理数:排队上限[:最长排队秒数]，排不上时立即回复busy
+TURN_ADMISSION = os.environ.get("HUOHUO_ADMISSION_TURN", "64:64:10")  # 整轮对话，限制同时驻留内存的录音
+ASR_ADMISSION = os.environ.get("HUOHUO_ADMISSION_ASR", "16:32:5")  # 包括转码和VAD
+LLM_ADMISSION = os.environ.get("HUOHUO_ADMISSION_LLM", f"{LLM_MAX_CONCURRENCY}:32:5")
+TTS_ADMISSION = os.environ.get("HUOHUO_ADMISSION_TTS", "16:64:5")  # 逐句回复时一轮对话会同时合成多句
+# 一轮对话从收到消息起，在各阶段排队的截止秒数
+TURN_QUEUE_DEADLINE = float(os.environ.get("HUOHUO_TURN_QUEUE_DEADLINE", 10))
+TURN_CANCEL_TIMEOUT = 2.0  # 打断时等待上一轮清理（关闭TTS流、归还名额）的最长秒数
+
+# WebSocket和HTTP文件服务配置
+WS_HOST = 'localhost'
+WS_PORT = int(os.environ.get('HUOHUO_WS_PORT', 8765))
+HTTP_HOST = 'localhost'
+HTTP_PORT = int(os.environ.get('HUOHUO_HTTP_PORT', 5000))
+EMOTION_IMG_CACHE_CONTROL = 'public, max-age=2592000'  # 情绪图片缓存30天
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # 按内容寻址的TTS缓存文件、带版本号的情绪图片
+REVALIDATE_CACHE_CONTROL = 'no-cache'  # 其他文件每次用ETag验证
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type, Range',
+    'Access-Control-Expose-Headers': 'Content-Length, Content-Range, ETag',
+}
+
+# 客户端选项及默认值，可通过config消息或单条消息中的同名字段修改
+CLIENT_OPTIONS = {
+    'stream_audio': False,  # 回复语音通过二进制帧流式下发
+    'stream_reply': False,  # AI回复逐句生成并合成语音
+    'emotion_asset': False,  # 回复附带情绪图片的资源ID和内容哈希
+}
+
+# 支持边录边传的音频编码 -> ASR音频格式(format, codec)
+# webm等识别服务不支持的格式会先缓存，录音结束后走完整识别流程
+STREAMING_ASR_FORMATS = {
+    AudioCodec.PCM: ('pcm', 'raw'),
+    AudioCodec.WAV: ('wav', 'raw'),
+    AudioCodec.OGG: ('ogg', 'opus'),
+    AudioCodec.MP3: ('mp3', 'raw'),
+}
 
 # 确保目录存在
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(REPLY_AUDIO_FOLDER, exist_ok=True)
 os.makedirs(EMOTION_IMG_FOLDER, exist_ok=True)
 
 # 连接管理
 connected_clients = set()
-executor = ThreadPoolExecutor(max_workers=4)
+client_memories = {}  # 各连接的对话历史，供统计接口汇总
+asr_pool = None  # ASR连接池，在start_server中创建
+gc_task = None  # 上传录音和TTS缓存的后台回收任务，在start_server中创建
+spill_tasks = set()  # 尚未写完的录音落盘任务，持有引用避免被回收，关闭时等待写完
+
+# 热路径上使用的指标
+SAVE_SECONDS = STAGE_SECONDS.labels('save')
+ASR_SECONDS = STAGE_SECONDS.labels('asr')
+LLM_SECONDS = STAGE_SECONDS.labels('llm')
+LLM_FIRST_TOKEN_SECONDS = STAGE_SECONDS.labels('llm_first_token')
+TTS_SECONDS = STAGE_SECONDS.labels('tts')
+SEND_SECONDS = STAGE_SECONDS.labels('send')
+ASR_IN_FLIGHT = UPSTREAM_IN_FLIGHT.labels('asr')
+
+# 各阶段的准入控制
+turn_admission = StageLimiter.parse('turn', TURN_ADMISSION)
+asr_admission = StageLimiter.parse('asr', ASR_ADMISSION)
+llm_admission = StageLimiter.parse('llm', LLM_ADMISSION)
+tts_admission = StageLimiter.parse('tts', TTS_ADMISSION)
+ADMISSION_LIMITERS = (turn_admission, asr_admission, llm_admission, tts_admission)
+
+def serve_static_file(request: web.Request, folder: str, cache_control: str,
+                      not_found: str) -> web.StreamResponse:
+    """
+    从folder中返回请求的文件
 
-class AudioFileHandler(SimpleHTTPRequestHandler):
-    """处理音频文件访问的HTTP处理器"""
+    FileResponse通过sendfile零拷贝发送文件，并处理Range（音频拖动和边下边播）、
+    ETag/Last-Modified条件请求，响应带有Content-Length，连接保持keep-alive
+    """
+    filename = request.match_info['filename']
+    file_path = os.path.join(folder, filename)
+    if filename.startswith('.') or os.path.basename(filename) != filename or not os.path.isfile(file_path):
+        raise web.HTTPNotFound(text=not_found, headers=CORS_HEADERS)
     
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, directory=os.getcwd(), **kwargs)
+    headers = dict(CORS_HEADERS)
+    headers['Cache-Control'] = cache_control
+    return web.FileResponse(file_path, headers=headers)
+
+class LeasedFileResponse(web.FileResponse):
+    """发送期间持有存储租约的FileResponse，文件不会在发送过程中被后台回收"""
     
-    def do_GET(self):
-        parsed_path = urlparse(self.path)
-        
-        if parsed_path.path.startswith('/api/audio/'):
-            # 提取文件名
-            filename = parsed_path.path.split('/')[-1]
-            file_path = os.path.join(REPLY_AUDIO_FOLDER, filename)
-            
-            if os.path.exists(file_path):
-                # 设置CORS头
-                self.send_response(200)
-                self.send_header('Content-Type', 'audio/mpeg')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-                self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-                self.end_headers()
-                
-                # 发送文件内容
-                with open(file_path, 'rb') as f:
-                    self.wfile.write(f.read())
-            else:
-                self.send_error(404, "Audio file not found")
-                
-        elif parsed_path.path.startswith('/api/emotion/'):
-            # 提取情绪图片文件名
-            filename = parsed_path.path.split('/')[-1]
-            file_path = os.path.join(EMOTION_IMG_FOLDER, filename)
-            
-            if os.path.exists(file_path):
-                # 设置CORS头
-                self.send_response(200)
-                self.send_header('Content-Type', 'image/jpeg')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-                self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-                self.end_headers()
-                
-                # 发送文件内容
-                with open(file_path, 'rb') as f:
-                    self.wfile.write(f.read())
-            else:
-                self.send_error(404, "Emotion image not found")
-        else:
-            self.send_error(404, "Not found")
+    def __init__(self, store, filename: str, **kwargs):
+        super().__init__(store.path_for(filename), **kwargs)
+        self.store = store
+        self.filename = filename
+    
+    async def prepare(self, request: web.BaseRequest):
+        acquired = self.store.acquire(self.filename)
+        try:
+            return await super().prepare(request)
+        finally:
+            if acquired:
+                self.store.release(self.filename)
 
-def start_http_server():
-    """启动HTTP服务器提供音频文件访问"""
-    try:
-        httpd = HTTPServer(('localhost', 5000), AudioFileHandler)
-        logger.info("HTTP服务器已启动，监听 localhost:5000")
-        httpd.serve_forever()
-    except Exception as e:
-        logger.error(f"HTTP服务器启动失败: {str(e)}")
+async def handle_audio_request(request: web.Request) -> web.StreamResponse:
+    """回复音频：TTS缓存文件按内容命名，内容不会变化，可以长期缓存"""
+    filename = request.match_info['filename']
+    if filename.endswith('.part'):
+        # 正在写入的临时文件
+        raise web.HTTPNotFound(text="Audio file not found", headers=CORS_HEADERS)
+    if tts_cache is None or not tts_cache.manages(filename):
+        return serve_static_file(request, REPLY_AUDIO_FOLDER, REVALIDATE_CACHE_CONTROL, "Audio file not found")
+    
+    # 在内存索引中查找，文件位于按文件名分散的子目录
+    if filename not in tts_cache.store:
+        raise web.HTTPNotFound(text="Audio file not found", headers=CORS_HEADERS)
+    headers = dict(CORS_HEADERS)
+    # 旧版本的回复语音不是按内容命名的，每次验证
+    headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if tts_cache.is_cache_file(filename) \
+        else REVALIDATE_CACHE_CONTROL
+    return LeasedFileResponse(tts_cache.store, filename, headers=headers)
+
+async def handle_emotion_request(request: web.Request) -> web.StreamResponse:
+    """情绪图片：从启动时加载的内存资源表返回，URL带有内容哈希版本号时永久缓存"""
+    asset_file = get_emotion_assets(EMOTION_IMG_FOLDER).get_file(request.match_info['filename'])
+    if asset_file is None:
+        return serve_static_file(request, EMOTION_IMG_FOLDER, EMOTION_IMG_CACHE_CONTROL, "Emotion image not found")
+    
+    headers = dict(CORS_HEADERS)
+    versioned = request.query.get('v') == asset_file.digest
+    headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL if versioned else EMOTION_IMG_CACHE_CONTROL
+    headers['ETag'] = asset_file.etag
+    
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        etags = [tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')]
+        if asset_file.etag in etags or '*' in etags:
+            return web.Response(status=304, headers=headers)
+    
+    return web.Response(body=asset_file.data, content_type=asset_file.content_type, headers=headers)
+
+async def handle_options_request(request: web.Request) -> web.Response:
+    return web.Response(headers=CORS_HEADERS)
+
+def collect_metrics() -> None:
+    """导出指标前读取连接数、队列长度和进行中的上游调用数"""
+    CONNECTED_CLIENTS.set(len(connected_clients))
+    executor = getattr(asyncio.get_event_loop(), '_default_executor', None)
+    work_queue = getattr(executor, '_work_queue', None)
+    QUEUE_DEPTH.labels('executor').set(work_queue.qsize() if work_queue is not None else 0)
+    QUEUE_DEPTH.labels('transcoder').set(get_transcoder().waiting)
+    if get_llm_client is not None:
+        llm_client = get_llm_client()
+        QUEUE_DEPTH.labels('llm').set(llm_client.queued)
+        UPSTREAM_IN_FLIGHT.labels('llm').set(llm_client.in_flight)
+    if get_tts_client is not None:
+        UPSTREAM_IN_FLIGHT.labels('tts').set(get_tts_client().in_use)
+
+registry.register_collector(collect_metrics)
+
+async def handle_metrics_request(request: web.Request) -> web.Response:
+    """Prometheus文本格式的运行指标"""
+    return web.Response(body=registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+def create_http_app() -> web.Application:
+    """创建提供音频和情绪图片访问的HTTP应用"""
+    app = web.Application()
+    app.router.add_get('/api/audio/{filename}', handle_audio_request)
+    app.router.add_get('/api/emotion/{filename}', handle_emotion_request)
+    app.router.add_get('/metrics', handle_metrics_request)
+    app.router.add_route('OPTIONS', '/api/{tail:.*}', handle_options_request)
+    return app
 
-async def run_asr_async(file_path: str) -> dict:
-    """异步运行ASR处理"""
+async def start_http_server() -> web.AppRunner:
+    """在当前事件循环中启动HTTP服务器提供音频文件访问"""
+    # 启动时一次性加载情绪图片
+    get_emotion_assets(EMOTION_IMG_FOLDER)
+    
+    runner = web.AppRunner(create_http_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, HTTP_HOST, HTTP_PORT)
+    await site.start()
+    logger.info(f"HTTP服务器已启动，监听 {HTTP_HOST}:{HTTP_PORT}")
+    return runner
+
+async def run_asr_async(audio) -> dict:
+    """
+    异步运行ASR处理
+    
+    Args:
+        audio: 内存中的录音（bytes/bytearray/memoryview），或录音文件路径
+    """
     try:
         if AsrWsClient is None:
             return {'success': False, 'error': '语音识别服务不可用'}
         
-        logger.info(f"开始ASR处理: {file_path}")
+        if isinstance(audio, str):
+            logger.info(f"开始ASR处理: {audio}")
+        else:
+            logger.info(f"开始ASR处理: 内存录音 {len(audio)} 字节")
         
-        async with AsrWsClient(ASR_URL, ASR_SEGMENT_DURATION) as client:
-            responses = []
-            async for response in client.execute(file_path):
-                responses.append(response.to_dict())
-                logger.info(f"ASR响应: {response.to_dict()}")
-            
-            # 提取识别结果
-            recognized_text = ""
-            for resp in responses:
-                if resp.get('payload_msg') and resp['payload_msg'].get('result'):
-                    result = resp['payload_msg']['result']
-                    if result.get('text'):
-                        recognized_text += result['text']
-            
-            return {
-                'success': True,
-                'recognized_text': recognized_text.strip(),
-                'raw_responses': responses
-            }
+        # 排队时间不计入ASR耗时
+        async with asr_admission:
+            with ASR_SECONDS.time(), ASR_IN_FLIGHT.track():
+                async with AsrWsClient(ASR_URL, ASR_SEGMENT_DURATION, ASR_PACING, pool=asr_pool,
+                                       vad=ASR_VAD) as client:
+                    responses = []
+                    results = client.execute(audio)
+                    try:
+                        async for response in results:
+                            responses.append(response.to_dict())
+                            logger.info(f"ASR响应: {response.to_dict()}")
+                    finally:
+                        await results.aclose()
+        
+        return {
+            'success': True,
+            'recognized_text': extract_recognized_text(responses),
+            'raw_responses': responses,
+            'vad': client.vad_result.to_dict() if client.vad_result is not None else None
+        }
             
+    except BusyError:
+        raise
+    except NoSpeechError as e:
+        # 没有人声的录音不上传识别
+        return {
+            'success': True,
+            'recognized_text': '',
+            'raw_responses': [],
+            'no_speech': True,
+            'vad': e.result.to_dict()
+        }
     except Exception as e:
         logger.error(f"ASR处理失败: {str(e)}")
+        record_upstream_error('asr', e)
         return {'success': False, 'error': str(e)}
 
-async def run_ai_response_async(text: str) -> dict:
-    """异步运行AI对话"""
+def extract_recognized_text(responses: list) -> str:
+    """从ASR响应列表中提取识别结果"""
+    recognized_text = ""
+    for resp in responses:
+        if resp.get('payload_msg') and resp['payload_msg'].get('result'):
+            result = resp['payload_msg']['result']
+            if result.get('text'):
+                recognized_text += result['text']
+    return recognized_text.strip()
+
+class StreamLimitExceeded(Exception):
+    """录音会话超过缓存上限"""
+
+class VoiceStreamSession:
+    """
+    边录边传的语音识别会话
+    
+    录音开始时建立上游ASR连接，收到的音频片段经队列依次转发给识别服务，
+    录音结束时只需等待最终结果。识别服务不支持的格式会先缓存，结束后走完整流程。
+    """
+    
+    def __init__(self, request_id: str, codec: int):
+        self.request_id = request_id
+        self.codec = codec
+        self.streaming = AsrWsClient is not None and codec in STREAMING_ASR_FORMATS
+        self.chunks = []  # 非流式格式的缓存
+        self.size = 0  # 已接收的字节数
+        self.queue = asyncio.Queue(STREAM_QUEUE_CHUNKS + 1)  # 多留一个位置给结束标记
+        self.task = asyncio.create_task(self._run()) if self.streaming else None
+    
+    async def _run(self) -> dict:
+        audio_format, audio_codec = STREAMING_ASR_FORMATS[self.codec]
+        # 录音期间一直占用一个ASR名额，排不上时丢弃之后收到的片段，录音结束时回复busy
+        async with asr_admission:
+            with ASR_IN_FLIGHT.track():
+                async with AsrWsClient(ASR_URL, ASR_SEGMENT_DURATION, pool=asr_pool) as client:
+                    finished = False
+                    try:
+                        await client.start_session(audio_format, audio_codec)
+                        while True:
+                            chunk = await self.queue.get()
+                            if chunk is None:
+                                break
+                            await client.feed(chunk)
+                        responses = await client.finish_session(ASR_STREAM_FINAL_TIMEOUT)
+                        finished = True
+                    finally:
+                        # 没有正常结束（被取消或出错）的连接不放回连接池
+                        await client.abort_session(error=not finished)
+        
+        responses = [response.to_dict() for response in responses]
+        logger.info(f"流式ASR响应: {responses}")
+        return {
+            'success': True,
+            'recognized_text': extract_recognized_text(responses),
+            'raw_responses': responses
+        }
+    
+    def feed(self, chunk) -> None:
+        """
+        接收一段录音数据（不阻塞，不拷贝）
+        
+        Raises:
+            StreamLimitExceeded: 录音超过STREAM_MAX_BYTES，或识别服务跟不上、排队的片段超过STREAM_QUEUE_CHUNKS
+        """
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > STREAM_MAX_BYTES:
+            raise StreamLimitExceeded('录音太长了')
+        if self.streaming:
+            if not self.task.done():
+                if self.queue.qsize() >= STREAM_QUEUE_CHUNKS:
+                    raise StreamLimitExceeded('语音识别跟不上录音')
+                self.queue.put_nowait(chunk)
+        else:
+            self.chunks.append(chunk)
+    
+    async def finish(self) -> dict:
+        """录音结束，返回识别结果（ASR耗时只统计录音结束后的等待时间）"""
+        self.queue.put_nowait(None)
+        try:
+            with ASR_SECONDS.time():
+                return await self.task
+        except BusyError:
+            raise
+        except Exception as e:
+            logger.error(f"流式ASR处理失败: {str(e)}")
+            record_upstream_error('asr', e)
+            return {'success': False, 'error': str(e)}
+    
+    def cancel(self) -> None:
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+async def run_ai_response_async(text: str, memory: ConversationMemory = None) -> dict:
+    """异步运行AI对话，传入memory时带上该连接的对话历史"""
     try:
-        if get_ai_response is None:
+        if get_ai_response_async is None:
             return {'success': False, 'error': 'AI对话服务不可用'}
         
         logger.info(f"开始AI对话: {text}")
         
-        # 在线程池中运行同步函数
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(executor, get_ai_response, text)
+        # 异步客户端直接在事件循环中请求，并发数由客户端的信号量限制
+        history = await memory.get_history() if memory is not None else None
+        async with llm_admission:
+            with LLM_SECONDS.time():
+                if memory is not None:
+                    result = await get_ai_response_async(text, memory.system_prompt, history)
+                else:
+                    result = await get_ai_response_async(text)
         
         logger.info(f"AI对话结果类型: {type(result)}, 内容: {result}")
         
@@ -172,6 +434,8 @@ async def run_ai_response_async(text: str) -> dict:
             logger.error(f"AI对话返回类型错误: {type(result)}")
             return {'success': False, 'error': f'AI对话返回类型错误: {type(result)}'}
         
+    except BusyError:
+        raise
     except Exception as e:
         logger.error(f"AI对话失败: {str(e)}", exc_info=True)
         return {'success': False, 'error': str(e)}
@@ -185,7 +449,9 @@ async def run_tts_async(text: str) -> dict:
         logger.info(f"开始TTS处理: {text}")
         
         # 直接调用异步TTS函数
-        result = await generate_speech(text)
+        async with tts_admission:
+            with TTS_SECONDS.time():
+                result = await generate_speech(text)
         
         logger.info(f"TTS结果类型: {type(result)}, 内容: {result}")
         
@@ -196,10 +462,275 @@ async def run_tts_async(text: str) -> dict:
             logger.error(f"TTS返回类型错误: {type(result)}")
             return {'success': False, 'error': f'TTS返回类型错误: {type(result)}'}
         
+    except BusyError as e:
+        # 语音合成满载时回复不带语音，不拒绝整轮对话
+        logger.warning(f"TTS繁忙，跳过语音合成: {str(e)}")
+        return {'success': False, 'error': str(e), 'busy': True}
     except Exception as e:
         logger.error(f"TTS处理失败: {str(e)}", exc_info=True)
         return {'success': False, 'error': str(e)}
 
+async def attach_reply_audio(reply: dict, stream_audio: bool = False) -> dict:
+    """
+    为AI回复生成语音
+    
+    普通模式下合成完整的音频文件并设置audio_url；流式模式下只准备语音流，
+    在send_reply发送回复后通过二进制帧边合成边下发，audio_url指向同时写入的文件
+    """
+    ai_reply = reply['message']
+    
+    if stream_audio and SpeechStream is not None:
+        audio_stream = SpeechStream(ai_reply)
+        reply['audio_stream_id'] = audio_stream.reply_id
+        reply['audio_url'] = f"/api/audio/{audio_stream.filename}"
+        reply['_audio_stream'] = audio_stream
+        return reply
+    
+    audio_url = None
+    try:
+        tts_result = await run_tts_async(ai_reply)
+        if isinstance(tts_result, dict) and tts_result.get('success'):
+            audio_filename = tts_result.get('filename')
+            if audio_filename:
+                audio_url = f"/api/audio/{audio_filename}"
+    except Exception as tts_error:
+        logger.error(f"TTS处理失败: {str(tts_error)}")
+    
+    reply['audio_url'] = audio_url
+    return reply
+
+async def buffer_reply_audio(audio_stream, queue: asyncio.Queue) -> None:
+    """
+    占用TTS名额合成回复语音，每段音频放入queue，结束时放入None，失败时放入异常
+
+    合成完成即归还名额，客户端接收慢时不会占着TTS名额
+    """
+    chunks = audio_stream.__aiter__()
+    try:
+        async with tts_admission:
+            async for chunk in chunks:
+                queue.put_nowait(chunk)
+    except Exception as e:
+        queue.put_nowait(e)
+        return
+    finally:
+        # 被打断时立即释放上游TTS连接
+        await chunks.aclose()
+    queue.put_nowait(None)
+
+async def stream_reply_audio(websocket, audio_stream) -> None:
+    """把合成中的回复语音逐块以二进制帧下发，最后发送结束帧或错误帧"""
+    reply_id = audio_stream.reply_id
+    queue = asyncio.Queue()
+    synthesis = asyncio.ensure_future(buffer_reply_audio(audio_stream, queue))
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                logger.error(f"流式TTS处理失败: {str(chunk)}")
+                await websocket.send(build_frame(FrameKind.TTS_ERROR, str(chunk).encode('utf-8'), reply_id))
+                return
+            await websocket.send(build_frame(FrameKind.TTS_CHUNK, chunk, reply_id, AudioCodec.MP3))
+    finally:
+        # 下发失败或被打断时停止合成
+        if not synthesis.done():
+            synthesis.cancel()
+            await asyncio.gather(synthesis, return_exceptions=True)
+    await websocket.send(build_frame(FrameKind.TTS_END, b'', reply_id, AudioCodec.MP3))
+
+async def send_reply(websocket, result: dict, request_id: str = None, emotion_asset: bool = False) -> None:
+    """
+    发送处理结果，流式语音回复在结果之后逐块下发
+    
+    emotion_asset为True时附带情绪图片的资源ID和内容哈希，emotion_img改为带版本号的URL，
+    客户端已缓存同一哈希的图片时不需要再请求
+    """
+    audio_stream = result.pop('_audio_stream', None)
+    if request_id:
+        result['request_id'] = request_id
+    if emotion_asset and 'emotion_value' in result:
+        asset = get_emotion_assets(EMOTION_IMG_FOLDER).describe(result['emotion_value'])
+        if asset is not None:
+            result['emotion_asset'] = asset
+            result['emotion_img'] = asset['url']
+    with SEND_SECONDS.time():
+        await websocket.send(json.dumps(result))
+        if audio_stream is not None:
+            await stream_reply_audio(websocket, audio_stream)
+
+async def send_sentence_audio(websocket, reply_id: str, tts_result: dict) -> None:
+    """把一句回复的语音以二进制帧下发"""
+    filename = tts_result.get('filename')
+    data = tts_cache.get_bytes(filename) if tts_cache is not None and filename else None
+    if data is None:
+        loop = asyncio.get_event_loop()
+        if tts_cache is not None and filename:
+            # 持有租约，读取期间文件不会被后台回收
+            with tts_cache.store.lease(filename):
+                data = await loop.run_in_executor(None, read_file, tts_result['file_path'])
+        else:
+            data = await loop.run_in_executor(None, read_file, tts_result['file_path'])
+    await websocket.send(build_frame(FrameKind.TTS_CHUNK, data, reply_id, AudioCodec.MP3))
+
+def build_usage_report(usage: dict, memory: ConversationMemory = None) -> dict:
+    """本轮请求的token用量，以及对话历史当前占用的上下文token数"""
+    report = dict(usage or {})
+    if memory is not None:
+        report['context_tokens'] = memory.token_count()
+        report['history_turns'] = len(memory.messages) // 2
+    logger.info(f"本轮token用量: {report}")
+    return report
+
+async def generate_streaming_reply(websocket, user_text: str, stream_audio: bool = False,
+                                   memory: ConversationMemory = None) -> dict:
+    """
+    流式生成AI回复：模型一边生成，一边按句子切分并立即合成语音
+    
+    每句话合成完成后按顺序发送assistant_reply_chunk消息（stream_audio时同时以二进制帧
+    下发该句语音），后面的句子在前面的句子播放时继续生成和合成。
+    全部完成后返回完整的assistant_reply，情绪标记只用于解析情绪值，不会被合成语音。
+    """
+    reply_id = uuid.uuid4().hex
+    splitter = SentenceSplitter()
+    sentences = asyncio.Queue()
+    raw_reply = ''
+    spoken = []
+    usage = {}
+    failed = False
+    
+    system_prompt = history = None
+    if memory is not None:
+        system_prompt, history = memory.system_prompt, await memory.get_history()
+    
+    def speak(sentence: str) -> None:
+        # 立即开始合成，不等待前面的句子
+        sentences.put_nowait((sentence, asyncio.ensure_future(run_tts_async(sentence))))
+    
+    async def send_sentences():
+        index = 0
+        while True:
+            item = await sentences.get()
+            if item is None:
+                break
+            sentence, tts_task = item
+            tts_result = await tts_task
+            audio_url = None
+            if tts_result.get('success') and tts_result.get('filename'):
+                audio_url = f"/api/audio/{tts_result['filename']}"
+                if stream_audio:
+                    await send_sentence_audio(websocket, reply_id, tts_result)
+            await websocket.send(json.dumps({
+                'type': 'assistant_reply_chunk',
+                'reply_id': reply_id,
+                'index': index,
+                'message': sentence,
+                'audio_url': audio_url
+            }))
+            spoken.append(sentence)
+            index += 1
+    
+    sender = asyncio.ensure_future(send_sentences())
+    deltas = stream_ai_response(user_text, system_prompt, history, usage)
+    try:
+        try:
+            async with llm_admission:
+                with LLM_SECONDS.time() as llm_timer:
+                    async for delta in deltas:
+                        if not raw_reply:
+                            LLM_FIRST_TOKEN_SECONDS.observe(time.perf_counter() - llm_timer.start)
+                        raw_reply += delta
+                        for sentence in splitter.feed(delta):
+                            speak(sentence)
+        except BusyError:
+            raise
+        except Exception as e:
+            logger.error(f"流式AI对话失败: {str(e)}", exc_info=True)
+            failed = True
+            if not raw_reply:
+                raw_reply = '抱歉，我现在有点问题，请稍后再试。[情绪:2]'
+                for sentence in splitter.feed(raw_reply):
+                    speak(sentence)
+        
+        for sentence in splitter.flush():
+            speak(sentence)
+        sentences.put_nowait(None)
+        await sender
+    finally:
+        # 被打断时关闭模型的流式输出，取消还没发送的语音合成
+        await deltas.aclose()
+        if not sender.done():
+            sender.cancel()
+            while not sentences.empty():
+                item = sentences.get_nowait()
+                if item is not None:
+                    item[1].cancel()
+    
+    if stream_audio:
+        await websocket.send(build_frame(FrameKind.TTS_END, b'', reply_id, AudioCodec.MP3))
+    
+    if memory is not None and not failed:
+        memory.add_turn(user_text, raw_reply, usage)
+    
+    ai_reply, emotion_value = parse_emotion_from_reply(raw_reply)
+    logger.info(f"流式AI回复完成: {len(spoken)}句, {ai_reply}")
+    return {
+        'type': 'assistant_reply',
+        'message': ai_reply,
+        'emotion_value': emotion_value,
+        'emotion_img': get_emotion_image_url(emotion_value),
+        'audio_url': None,
+        'user_message': user_text,
+        'reply_id': reply_id,
+        'streamed': True,
+        'sentence_count': len(spoken),
+        'usage': build_usage_report(usage, memory)
+    }
+
+async def generate_reply(websocket, user_text: str, stream_audio: bool = False,
+                         stream_reply: bool = False, memory: ConversationMemory = None) -> dict:
+    """调用AI模型生成回复并合成语音，memory为该连接的对话历史"""
+    # 发送状态更新
+    await websocket.send(json.dumps({
+        'type': 'status',
+        'message': 'AI正在思考回复...'
+    }))
+    
+    if stream_reply and stream_ai_response is not None:
+        return await generate_streaming_reply(websocket, user_text, stream_audio, memory)
+    
+    ai_result = await run_ai_response_async(user_text, memory)
+    usage = None
+    
+    # 安全地检查ai_result并提取情绪值
+    if isinstance(ai_result, dict) and ai_result.get('success'):
+        ai_reply = ai_result.get('ai_reply', '抱歉，我现在没有回复。')
+        emotion_value = ai_result.get('emotion_value', 3)  # 默认为中性情绪
+        usage = ai_result.get('usage')
+        if memory is not None:
+            memory.add_turn(user_text, ai_result.get('raw_reply', ai_reply), usage)
+    else:
+        ai_reply = '抱歉，我现在有点问题，请稍后再试。'
+        emotion_value = 2  # 错误情况下设置为消极情绪
+    
+    # 发送状态更新
+    await websocket.send(json.dumps({
+        'type': 'status',
+        'message': '正在生成语音回复...'
+    }))
+    
+    # 生成TTS语音并返回最终结果
+    return await attach_reply_audio({
+        'type': 'assistant_reply',
+        'message': ai_reply,
+        'emotion_value': emotion_value,
+        'emotion_img': get_emotion_image_url(emotion_value),
+        'audio_url': None,
+        'user_message': user_text,
+        'usage': build_usage_report(usage, memory)
+    }, stream_audio)
+
 def get_emotion_image_url(emotion_value: int) -> str:
     """
     根据情绪值获取对应的图片URL
@@ -231,36 +762,49 @@ def run_tts_in_thread(text: str, result_container: dict):
         result_container.update({'success': False, 'error': str(e)})
 
 async def save_audio_file(audio_data: bytes, file_extension: str = 'webm') -> str:
-    """保存音频文件并返回文件路径"""
+    """保存音频文件并返回文件名"""
     try:
         # 生成唯一文件名
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         unique_id = str(uuid.uuid4())[:8]
         filename = f"voice_{timestamp}_{unique_id}.{file_extension}"
-        file_path = os.path.join(UPLOAD_FOLDER, filename)
+        file_path = upload_store.path_for(filename, create=True)
         
         # 保存文件
-        with open(file_path, 'wb') as f:
-            f.write(audio_data)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, write_file, file_path, audio_data)
+        upload_store.add(filename, len(audio_data))
         
         logger.info(f"音频文件保存成功: {file_path}")
-        return file_path
+        return filename
         
     except Exception as e:
         logger.error(f"保存音频文件失败: {str(e)}")
         raise
 
-async def process_voice_message(websocket, audio_data: bytes) -> dict:
+async def spill_audio_file(audio_data: bytes, file_extension: str) -> None:
+    """后台保存录音，失败只记录日志，不影响识别和回复"""
+    try:
+        with SAVE_SECONDS.time():
+            await save_audio_file(audio_data, file_extension)
+    except Exception:
+        pass  # save_audio_file已记录错误
+
+def spill_audio(audio_data: bytes, file_extension: str = 'webm') -> None:
+    """安排录音在后台落盘，立即返回"""
+    if not UPLOAD_SPILL:
+        return
+    task = asyncio.ensure_future(spill_audio_file(audio_data, file_extension))
+    spill_tasks.add(task)
+    task.add_done_callback(spill_tasks.discard)
+
+async def process_voice_message(websocket, audio_data: bytes, file_extension: str = 'webm',
+                                stream_audio: bool = False, stream_reply: bool = False,
+                                memory: ConversationMemory = None) -> dict:
     """处理语音消息的完整流程"""
     try:
-        # 发送状态更新
-        await websocket.send(json.dumps({
-            'type': 'status',
-            'message': '正在保存音频文件...'
-        }))
-        
-        # 1. 保存音频文件
-        file_path = await save_audio_file(audio_data)
+        # 1. 录音在后台另存一份，不等待写盘
+        spill_audio(audio_data, file_extension)
         
         # 发送状态更新
         await websocket.send(json.dumps({
@@ -268,9 +812,24 @@ async def process_voice_message(websocket, audio_data: bytes) -> dict:
             'message': '正在进行语音识别...'
         }))
         
-        # 2. 进行语音识别
-        asr_result = await run_asr_async(file_path)
+        # 2. 直接用内存中的录音进行语音识别
+        asr_result = await run_asr_async(audio_data)
         
+        return await reply_to_asr_result(websocket, asr_result, stream_audio, stream_reply, memory)
+        
+    except BusyError:
+        raise
+    except Exception as e:
+        logger.error(f"处理语音消息失败: {str(e)}")
+        return {
+            'type': 'error',
+            'message': f'处理失败: {str(e)}'
+        }
+
+async def reply_to_asr_result(websocket, asr_result: dict, stream_audio: bool = False,
+                              stream_reply: bool = False, memory: ConversationMemory = None) -> dict:
+    """根据语音识别结果生成AI回复和TTS语音"""
+    try:
         if not asr_result['success']:
             return {
                 'type': 'error',
@@ -279,11 +838,12 @@ async def process_voice_message(websocket, audio_data: bytes) -> dict:
         
         recognized_text = asr_result['recognized_text']
         
-        # 发送语音识别结果
-        await websocket.send(json.dumps({
-            'type': 'asr_result',
-            'message': f'识别结果: "{recognized_text}"'
-        }))
+        # 发送语音识别结果，没有人声时没有经过识别，直接回复
+        if not asr_result.get('no_speech'):
+            await websocket.send(json.dumps({
+                'type': 'asr_result',
+                'message': f'识别结果: "{recognized_text}"'
+            }))
         
         if not recognized_text.strip():
             return {
@@ -292,50 +852,11 @@ async def process_voice_message(websocket, audio_data: bytes) -> dict:
                 'audio_url': None
             }
         
-        # 发送状态更新
-        await websocket.send(json.dumps({
-            'type': 'status',
-            'message': 'AI正在思考回复...'
-        }))
-        
-        # 3. 调用AI模型
-        ai_result = await run_ai_response_async(recognized_text)
-        
-        # 安全地检查ai_result并提取情绪值
-        if isinstance(ai_result, dict) and ai_result.get('success'):
-            ai_reply = ai_result.get('ai_reply', '抱歉，我现在没有回复。')
-            emotion_value = ai_result.get('emotion_value', 3)  # 默认为中性情绪
-        else:
-            ai_reply = '抱歉，我现在有点问题，请稍后再试。'
-            emotion_value = 2  # 错误情况下设置为消极情绪
-        
-        # 发送状态更新
-        await websocket.send(json.dumps({
-            'type': 'status',
-            'message': '正在生成语音回复...'
-        }))
-        
-        # 4. 生成TTS语音
-        audio_url = None
-        try:
-            tts_result = await run_tts_async(ai_reply)
-            if isinstance(tts_result, dict) and tts_result.get('success'):
-                audio_filename = tts_result.get('filename')
-                if audio_filename:
-                    audio_url = f"/api/audio/{audio_filename}"
-        except Exception as tts_error:
-            logger.error(f"TTS处理失败: {str(tts_error)}")
-        
-        # 返回最终结果
-        return {
-            'type': 'assistant_reply',
-            'message': ai_reply,
-            'emotion_value': emotion_value,
-            'emotion_img': get_emotion_image_url(emotion_value),
-            'audio_url': audio_url,
-            'user_message': recognized_text
-        }
+        # 3. 调用AI模型并生成TTS语音
+        return await generate_reply(websocket, recognized_text, stream_audio, stream_reply, memory)
         
+    except BusyError:
+        raise
     except Exception as e:
         logger.error(f"处理语音消息失败: {str(e)}")
         return {
@@ -343,12 +864,259 @@ async def process_voice_message(websocket, audio_data: bytes) -> dict:
             'message': f'处理失败: {str(e)}'
         }
 
+def message_options(options: dict, data: dict) -> dict:
+    """连接的客户端选项，加上单条消息中覆盖的选项"""
+    merged = dict(options)
+    for key in CLIENT_OPTIONS:
+        if key in data:
+            merged[key] = bool(data[key])
+    return merged
+
+async def run_turn(websocket, kind: str, handler, request_id: str = None) -> None:
+    """
+    在准入控制下进行一轮对话，handler为处理并发送结果的协程函数
+    
+    排队截止时间从收到消息时开始计算；整轮对话或其中某个阶段满载时不再等待，
+    立即回复busy消息，客户端可以稍后重试
+    """
+    try:
+        with deadline_scope(TURN_QUEUE_DEADLINE):
+            async with turn_admission:
+                with REQUEST_SECONDS.labels(kind).time():
+                    await handler()
+    except BusyError as e:
+        logger.warning(f"服务器繁忙，拒绝请求 {request_id}: {str(e)}")
+        busy = {
+            'type': 'busy',
+            'message': '藿藿现在有点忙，请稍后再试。'
+        }
+        busy.update(e.to_dict())
+        await send_reply(websocket, busy, request_id)
+
+async def reply_to_voice(websocket, audio_data: bytes, file_extension: str, options: dict,
+                         memory: ConversationMemory, request_id: str = None):
+    """一轮语音对话：识别、回复并发送结果"""
+    async def handler():
+        result = await process_voice_message(websocket, audio_data, file_extension, options['stream_audio'],
+                                             options['stream_reply'], memory)
+        await send_reply(websocket, result, request_id, options['emotion_asset'])
+    await run_turn(websocket, 'voice', handler, request_id)
+
+async def reply_to_voice_stream(websocket, session: 'VoiceStreamSession', options: dict,
+                                memory: ConversationMemory):
+    """一轮边录边传的语音对话：等待识别结果、回复并发送结果（耗时从录音结束开始计算）"""
+    async def handler():
+        if session.streaming:
+            await websocket.send(json.dumps({
+                'type': 'status',
+                'message': '正在进行语音识别...'
+            }))
+            asr_result = await session.finish()
+            result = await reply_to_asr_result(websocket, asr_result, options['stream_audio'],
+                                               options['stream_reply'], memory)
+        else:
+            audio_data = b''.join(session.chunks)
+            logger.info(f"流式录音结束，缓存音频大小: {len(audio_data)} bytes")
+            result = await process_voice_message(websocket, audio_data, CODEC_EXTENSIONS.get(session.codec, 'webm'),
+                                                 options['stream_audio'], options['stream_reply'], memory)
+        
+        await send_reply(websocket, result, session.request_id, options['emotion_asset'])
+    await run_turn(websocket, 'voice_stream', handler, session.request_id)
+
+async def reply_to_text(websocket, text: str, options: dict, memory: ConversationMemory,
+                        request_id: str = None):
+    """一轮文字对话：回复并发送结果"""
+    async def handler():
+        reply = await generate_reply(websocket, text, options['stream_audio'], options['stream_reply'], memory)
+        await send_reply(websocket, reply, request_id, options['emotion_asset'])
+    await run_turn(websocket, 'text', handler, request_id)
+
+class ClientSupervisor:
+    """
+    一个连接上的请求任务管理
+    
+    每个请求在独立的任务中处理，消息循环不会被ASR/LLM/TTS阻塞，ping等消息可以立即应答。
+    用户开始新一轮发言时取消上一轮还没完成的处理（打断），立即释放上游连接，
+    不再为没人听的回复合成语音。
+    """
+    
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.tasks = set()
+        self.turn = None  # 当前一轮对话的任务
+        self.turn_request_id = None
+        self.interrupted = 0
+    
+    def spawn(self, coro, request_id: str = None) -> asyncio.Task:
+        """在独立任务中处理一个请求"""
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(lambda finished: self._on_done(finished, request_id))
+        return task
+    
+    async def start_turn(self, coro, request_id: str = None) -> None:
+        """开始新的一轮对话，上一轮还没完成时先取消"""
+        await self.interrupt()
+        self.turn = self.spawn(coro, request_id)
+        self.turn_request_id = request_id
+    
+    async def interrupt(self) -> None:
+        """取消进行中的一轮对话，等它清理完后通知客户端"""
+        turn, self.turn = self.turn, None
+        if turn is None or turn.done():
+            return
+        turn.cancel()
+        self.interrupted += 1
+        logger.info(f"打断上一轮对话: {self.turn_request_id}")
+        # 等上一轮关闭TTS流、归还准入名额后再开始新的一轮，也保证interrupted之后不再有上一轮的消息
+        await asyncio.wait({turn}, timeout=TURN_CANCEL_TIMEOUT)
+        if not turn.done():
+            logger.warning(f"上一轮对话在{TURN_CANCEL_TIMEOUT}秒内没有结束: {self.turn_request_id}")
+        await self.websocket.send(json.dumps({
+            'type': 'interrupted',
+            'request_id': self.turn_request_id
+        }))
+    
+    def _on_done(self, task: asyncio.Task, request_id: str = None) -> None:
+        self.tasks.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None or isinstance(error, websockets.exceptions.ConnectionClosed):
+            return
+        logger.error(f"处理消息失败: {str(error)}")
+        self.spawn(self._send_error(error, request_id), request_id)
+    
+    async def _send_error(self, error: Exception, request_id: str = None) -> None:
+        try:
+            await self.websocket.send(json.dumps({
+                'type': 'error',
+                'message': f'服务器内部错误: {str(error)}',
+                'request_id': request_id
+            }))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            logger.warning(f"发送错误消息失败: {str(e)}")
+    
+    async def close(self) -> None:
+        """连接断开时取消所有进行中的请求"""
+        for task in list(self.tasks):
+            task.cancel()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+async def feed_stream(websocket, streams: dict, session: VoiceStreamSession, chunk) -> bool:
+    """把录音片段交给会话，超过上限时取消会话并通知客户端，返回是否成功"""
+    try:
+        session.feed(chunk)
+        return True
+    except StreamLimitExceeded as e:
+        logger.warning(f"流式录音超过上限，已取消: {session.request_id}, {session.size} bytes, {e}")
+        streams.pop(session.request_id, None)
+        session.cancel()
+        await websocket.send(json.dumps({
+            'type': 'error',
+            'message': f'{e}，请重新录音',
+            'request_id': session.request_id
+        }))
+        return False
+
+async def handle_binary_message(websocket, message: bytes, streams: dict, options: dict,
+                                memory: ConversationMemory, supervisor: ClientSupervisor):
+    """
+    处理二进制帧消息，streams保存该连接上进行中的流式识别会话，
+    options为连接的客户端选项，memory为连接的对话历史
+    """
+    try:
+        frame = parse_client_frame(message)
+    except ValueError as e:
+        await websocket.send(json.dumps({
+            'type': 'error',
+            'message': f'无效的二进制帧: {str(e)}'
+        }))
+        return
+
+    if frame.kind == FrameKind.AUDIO:
+        if not frame.payload:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': '无效的音频数据',
+                'request_id': frame.request_id
+            }))
+            return
+
+        logger.info(f"收到二进制音频数据，大小: {len(frame.payload)} bytes, 格式: {frame.file_extension}")
+
+        # 在独立任务中处理语音消息
+        await supervisor.start_turn(reply_to_voice(websocket, frame.payload, frame.file_extension,
+                                                   dict(options), memory, frame.request_id), frame.request_id)
+    
+    elif frame.kind == FrameKind.AUDIO_START:
+        # 用户开始说话：打断还在进行的上一轮回复，并立即建立上游识别连接
+        previous = streams.pop(frame.request_id, None)
+        if previous:
+            previous.cancel()
+        if len(streams) >= MAX_STREAMS_PER_CLIENT:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': '进行中的录音太多，请先结束之前的录音',
+                'request_id': frame.request_id
+            }))
+            return
+        await supervisor.interrupt()
+        session = VoiceStreamSession(frame.request_id, frame.codec)
+        streams[frame.request_id] = session
+        if not await feed_stream(websocket, streams, session, frame.payload):
+            return
+        logger.info(f"开始流式录音: {frame.request_id}, 格式: {frame.file_extension}, 边录边传: {session.streaming}")
+    
+    elif frame.kind == FrameKind.AUDIO_CHUNK:
+        session = streams.get(frame.request_id)
+        if session:
+            await feed_stream(websocket, streams, session, frame.payload)
+        else:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': '未找到对应的录音会话',
+                'request_id': frame.request_id
+            }))
+    
+    elif frame.kind == FrameKind.AUDIO_END:
+        session = streams.pop(frame.request_id, None)
+        if session is None:
+            await websocket.send(json.dumps({
+                'type': 'error',
+                'message': '未找到对应的录音会话',
+                'request_id': frame.request_id
+            }))
+            return
+        if not await feed_stream(websocket, streams, session, frame.payload):
+            return
+        
+        await supervisor.start_turn(reply_to_voice_stream(websocket, session, dict(options), memory),
+                                    frame.request_id)
+    
+    else:
+        await websocket.send(json.dumps({
+            'type': 'error',
+            'message': f'未知的二进制帧类型: {frame.kind}',
+            'request_id': frame.request_id
+        }))
+
 async def handle_client(websocket, path):
     """处理WebSocket客户端连接"""
     client_id = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
     logger.info(f"客户端连接: {client_id}")
     
     connected_clients.add(websocket)
+    streams = {}  # 进行中的流式识别会话
+    options = dict(CLIENT_OPTIONS)  # 客户端选项，可通过config消息修改
+    # 该连接的多轮对话历史
+    memory = ConversationMemory(summarizer=summarize_conversation if get_llm_client is not None else None)
+    client_memories[websocket] = memory
+    # 每个请求在独立任务中处理，新一轮发言会打断上一轮
+    supervisor = ClientSupervisor(websocket)
     
     try:
         # 发送欢迎消息
@@ -360,6 +1128,11 @@ async def handle_client(websocket, path):
         
         async for message in websocket:
             try:
+                if isinstance(message, bytes):
+                    # 二进制帧：音频数据以memoryview直接传递，不做base64解码和拷贝
+                    await handle_binary_message(websocket, message, streams, options, memory, supervisor)
+                    continue
+
                 data = json.loads(message)
                 message_type = data.get('type')
                 
@@ -372,11 +1145,11 @@ async def handle_client(websocket, path):
                         
                         logger.info(f"收到音频数据，大小: {len(audio_data)} bytes")
                         
-                        # 处理语音消息
-                        result = await process_voice_message(websocket, audio_data)
-                        
-                        # 发送处理结果
-                        await websocket.send(json.dumps(result))
+                        # 在独立任务中处理语音消息
+                        await supervisor.start_turn(reply_to_voice(
+                            websocket, audio_data, 'webm', message_options(options, data),
+                            memory, data.get('request_id')
+                        ), data.get('request_id'))
                     else:
                         await websocket.send(json.dumps({
                             'type': 'error',
@@ -389,49 +1162,43 @@ async def handle_client(websocket, path):
                     if text_content:
                         logger.info(f"收到文本消息: {text_content}")
                         
-                        # 发送状态更新
-                        await websocket.send(json.dumps({
-                            'type': 'status',
-                            'message': 'AI正在思考回复...'
-                        }))
-                        
-                        # 调用AI模型
-                        ai_result = await run_ai_response_async(text_content)
-                        
-                        # 安全地检查ai_result并提取情绪值
-                        if isinstance(ai_result, dict) and ai_result.get('success'):
-                            ai_reply = ai_result.get('ai_reply', '抱歉，我现在没有回复。')
-                            emotion_value = ai_result.get('emotion_value', 3)  # 默认为中性情绪
-                        else:
-                            ai_reply = '抱歉，我现在有点问题，请稍后再试。'
-                            emotion_value = 2  # 错误情况下设置为消极情绪
-                        
-                        # 生成TTS语音
-                        audio_url = None
-                        try:
-                            tts_result = await run_tts_async(ai_reply)
-                            if isinstance(tts_result, dict) and tts_result.get('success'):
-                                audio_filename = tts_result.get('filename')
-                                if audio_filename:
-                                    audio_url = f"/api/audio/{audio_filename}"
-                        except Exception as tts_error:
-                            logger.error(f"TTS处理失败: {str(tts_error)}")
-                        
-                        # 发送回复
-                        await websocket.send(json.dumps({
-                            'type': 'assistant_reply',
-                            'message': ai_reply,
-                            'emotion_value': emotion_value,
-                            'emotion_img': get_emotion_image_url(emotion_value),
-                            'audio_url': audio_url,
-                            'user_message': text_content
-                        }))
+                        # 在独立任务中调用AI模型并生成TTS语音
+                        await supervisor.start_turn(reply_to_text(
+                            websocket, text_content, message_options(options, data),
+                            memory, data.get('request_id')
+                        ), data.get('request_id'))
                     else:
                         await websocket.send(json.dumps({
                             'type': 'error',
                             'message': '无效的文本消息'
                         }))
                 
+                elif message_type == 'config':
+                    # 客户端选项，见CLIENT_OPTIONS
+                    options.update(message_options(options, data))
+                    await websocket.send(json.dumps({
+                        'type': 'config',
+                        'options': options
+                    }))
+                
+                elif message_type == 'assets':
+                    # 全部情绪图片的资源ID、哈希和URL，include_data指定版本时内嵌base64图片数据
+                    await websocket.send(json.dumps({
+                        'type': 'assets',
+                        'emotions': get_emotion_assets(EMOTION_IMG_FOLDER).manifest(data.get('include_data'))
+                    }))
+                
+                elif message_type == 'interrupt':
+                    # 客户端主动打断当前回复（例如用户点击了停止）
+                    await supervisor.interrupt()
+                
+                elif message_type == 'stats':
+                    # 服务器运行状态：AI请求的进行中/排队数等
+                    await websocket.send(json.dumps({
+                        'type': 'stats',
+                        'stats': get_server_stats()
+                    }))
+                
                 elif message_type == 'ping':
                     # 心跳检测
                     await websocket.send(json.dumps({
@@ -462,13 +1229,68 @@ async def handle_client(websocket, path):
     except Exception as e:
         logger.error(f"WebSocket处理错误: {str(e)}")
     finally:
+        await supervisor.close()
+        for session in streams.values():
+            session.cancel()
+        memory.close()
+        client_memories.pop(websocket, None)
         connected_clients.discard(websocket)
         logger.info(f"清理客户端连接: {client_id}")
 
+def get_conversation_stats() -> dict:
+    """汇总所有连接的对话历史统计，用于观察上下文预算和摘要压缩情况"""
+    stats = [memory.get_stats() for memory in client_memories.values()]
+    return {
+        'conversations': len(stats),
+        'turns': sum(s['turns'] for s in stats),
+        'context_tokens': sum(s['context_tokens'] for s in stats),
+        'max_context_tokens': max((s['context_tokens'] for s in stats), default=0),
+        'compactions': sum(s['compactions'] for s in stats),
+        'dropped_turns': sum(s['dropped_turns'] for s in stats),
+        'summary_failures': sum(s['summary_failures'] for s in stats)
+    }
+
+def get_server_stats() -> dict:
+    """汇总当前事件循环中各服务的统计信息"""
+    return {
+        'connected_clients': len(connected_clients),
+        'conversation': get_conversation_stats(),
+        'llm': get_llm_client().get_stats() if get_llm_client is not None else None,
+        'asr_pool': asr_pool.get_stats() if asr_pool is not None else None,
+        'admission': {limiter.stage: limiter.get_stats() for limiter in ADMISSION_LIMITERS},
+        'outbound': get_outbound_stats(),
+        'asr_compression': {
+            'audio': asr_audio_compression.get_stats(),
+            'control': asr_control_compression.get_stats()
+        } if AsrWsClient is not None else None,
+        'tts': get_tts_client().get_stats() if get_tts_client is not None else None,
+        'storage': {
+            'uploads': upload_store.get_stats(),
+            'pending_spills': len(spill_tasks),
+            'reply_audio': tts_cache.store.get_stats() if tts_cache is not None else None
+        }
+    }
+
 async def start_server():
     """启动WebSocket服务器"""
-    host = "localhost"
-    port = 8765
+    global asr_pool, gc_task
+    host = WS_HOST
+    port = WS_PORT
+    
+    # 创建共享的ASR连接池并开始预热连接
+    if AsrConnectionPool is not None:
+        asr_pool = AsrConnectionPool(ASR_URL, ASR_POOL_SIZE, ASR_POOL_MAX_IDLE)
+        await asr_pool.start()
+    
+    # 创建异步AI客户端
+    if get_llm_client is not None:
+        get_llm_client(LLM_MAX_CONCURRENCY)
+    
+    # 在线程池中建立音频文件索引（迁移旧文件），之后在后台回收过期和超出容量的文件
+    stores = [upload_store] if tts_cache is None else [upload_store, tts_cache.store]
+    await asyncio.gather(*(store.open() for store in stores))
+    if STORAGE_GC:
+        gc_task = asyncio.ensure_future(run_gc(stores))
     
     logger.info(f"启动WebSocket服务器在 ws://{host}:{port}")
     
@@ -488,20 +1310,20 @@ async def start_server():
     return server
 
 if __name__ == "__main__":
+    http_runner = None
     try:
-        # 在后台线程中启动HTTP服务器
-        http_thread = threading.Thread(target=start_http_server, daemon=True)
-        http_thread.start()
-        logger.info("HTTP服务器线程已启动")
+        loop = asyncio.get_event_loop()
+        
+        # HTTP服务器与WebSocket服务器运行在同一个事件循环中
+        http_runner = loop.run_until_complete(start_http_server())
         
         # 启动WebSocket服务器
-        loop = asyncio.get_event_loop()
         server = loop.run_until_complete(start_server())
         
         logger.info("服务器正在运行，按Ctrl+C停止")
-        logger.info("WebSocket地址: ws://localhost:8765")
-        logger.info("音频文件HTTP服务: http://localhost:5000")
-        logger.info("情绪图片HTTP服务: http://localhost:5000/api/emotion/")
+        logger.info(f"WebSocket地址: ws://{WS_HOST}:{WS_PORT}")
+        logger.info(f"音频文件HTTP服务: http://{HTTP_HOST}:{HTTP_PORT}")
+        logger.info(f"情绪图片HTTP服务: http://{HTTP_HOST}:{HTTP_PORT}/api/emotion/")
         
         # 保持服务器运行
         loop.run_forever()
@@ -512,5 +1334,17 @@ if __name__ == "__main__":
         logger.error(f"服务器启动失败: {str(e)}")
     finally:
         # 清理资源
-        executor.shutdown(wait=True)
+        if gc_task is not None:
+            gc_task.cancel()
+        if spill_tasks:
+            # 等待尚未写完的录音落盘
+            loop.run_until_complete(asyncio.gather(*spill_tasks, return_exceptions=True))
+        if http_runner is not None:
+            loop.run_until_complete(http_runner.cleanup())
+        if asr_pool is not None:
+            loop.run_until_complete(asr_pool.close())
+        if get_llm_client is not None:
+            loop.run_until_complete(close_llm_client())
+        if close_tts_client is not None:
+            loop.run_until_complete(close_tts_client())
         logger.info("服务器已关闭")
\ No newline at end of file
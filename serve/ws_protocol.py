@@ -0,0 +1,124 @@
+"""
+WebSocket二进制帧协议
+客户端可以直接发送二进制帧上传音频，避免base64编码带来的约33%体积膨胀和多次内存拷贝
+
+帧格式（大端序，上下行相同）:
+    偏移   长度   含义
+    0      1      协议版本 (0x01)
+    1      1      消息类型 (FrameKind)
+    2      1      音频编码 (AudioCodec)
+    3      1      请求ID长度 N (0-255)
+    4      N      请求ID (utf-8)
+    4+N    ...    原始音频数据
+"""
+
+import struct
+from typing import Optional
+
+PROTOCOL_VERSION = 0x01
+
+# 固定头部: 版本, 消息类型, 音频编码, 请求ID长度
+FRAME_HEADER = struct.Struct('>BBBB')
+
+
+class FrameKind:
+    AUDIO = 0x01        # 完整的一段录音
+    AUDIO_START = 0x02  # 开始录音（流式识别），payload可携带第一段音频
+    AUDIO_CHUNK = 0x03  # 录音过程中的一段音频
+    AUDIO_END = 0x04    # 录音结束，payload可携带最后一段音频
+    
+    # 服务端下行，请求ID字段为回复ID
+    TTS_CHUNK = 0x11    # 一段合成好的回复语音
+    TTS_END = 0x12      # 回复语音结束
+    TTS_ERROR = 0x13    # 回复语音合成失败，payload为utf-8错误信息
+
+
+class AudioCodec:
+    UNKNOWN = 0x00
+    WEBM = 0x01
+    WAV = 0x02
+    MP3 = 0x03
+    OGG = 0x04
+    PCM = 0x05  # 16kHz 16bit 单声道裸PCM
+
+
+# 音频编码对应的文件扩展名
+CODEC_EXTENSIONS = {
+    AudioCodec.UNKNOWN: 'webm',
+    AudioCodec.WEBM: 'webm',
+    AudioCodec.WAV: 'wav',
+    AudioCodec.MP3: 'mp3',
+    AudioCodec.OGG: 'ogg',
+    AudioCodec.PCM: 'pcm',
+}
+
+
+class ClientFrame:
+    """解析后的客户端二进制帧，payload是对原始消息的memoryview，不发生拷贝"""
+
+    __slots__ = ('kind', 'codec', 'request_id', 'payload')
+
+    def __init__(self, kind: int, codec: int, request_id: str, payload: memoryview):
+        self.kind = kind
+        self.codec = codec
+        self.request_id = request_id
+        self.payload = payload
+
+    @property
+    def file_extension(self) -> str:
+        return CODEC_EXTENSIONS.get(self.codec, 'webm')
+
+
+def parse_client_frame(message: bytes) -> ClientFrame:
+    """
+    解析客户端发送的二进制帧
+
+    Args:
+        message (bytes): WebSocket收到的二进制消息
+
+    Returns:
+        ClientFrame: 解析结果，payload为零拷贝的memoryview
+
+    Raises:
+        ValueError: 帧格式无效
+    """
+    if len(message) < FRAME_HEADER.size:
+        raise ValueError("二进制帧过短")
+
+    version, kind, codec, id_len = FRAME_HEADER.unpack_from(message, 0)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"不支持的协议版本: {version}")
+
+    offset = FRAME_HEADER.size + id_len
+    if len(message) < offset:
+        raise ValueError("二进制帧请求ID长度无效")
+
+    view = memoryview(message)
+    request_id = str(view[FRAME_HEADER.size:offset], 'utf-8') if id_len else ''
+    return ClientFrame(kind, codec, request_id, view[offset:])
+
+
+def build_frame(kind: int, payload: bytes = b'', request_id: Optional[str] = None,
+                codec: int = AudioCodec.UNKNOWN) -> bytes:
+    """
+    构建二进制帧（客户端测试脚本与服务端下行消息共用）
+
+    Args:
+        kind (int): 消息类型
+        payload (bytes): 音频数据
+        request_id (str): 请求ID
+        codec (int): 音频编码
+
+    Returns:
+        bytes: 完整的二进制帧
+    """
+    id_bytes = request_id.encode('utf-8') if request_id else b''
+    if len(id_bytes) > 255:
+        raise ValueError("请求ID过长")
+
+    frame = bytearray(FRAME_HEADER.size + len(id_bytes) + len(payload))
+    FRAME_HEADER.pack_into(frame, 0, PROTOCOL_VERSION, kind, codec, len(id_bytes))
+    offset = FRAME_HEADER.size
+    frame[offset:offset + len(id_bytes)] = id_bytes
+    frame[offset + len(id_bytes):] = payload
+    return bytes(frame)